@@ -0,0 +1,183 @@
+
+from datetime import timedelta
+
+import numpy as np
+
+from .lazy import lazy_import
+
+
+# loaded at first use to keep imports fast
+pd = lazy_import('pandas')
+
+
+METHODS = ('nearest', 'linear')
+
+
+def epoch_ns(times):
+    """ int64 nanoseconds since epoch of datetimes, naive ones are utc """
+
+    times = pd.DatetimeIndex(times)
+    if times.tz is not None:
+        times = times.tz_convert('UTC').tz_localize(None)
+    return times.to_numpy(dtype='datetime64[ns]').view(np.int64)
+
+
+def parse_tolerance(tolerance):
+    """ tolerance in nanoseconds from a timedelta, a pandas offset string
+    ('10min') or a number of seconds, None means unbounded """
+
+    if tolerance is None:
+        return np.iinfo(np.int64).max
+    if isinstance(tolerance, (int, float)):
+        tolerance = timedelta(seconds=tolerance)
+    return pd.Timedelta(tolerance).value
+
+
+def direction_columns(columns):
+    """ the wind direction columns of meteo data (not their standard
+    deviations), the default of align and zandmotor.meteo.resample_angles """
+    return [column for column in columns
+            if str(column).startswith('WindDir')
+            and not str(column).endswith('Std')]
+
+
+def align_values(times, values, query, method='nearest', tolerance=None,
+                 circular=None, radians=False):
+    """ (query, column) values of a (time, column) array at the query times
+    (all int64 nanoseconds). nearest takes the closest sample within the
+    tolerance, linear interpolates between the samples around a query time
+    if both are within the tolerance (or one matches exactly). Columns
+    flagged in circular are directions, interpolated on the unit circle.
+    Queries without valid samples are nan """
+
+    if method not in METHODS:
+        raise ValueError(f'method must be one of {METHODS}')
+
+    times = np.asarray(times, dtype=np.int64)
+    values = np.asarray(values, dtype=float)
+    if values.ndim == 1:
+        values = values[:, None]
+    query = np.asarray(query, dtype=np.int64)
+    tolerance = parse_tolerance(tolerance)
+
+    if np.any(np.diff(times) < 0):
+        order = np.argsort(times, kind='stable')
+        times, values = times[order], values[order]
+
+    output = np.full((len(query), values.shape[1]), np.nan)
+    if not len(times):
+        return output
+
+    # samples at or before (left) and after (right) every query
+    right = np.searchsorted(times, query, side='right')
+    left = np.clip(right - 1, 0, len(times) - 1)
+    right = np.clip(right, 0, len(times) - 1)
+    left_gap = query - times[left]
+    right_gap = times[right] - query
+    has_left, has_right = left_gap >= 0, right_gap > 0
+
+    if method == 'nearest':
+        use_right = has_right & (~has_left | (right_gap < left_gap))
+        index = np.where(use_right, right, left)
+        gap = np.where(use_right, right_gap, left_gap)
+        valid = gap <= tolerance
+        output[valid] = values[index[valid]]
+        return output
+
+    exact = left_gap == 0
+    valid = exact | (has_left & has_right & (left_gap <= tolerance)
+                     & (right_gap <= tolerance))
+    span = np.where(exact, 1, times[right] - times[left])
+    weight = np.where(exact, 0, left_gap / span)[valid, None]
+    left, right = left[valid], right[valid]
+
+    circular = np.zeros(values.shape[1], dtype=bool) if circular is None \
+        else np.asarray(circular, dtype=bool)
+    linear = values[left] + weight * (values[right] - values[left])
+
+    if circular.any():
+        angles = values[:, circular]
+        if not radians:
+            angles = np.deg2rad(angles)
+        sines, cosines = np.sin(angles), np.cos(angles)
+        theta = np.arctan2(
+            sines[left] + weight * (sines[right] - sines[left]),
+            cosines[left] + weight * (cosines[right] - cosines[left])
+        ) % (2 * np.pi)
+        linear[:, circular] = theta if radians else np.rad2deg(theta)
+
+    output[valid] = linear
+    return output
+
+
+def catalog_times(catalog):
+    """ image epochs of a catalog, from an epoch column (seconds) or the
+    datetime index as returned by get_images """
+
+    if 'epoch' in catalog.columns:
+        return catalog['epoch'].to_numpy(dtype=np.int64) * 10 ** 9
+    return epoch_ns(catalog.index)
+
+
+def align(catalog, *series, method='nearest', tolerance='10min',
+          directions=None, radians=False):
+    """ the catalog (e.g. of get_images) with the columns of every time
+    series (DataFrame or named Series with a datetime index, such as the
+    output of get_meteo or a tide series) aligned to its image epochs.
+    Every series is joined in one vectorized pass, see align_values.
+    Direction columns (by default the WindDir columns of meteo data) are
+    interpolated as angles. The result can be filtered, e.g. with within,
+    before any image is downloaded """
+
+    query = catalog_times(catalog)
+    frames = []
+    for item in series:
+        frame = item.to_frame() if isinstance(item, pd.Series) else item
+        columns = list(frame.columns)
+
+        circular = direction_columns(columns) if directions is None \
+            else [column for column in directions if column in columns]
+        values = align_values(
+            epoch_ns(frame.index), frame.to_numpy(dtype=float), query,
+            method=method, tolerance=tolerance,
+            circular=[column in circular for column in columns],
+            radians=radians
+        )
+        frames.append(pd.DataFrame(values, index=catalog.index,
+                                   columns=columns))
+
+    if not frames:
+        return catalog.copy()
+    aligned = pd.concat(frames, axis=1)
+
+    duplicates = set(aligned.columns) & set(catalog.columns)
+    if duplicates or aligned.columns.duplicated().any():
+        raise ValueError(
+            f'Duplicate columns {sorted(map(str, duplicates))}'
+            if duplicates else 'Time series have duplicate columns'
+        )
+
+    # the (camera, type) columns of a multi camera catalog get a padded
+    # level, so aligned['WindSpeed_Avg'] still selects a plain column
+    if isinstance(catalog.columns, pd.MultiIndex):
+        padding = ('',) * (catalog.columns.nlevels - 1)
+        aligned.columns = pd.MultiIndex.from_tuples(
+            [(column,) + padding for column in aligned.columns]
+        )
+    return pd.concat((catalog, aligned), axis=1)
+
+
+def within(catalog, **limits):
+    """ rows of an aligned catalog with every given column within its
+    (minimum, maximum) limits, None for an open end. Rows with a missing
+    value are dropped """
+
+    keep = np.ones(len(catalog), dtype=bool)
+    for column, (minimum, maximum) in limits.items():
+        values = np.asarray(catalog[column], dtype=float).reshape(-1)
+        keep &= ~np.isnan(values)
+        if minimum is not None:
+            keep &= values >= minimum
+        if maximum is not None:
+            keep &= values <= maximum
+    return catalog[keep]
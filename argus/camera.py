@@ -2,6 +2,8 @@
 import cv2
 import numpy as np
 
+from .instrumentation import add_items, timed
+
 
 class Camera(object):
 
@@ -45,6 +47,7 @@ class Camera(object):
             return True
         return False
 
+    @timed('camera.undistort_points')
     def undistort_points(self, points):
         undistorted_points = cv2.undistortPoints(
             points.reshape(-1, 1, 2), self.opt_camera_matrix, self.dist_coefs,
@@ -52,37 +55,62 @@ class Camera(object):
         )
         return undistorted_points.reshape(points.shape)
 
+    @timed('camera.undistort_image')
     def undistort_image(self, image):
         return cv2.undistort(
-            image, self.camera_matrix, self.dist_coefs, self.opt_camera_matrix
+            image, self.camera_matrix, self.dist_coefs,
+            newCameraMatrix=self.opt_camera_matrix
         )
 
-    def rectify(self, object_points, image_points, distorted=False):
+    @timed('camera.solve_pnp')
+    def rectify(self, object_points, image_points, distorted=False,
+                use_extrinsic_guess=False):
 
         if distorted:
             image_points = self.undistort_points(image_points)
 
         dist_coefs = np.zeros(4)
 
+        # refine the current pose instead of solving from scratch
+        if use_extrinsic_guess and self.is_rectified:
+            guess = dict(
+                rvec=cv2.Rodrigues(self.rotation_matrix)[0].copy(),
+                tvec=self.translation_vector.astype(float).copy(),
+                useExtrinsicGuess=True
+            )
+        else:
+            guess = {}
+
         rotation_vector, self.translation_vector = cv2.solvePnP(
-            object_points, image_points, self.opt_camera_matrix, dist_coefs
+            object_points, image_points, self.opt_camera_matrix, dist_coefs,
+            **guess
         )[-2:]
 
         self.rotation_matrix = cv2.Rodrigues(rotation_vector)[0]
 
-    def object_to_image_points(self, points):
+    def object_to_camera_points(self, points):
 
         if not self.is_rectified:
             raise ValueError('Camera has to be rectified')
 
-        object_points = points.reshape(-1, 1, 3)
-
-        # object points in local camera coordinate system
-        object_points_camera = (
-            (self.rotation_matrix * object_points).sum(axis=2)
+        return (
+            np.dot(points.reshape(-1, 3), self.rotation_matrix.T)
             + self.translation_vector.reshape(1, -1)
         )
 
+    @timed('camera.project')
+    def object_to_image_points(self, points):
+
+        if not self.is_rectified:
+            raise ValueError('Camera has to be rectified')
+        add_items('camera.project', len(points))
+
+        # object points in local camera coordinate system
+        object_points_camera = self.object_to_camera_points(points)
+        return self.camera_to_image_points(object_points_camera)
+
+    def camera_to_image_points(self, object_points_camera):
+
         # calculate image coordinates
         scaled_object_points = (
             object_points_camera[:, :-1] /
@@ -96,6 +124,27 @@ class Camera(object):
         image_points = self._mask_image_points(image_points)
         return image_points
 
+    @timed('camera.project_distorted')
+    def object_to_distorted_image_points(self, points):
+        """ image points in the original (distorted) frame, so pixels can be
+        sampled without undistorting the whole image """
+
+        if not self.is_rectified:
+            raise ValueError('Camera has to be rectified')
+        add_items('camera.project_distorted', len(points))
+
+        # inverse of undistort_points, through which rectify sees the gcps
+        image_points = cv2.projectPoints(
+            points.reshape(-1, 1, 3).astype(float),
+            cv2.Rodrigues(self.rotation_matrix)[0], self.translation_vector,
+            self.opt_camera_matrix, self.dist_coefs
+        )[0].reshape(-1, 2)
+
+        # projectPoints also maps points behind the camera into the frame
+        behind = self.object_to_camera_points(points)[:, -1] <= 0
+        image_points[behind] = np.nan
+        return self._mask_image_points(image_points)
+
     def _mask_image_points(self, image_points):
 
         mask = (np.isnan(image_points) | (image_points < 0)
@@ -105,7 +154,7 @@ class Camera(object):
 
     def projection_error(self, object_points, image_points):
 
-        pixel_diff = (self.object_to_image_points(self, object_points).data
+        pixel_diff = (self.object_to_image_points(object_points).data
                       - image_points)
 
         return ((pixel_diff**2).sum(axis=1)**0.5).mean()
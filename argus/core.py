@@ -3,15 +3,18 @@ from datetime import datetime
 import json
 import os
 from re import sub as re_sub
-import requests
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-
-from .models import Base
+from .instrumentation import add_bytes, timer
+from .lazy import lazy_import
 from . import utils
 
 
+# loaded at first use to keep imports fast
+requests = lazy_import('requests')
+sqlalchemy = lazy_import('sqlalchemy')
+orm = lazy_import('sqlalchemy.orm')
+
+
 API = 'http://argus-public.deltares.nl/db/table'
 
 AVAILABLE_TABLES = (
@@ -57,7 +60,10 @@ def get_table(table_name):
 
     if table_name not in AVAILABLE_TABLES:
         raise ValueError("Table does not exist")
-    return requests.get(('/').join((API, table_name))).json()
+    with timer('core.api'):
+        response = requests.get(('/').join((API, table_name)))
+    add_bytes('core.api', len(response.content))
+    return response.json()
 
 
 def extract_table(table_name):
@@ -115,6 +121,7 @@ def get_cleaned_table(table_name):
         print('Can not clean this table')
         return table
 
+    from .models import Base
     columns = get_table_model(Base, table_name).__table__.columns.keys()
 
     key_mapping = utils.FIELD_MAPPING[table_name]
@@ -160,14 +167,39 @@ def obj_to_dict(obj):
     return output
 
 
+def instrument_engine(engine):
+    """ time the statements executed by an engine as the core.sql stage """
+
+    @sqlalchemy.event.listens_for(engine, 'before_cursor_execute')
+    def start_timer(connection, *args):
+        sql_timer = timer('core.sql')
+        connection.info.setdefault('sql_timers', []).append(sql_timer)
+        sql_timer.__enter__()
+
+    @sqlalchemy.event.listens_for(engine, 'after_cursor_execute')
+    def stop_timer(connection, *args):
+        connection.info['sql_timers'].pop().__exit__(None, None, None)
+
+    @sqlalchemy.event.listens_for(engine, 'handle_error')
+    def drop_timer(context):
+        timers = context.connection.info.get('sql_timers')
+        if timers:
+            timers.pop()
+    return engine
+
+
 def create_session():
-    engine = create_engine(DATABASE_URL, echo=False)
-    Session = sessionmaker(bind=engine)
+    engine = instrument_engine(
+        sqlalchemy.create_engine(DATABASE_URL, echo=False)
+    )
+    Session = orm.sessionmaker(bind=engine)
     return Session()
 
 
 def create_db(remove_existing=False):
 
+    from .models import Base
+
     # check that the tables needed for db are avilable locally
     local_tables = {table.lower() for table in list_local_tables().keys()}
     if not all(table in local_tables for table in LOCAL_TABLES):
@@ -191,10 +223,12 @@ def create_db(remove_existing=False):
         model = get_table_model(Base, table_name)
         all_entries += [model(**item) for item in table]
 
-    engine = create_engine(DATABASE_URL, echo=False)
+    engine = instrument_engine(
+        sqlalchemy.create_engine(DATABASE_URL, echo=False)
+    )
     Base.metadata.create_all(engine)
 
-    Session = sessionmaker(bind=engine)
+    Session = orm.sessionmaker(bind=engine)
     session = Session()
 
     try:
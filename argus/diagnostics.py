@@ -0,0 +1,235 @@
+
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+from .camera import Camera as ArgusCamera
+from .core import create_session
+from .lazy import lazy_import
+
+
+# loaded at first use to keep imports fast, the models load SQLAlchemy so
+# they are imported where they are needed
+pd = lazy_import('pandas')
+
+
+def load_used_gcps(session, geometry_ids=None):
+    """ image and object points of the used gcps of all (or the given)
+    geometries in one query """
+
+    from .models import Geometry, Gcp, UsedGcp
+    query = session.query(
+        UsedGcp.pk, UsedGcp.geometry_id, Geometry.camera_id,
+        UsedGcp.image_coord_horizontal, UsedGcp.image_coord_vertical,
+        Gcp.coord_x, Gcp.coord_y, Gcp.coord_z
+    ).join(Gcp, UsedGcp.gcp_id == Gcp.id)\
+        .join(Geometry, UsedGcp.geometry_id == Geometry.id)
+
+    if geometry_ids is not None:
+        query = query.filter(UsedGcp.geometry_id.in_(list(geometry_ids)))
+
+    columns = ['used_gcp_pk', 'geometry_id', 'camera_id', 'u', 'v',
+               'x', 'y', 'z']
+    return pd.DataFrame(query.all(), columns=columns)
+
+
+def load_cameras(session):
+    """ argus cameras (intrinsics only) keyed by camera id """
+
+    from .models import Camera
+    cameras = {}
+    for camera in session.query(Camera).all():
+        if camera.intrinsic_parameters is None:
+            continue
+        try:
+            cameras[camera.id] = ArgusCamera(
+                camera.camera_matrix.astype(float),
+                camera.dist_coefs_for_cv2.astype(float),
+                camera.intrinsic_parameters.frame_size
+            )
+        except (TypeError, cv2.error):
+            # cameras with missing intrinsics
+            continue
+    return cameras
+
+
+def geometry_pose(camera, object_points, image_points, ransac_error=8.0,
+                  min_points=4):
+    """ pose of a camera solved on the RANSAC inliers of the (undistorted)
+    gcps and which gcps are inliers, so errors computed with the pose match
+    the inlier flags. Without a usable RANSAC result the pose is solved on
+    all gcps and all are inliers. The pose is None if it cannot be solved """
+
+    count = len(object_points)
+    inliers = np.zeros(count, dtype=bool)
+    if count < min_points:
+        return None, None, inliers
+
+    if count > min_points:
+        try:
+            success, _, _, inlier_index = cv2.solvePnPRansac(
+                object_points, image_points, camera.opt_camera_matrix,
+                np.zeros(4), reprojectionError=ransac_error
+            )
+        except cv2.error:
+            success = False
+        if success and inlier_index is not None:
+            inliers[inlier_index.ravel()] = True
+    if inliers.sum() < min_points:
+        inliers[:] = True
+
+    try:
+        camera.rectify(object_points[inliers], image_points[inliers])
+    except cv2.error:
+        return None, None, np.zeros(count, dtype=bool)
+    return camera.rotation_matrix, camera.translation_vector, inliers
+
+
+def batch_reprojection_errors(rotation_matrices, translation_vectors,
+                              focal_lengths, principal_points, object_points,
+                              image_points):
+    """ reprojection errors of many gcps, each with its own pose and
+    (optimal) intrinsics, in a single vectorized pass. All arguments have the
+    number of gcps as first dimension """
+
+    points_camera = np.einsum(
+        'nij,nj->ni', rotation_matrices, object_points
+    ) + translation_vectors
+    with np.errstate(invalid='ignore', divide='ignore'):
+        projected = (focal_lengths * points_camera[:, :2]
+                     / points_camera[:, 2:] + principal_points)
+    errors = np.hypot(*(projected - image_points).T)
+    return np.where(points_camera[:, 2] > 0, errors, np.nan)
+
+
+def compute_diagnostics(session=None, geometry_ids=None, ransac_error=8.0):
+    """ per gcp and per geometry reprojection errors of all geometries.
+    Returns a per gcp and a per geometry DataFrame """
+
+    close_session = session is None
+    session = session if session else create_session()
+    try:
+        used_gcps = load_used_gcps(session, geometry_ids)
+        cameras = load_cameras(session)
+    finally:
+        if close_session:
+            session.close()
+
+    used_gcps = used_gcps.sort_values(['geometry_id', 'used_gcp_pk'])\
+        .reset_index(drop=True)
+    count = len(used_gcps)
+    if not count:
+        return _diagnostics(used_gcps, np.zeros(0), np.zeros(0, dtype=bool))
+    object_points = used_gcps[['x', 'y', 'z']].to_numpy(dtype=float)
+    image_points = used_gcps[['u', 'v']].to_numpy(dtype=float, copy=True)
+    geometry_ids = used_gcps['geometry_id'].to_numpy()
+    camera_ids = used_gcps['camera_id'].to_numpy()
+
+    rotation_matrices = np.full((count, 3, 3), np.nan)
+    translation_vectors = np.full((count, 3), np.nan)
+    focal_lengths = np.full((count, 2), np.nan)
+    principal_points = np.full((count, 2), np.nan)
+    inliers = np.zeros(count, dtype=bool)
+
+    # the used gcps are sorted by geometry, so each geometry is a slice. Only
+    # the pose is solved per geometry, the errors are computed in one go
+    starts = np.flatnonzero(np.r_[True, geometry_ids[1:] != geometry_ids[:-1]])
+    stops = np.r_[starts[1:], count]
+    for start, stop in zip(starts, stops):
+        camera = cameras.get(camera_ids[start])
+        if camera is None:
+            continue
+        image_points[start:stop] = camera.undistort_points(
+            image_points[start:stop]
+        )
+        rotation_matrix, translation_vector, inliers[start:stop] = \
+            geometry_pose(camera, object_points[start:stop],
+                          image_points[start:stop], ransac_error=ransac_error)
+        if rotation_matrix is None:
+            continue
+        rotation_matrices[start:stop] = rotation_matrix
+        translation_vectors[start:stop] = translation_vector.ravel()
+        focal_lengths[start:stop] = camera.focal_lengths
+        principal_points[start:stop] = camera.principal_point
+
+    errors = batch_reprojection_errors(
+        rotation_matrices, translation_vectors, focal_lengths,
+        principal_points, object_points, image_points
+    )
+
+    return _diagnostics(used_gcps, errors, inliers)
+
+
+def _diagnostics(used_gcps, errors, inliers):
+    """ the per gcp and per geometry frames of compute_diagnostics """
+
+    used_gcps = used_gcps.assign(error=errors, is_inlier=inliers)
+    grouped = used_gcps.assign(
+        squared_error=errors ** 2,
+        inlier_error=np.where(inliers, errors, np.nan)
+    ).groupby('geometry_id')
+    geometries = pd.DataFrame({
+        'gcp_count': grouped['used_gcp_pk'].count(),
+        'inlier_count': grouped['is_inlier'].sum().astype(int),
+        'mean_error': grouped['error'].mean(),
+        'rms_error': grouped['squared_error'].mean() ** 0.5,
+        'max_error': grouped['error'].max(),
+        'inlier_mean_error': grouped['inlier_error'].mean(),
+    })
+    return used_gcps, geometries
+
+
+def store_diagnostics(used_gcps, geometries, session=None):
+    """ persist the output of compute_diagnostics, replacing earlier results
+    of the same geometries """
+
+    from .models import GeometryQuality, UsedGcpError
+    close_session = session is None
+    session = session if session else create_session()
+
+    engine = session.get_bind()
+    for model in (GeometryQuality, UsedGcpError):
+        model.__table__.create(engine, checkfirst=True)
+
+    time_computed = datetime.utcnow()
+    geometry_ids = [int(item) for item in geometries.index]
+    try:
+        for model in (GeometryQuality, UsedGcpError):
+            session.query(model)\
+                .filter(model.geometry_id.in_(geometry_ids))\
+                .delete(synchronize_session=False)
+
+        session.bulk_insert_mappings(GeometryQuality, [
+            dict(geometry_id=int(geometry_id), time_computed=time_computed,
+                 **{key: _to_python(value) for key, value in row.items()})
+            for geometry_id, row in geometries.iterrows()
+        ])
+        session.bulk_insert_mappings(UsedGcpError, [
+            dict(used_gcp_pk=int(row.used_gcp_pk),
+                 geometry_id=int(row.geometry_id),
+                 error=_to_python(row.error), is_inlier=bool(row.is_inlier))
+            for row in used_gcps.itertuples()
+        ])
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        if close_session:
+            session.close()
+
+
+def update_diagnostics(session=None, geometry_ids=None, ransac_error=8.0):
+    used_gcps, geometries = compute_diagnostics(
+        session, geometry_ids, ransac_error=ransac_error
+    )
+    store_diagnostics(used_gcps, geometries, session)
+    return geometries
+
+
+def _to_python(value):
+    if isinstance(value, (np.integer, np.bool_)):
+        return value.item()
+    value = float(value)
+    return None if np.isnan(value) else value
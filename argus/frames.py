@@ -0,0 +1,220 @@
+
+from collections import namedtuple
+from multiprocessing import shared_memory
+import os
+import threading
+
+import cv2
+import numpy as np
+
+from .images import bgr_to_rgb, decode_image, download_image
+
+
+# shared memory blocks this process has attached to, keyed by name
+_ATTACHED = {}
+
+
+class FrameHandle(namedtuple('FrameHandle', (
+        'name', 'slot', 'offset', 'shape', 'dtype', 'timestamp'))):
+    """ small picklable reference to a frame in the shared memory of a
+    FrameBroker, passed to workers instead of the frame itself """
+
+    __slots__ = ()
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+
+    def array(self):
+        """ the frame as a numpy array backed by the shared memory, without
+        copying. Valid until the slot is released """
+
+        memory = _ATTACHED.get(self.name)
+        if memory is None:
+            memory = _ATTACHED[self.name] = _attach(self.name)
+        return np.ndarray(
+            self.shape, dtype=self.dtype, buffer=memory.buf,
+            offset=self.offset
+        )
+
+
+class FrameBroker(object):
+    """ ring of equally sized slots in one shared memory block. Frames are
+    decoded (or copied) into a free slot and handed to other processes as
+    FrameHandles. Every slot has a reference count, set when it is filled
+    and decremented with release, after which it is reused. When all slots
+    are taken filling a slot blocks, which throttles the producer to the
+    pace of the workers """
+
+    def __init__(self, slot_size, slots=8):
+
+        self.slot_size = int(slot_size)
+        self.slots = int(slots)
+        self._memory = shared_memory.SharedMemory(
+            create=True, size=self.slot_size * self.slots
+        )
+        _ATTACHED[self._memory.name] = self._memory
+
+        self._condition = threading.Condition()
+        self._references = [0] * self.slots
+        self._free = list(range(self.slots))[::-1]
+        self._closed = False
+
+    @classmethod
+    def for_frames(cls, frame_size, channels=3, dtype=np.uint8, slots=8):
+        """ broker with slots for frames of a camera """
+        width, height = frame_size
+        return cls(width * height * channels * np.dtype(dtype).itemsize,
+                   slots=slots)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def name(self):
+        return self._memory.name
+
+    @property
+    def free_slots(self):
+        with self._condition:
+            return len(self._free)
+
+    def reserve(self, shape, dtype=np.uint8, timestamp=None, references=1,
+                timeout=None):
+        """ take a free slot (waiting at most timeout seconds for one) for a
+        frame of the given shape, returns the handle and a writable array """
+
+        dtype = np.dtype(dtype)
+        shape = tuple(int(size) for size in shape)
+        if int(np.prod(shape)) * dtype.itemsize > self.slot_size:
+            raise ValueError(f'Frame of shape {shape} does not fit a slot')
+
+        with self._condition:
+            if not self._condition.wait_for(
+                    lambda: self._free or self._closed, timeout=timeout):
+                raise TimeoutError('No free slot')
+            if self._closed:
+                raise ValueError('Broker is closed')
+            slot = self._free.pop()
+            self._references[slot] = references
+
+        handle = FrameHandle(self.name, slot, slot * self.slot_size, shape,
+                             dtype.str, timestamp)
+        return handle, handle.array()
+
+    def put(self, image, timestamp=None, references=1, timeout=None):
+        """ copy an array into a slot """
+
+        image = np.asarray(image)
+        handle, array = self.reserve(image.shape, image.dtype, timestamp,
+                                     references, timeout)
+        np.copyto(array, image)
+        return handle
+
+    def load(self, source, timestamp=None, to_float=False, references=1,
+             timeout=None):
+        """ decode an image (url or local file) straight into a slot, as RGB
+        uint8 or float32 like load_image """
+
+        if os.path.exists(source):
+            image = cv2.imread(source, cv2.IMREAD_COLOR)
+            if image is None:
+                raise ValueError(f'Could not read {source}')
+        else:
+            image = decode_image(download_image(source))
+
+        dtype = np.float32 if to_float else np.uint8
+        handle, array = self.reserve(image.shape, dtype, timestamp,
+                                     references, timeout)
+        try:
+            bgr_to_rgb(image, to_float=to_float, out=array)
+        except Exception:
+            self.release(handle, references)
+            raise
+        return handle
+
+    def retain(self, handle, references=1):
+        """ add references to a filled slot, e.g. for an extra consumer """
+
+        with self._condition:
+            if self._references[handle.slot] <= 0:
+                raise ValueError(f'Slot {handle.slot} is not in use')
+            self._references[handle.slot] += references
+
+    def release(self, handle, references=1):
+        """ drop references to a slot, the slot is reused at zero """
+
+        with self._condition:
+            if self._references[handle.slot] <= 0:
+                raise ValueError(f'Slot {handle.slot} is not in use')
+            self._references[handle.slot] -= references
+            if self._references[handle.slot] <= 0:
+                self._references[handle.slot] = 0
+                self._free.append(handle.slot)
+                self._condition.notify()
+
+    def map(self, executor, function, frames, to_float=False, timeout=None):
+        """ apply function(handle) on an executor to an iterable of
+        (timestamp, url, path or array) pairs. Slots are released when a
+        result is in, results are yielded in order """
+
+        pending = []
+        for timestamp, frame in frames:
+            if isinstance(frame, str):
+                handle = self.load(frame, timestamp, to_float=to_float,
+                                   timeout=timeout)
+            else:
+                handle = self.put(frame, timestamp, timeout=timeout)
+
+            future = executor.submit(function, handle)
+            future.add_done_callback(
+                lambda _, handle=handle: self.release(handle)
+            )
+            pending.append(future)
+
+            # yield finished results without waiting on the rest
+            while pending and pending[0].done():
+                yield pending.pop(0).result()
+
+        for future in pending:
+            yield future.result()
+
+    def close(self):
+        """ free the shared memory, handles must no longer be used """
+
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify_all()
+        _ATTACHED.pop(self._memory.name, None)
+        self._memory.unlink()
+        _close(self._memory)
+
+
+def _attach(name):
+
+    # attaching processes should not unlink the block when they exit
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+def detach_all():
+    """ close the shared memory blocks attached by this (worker) process """
+
+    for memory in _ATTACHED.values():
+        _close(memory)
+    _ATTACHED.clear()
+
+
+def _close(memory):
+    try:
+        memory.close()
+    except BufferError:
+        # arrays still refer to the block, it is unmapped once they are gone
+        pass
@@ -0,0 +1,433 @@
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+import cv2
+import numpy as np
+
+from .images import decode_image, download_image, image_url
+from .instrumentation import timer
+from .mosaic import PlanView
+
+
+CHANNELS = {'red': 0, 'green': 1, 'blue': 2}
+
+STATISTICS = ('mean', 'std', 'min', 'max', 'count')
+
+# ops that resample the frame and are fused into a single remap
+GEOMETRY_OPS = ('undistort', 'rectify', 'crop')
+
+
+class FrameGraph(object):
+    """ lazy processing graph of image series. Operations are declared by
+    chaining (load, channels, undistort, rectify, crop, to_float, map) and
+    only run when frames or statistics are requested. Every source (e.g.
+    camera) is an independent branch.
+
+    Per branch the operations are compiled into few fused stages: channels
+    are selected right after decoding, undistort, crop and rectify become
+    one remap with precomputed maps (a plan view is sampled from the
+    original frame directly), conversion to float happens after the remap.
+    Every stage writes into its own buffer, reused for all frames, so
+    memory does not depend on the length of the series. Branches run in
+    parallel threads, frames are processed chunk_size at a time.
+
+    Sources yield (timestamp, frame) pairs, a frame is a url, a file path
+    or an array. Arrays are taken as BGR (as decoded by OpenCV) unless
+    color is 'rgb' """
+
+    def __init__(self, sources, cameras=None, ops=(), color='bgr'):
+
+        if color not in ('bgr', 'rgb'):
+            raise ValueError("color must be 'bgr' or 'rgb'")
+        self.sources = sources
+        self.cameras = cameras if cameras else {}
+        self.ops = tuple(ops)
+        self.color = color
+
+    @classmethod
+    def from_catalog(cls, catalog, cameras, image_type='snap'):
+        """ graph with a branch per camera of a get_images catalog """
+
+        sources = {}
+        for camera in cameras:
+            if getattr(catalog.columns, 'nlevels', 1) > 1:
+                paths = catalog[(camera, image_type)]
+            elif len(cameras) == 1:
+                paths = catalog[image_type]
+            else:
+                raise ValueError('Catalog has images of a single camera')
+            sources[camera] = [
+                (timestamp, image_url(path))
+                for timestamp, path in paths.dropna().items()
+            ]
+        return cls(sources, cameras)
+
+    def _then(self, *op):
+        return FrameGraph(self.sources, self.cameras, self.ops + (op,),
+                          self.color)
+
+    def load(self, to_float=False):
+        """ decode frames as RGB (float32 in [0, 1] if to_float) """
+        return self.to_float() if to_float else self
+
+    def channels(self, *channels):
+        """ keep only the given channels (names or RGB indices) """
+        indices = tuple(CHANNELS.get(channel, channel) for channel in channels)
+        return self._then('channels', indices)
+
+    def undistort(self):
+        return self._then('undistort')
+
+    def rectify(self, x, y, z=0):
+        """ plan view on the grid spanned by x and y, see PlanView """
+        return self._then('rectify', (x, y, z))
+
+    def crop(self, columns, rows):
+        """ keep a window, given as (start, stop) column and row ranges """
+        return self._then('crop', (slice(*columns), slice(*rows)))
+
+    def to_float(self):
+        return self._then('to_float')
+
+    def map(self, function):
+        """ apply function(array) to every frame. Operations after a map
+        are not reordered across it """
+        return self._then('map', function)
+
+    def compile(self, branch):
+        """ the fused stages of a branch """
+        return _compile(self.ops, self.cameras.get(branch), self.color)
+
+    def frames(self, chunk_size=16, workers=None):
+        """ yield (timestamp, branch, array) for all frames, chunk_size
+        frames per branch at a time, ordered by timestamp within a chunk """
+
+        pipelines = {branch: self.compile(branch) for branch in self.sources}
+        iterators = {branch: iter(frames)
+                     for branch, frames in self.sources.items()}
+
+        def process(branch):
+            output, count = [], 0
+            for timestamp, frame in _take(iterators[branch], chunk_size):
+                count += 1
+                array = _run(pipelines[branch], frame)
+                if array is not None:
+                    output.append((timestamp, branch, array.copy()))
+            return branch, output, count < chunk_size
+
+        with ThreadPoolExecutor(
+                max_workers=workers if workers else max(1, len(self.sources))
+        ) as executor:
+            while iterators:
+                results = []
+                for branch, output, exhausted in executor.map(
+                        process, list(iterators)):
+                    results.extend(output)
+                    if exhausted:
+                        iterators.pop(branch)
+                results.sort(key=lambda item: item[0])
+                yield from results
+
+    def reduce(self, statistics=STATISTICS, workers=None):
+        """ per pixel statistics of every branch, computed on the fly
+        without keeping frames. Returns {branch: {statistic: array}}, nan
+        cells and cells outside a plan view (also of integer frames) are
+        ignored """
+
+        unknown = set(statistics) - set(STATISTICS)
+        if unknown:
+            raise ValueError(f'Unknown statistics {sorted(unknown)}')
+
+        def process(branch):
+            pipeline = self.compile(branch)
+            accumulator = _Accumulator(statistics, _valid(pipeline))
+            for _, frame in self.sources[branch]:
+                array = _run(pipeline, frame)
+                if array is not None:
+                    accumulator.add(array)
+            return branch, accumulator.result()
+
+        with ThreadPoolExecutor(
+                max_workers=workers if workers else max(1, len(self.sources))
+        ) as executor:
+            return dict(executor.map(process, list(self.sources)))
+
+
+def _take(iterator, count):
+    for _, item in zip(range(count), iterator):
+        yield item
+
+
+def _run(pipeline, frame):
+    """ a frame through the stages, None if it could not be loaded """
+
+    try:
+        array = pipeline[0](frame)
+    except (OSError, ValueError):
+        return None
+    for stage in pipeline[1:]:
+        array = stage(array)
+    return array
+
+
+def _valid(pipeline):
+    """ cells covered by the last plan view of a pipeline, if any """
+    return next((stage.valid for stage in pipeline[::-1]
+                 if getattr(stage, 'valid', None) is not None), None)
+
+
+def _compile(ops, camera, color='bgr'):
+
+    # the leading ops up to the first map can be reordered
+    barrier = next(
+        (index for index, op in enumerate(ops) if op[0] == 'map'), len(ops)
+    )
+    head, tail = ops[:barrier], ops[barrier:]
+
+    channels = None
+    for op in head:
+        if op[0] == 'channels':
+            channels = op[1] if channels is None \
+                else tuple(channels[index] for index in op[1])
+    pipeline = [_Decode(channels, rgb_arrays=color == 'rgb')]
+
+    geometry = [op for op in head if op[0] in GEOMETRY_OPS]
+    if geometry:
+        pipeline.append(_resample(geometry, camera))
+    if any(op[0] == 'to_float' for op in head):
+        pipeline.append(_ToFloat(getattr(pipeline[-1], 'valid', None)))
+
+    for op in tail:
+        if op[0] == 'map':
+            pipeline.append(op[1])
+        elif op[0] in GEOMETRY_OPS:
+            pipeline.append(_resample([op], camera))
+        elif op[0] == 'to_float':
+            pipeline.append(_ToFloat())
+        elif op[0] == 'channels':
+            pipeline.append(lambda array, indices=op[1]: array[..., indices])
+    return pipeline
+
+
+def _resample(geometry, camera):
+    """ one stage for a sequence of undistort, rectify and crop ops: a
+    remap if the frame is resampled, else a view of the crop """
+
+    maps, valid, windows = None, None, []
+    for name, *arguments in geometry:
+        if name in ('undistort', 'rectify') and camera is None:
+            raise ValueError(f'{name} needs a camera')
+
+        if name == 'undistort':
+            if maps is not None or windows:
+                raise ValueError('undistort must come before crop and rectify')
+            maps = cv2.initUndistortRectifyMap(
+                camera.camera_matrix, camera.dist_coefs, None,
+                camera.opt_camera_matrix, tuple(camera.frame_size),
+                cv2.CV_32FC1
+            )
+        elif name == 'rectify':
+            if windows:
+                raise ValueError('rectify can not follow crop')
+            # plan views are sampled from the original (distorted) frame,
+            # so a preceding undistort is dropped
+            plan_view = PlanView(camera, *arguments[0])
+            maps, valid = (plan_view.map_x, plan_view.map_y), plan_view.valid
+        else:
+            columns, rows = arguments[0]
+            if maps is None:
+                windows.append((rows, columns))
+            else:
+                maps = tuple(item[rows, columns] for item in maps)
+                valid = None if valid is None else valid[rows, columns]
+
+    if maps is None:
+        return _Crop(windows)
+    return _Remap(*maps, valid=valid)
+
+
+class _Decode(object):
+    """ url, file path or (BGR, or RGB if rgb_arrays) array to an RGB (or
+    channel subset) array """
+
+    def __init__(self, channels=None, rgb_arrays=False):
+        # RGB indices to BGR indices
+        self.channels = channels
+        self.indices = None if channels is None \
+            else [2 - channel for channel in channels]
+        self.rgb_arrays = rgb_arrays
+        self.buffer = None
+
+    def __call__(self, frame):
+
+        if isinstance(frame, str):
+            if os.path.exists(frame):
+                with timer('images.decode'):
+                    image = cv2.imread(frame, cv2.IMREAD_COLOR)
+                if image is None:
+                    raise ValueError(f'Could not read {frame}')
+            else:
+                image = decode_image(download_image(frame))
+        elif self.rgb_arrays:
+            image = np.asarray(frame)
+            return image if self.channels is None \
+                else self._select(image, self.channels)
+        else:
+            image = np.asarray(frame)
+
+        if self.indices is None:
+            if self.buffer is None or self.buffer.shape != image.shape:
+                self.buffer = np.empty_like(image)
+            return cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=self.buffer)
+
+        return self._select(image, self.indices)
+
+    def _select(self, image, indices):
+
+        shape = image.shape[:2] + ((len(indices),) if len(indices) > 1 else ())
+        if self.buffer is None or self.buffer.shape != shape \
+                or self.buffer.dtype != image.dtype:
+            self.buffer = np.empty(shape, dtype=image.dtype)
+        if len(indices) == 1:
+            np.copyto(self.buffer, image[..., indices[0]])
+        else:
+            np.take(image, indices, axis=2, out=self.buffer)
+        return self.buffer
+
+
+class _Remap(object):
+
+    def __init__(self, map_x, map_y, valid=None):
+        # fixed point maps make remap about twice as fast
+        self.maps = cv2.convertMaps(
+            np.ascontiguousarray(map_x, dtype=np.float32),
+            np.ascontiguousarray(map_y, dtype=np.float32), cv2.CV_16SC2
+        )
+        self.shape = map_x.shape
+        self.valid = valid
+        self.buffer = None
+
+    def __call__(self, array):
+
+        shape = self.shape + array.shape[2:]
+        if self.buffer is None or self.buffer.shape != shape \
+                or self.buffer.dtype != array.dtype:
+            self.buffer = np.empty(shape, dtype=array.dtype)
+        return cv2.remap(
+            array, *self.maps, cv2.INTER_LINEAR, dst=self.buffer,
+            borderMode=cv2.BORDER_CONSTANT, borderValue=0
+        )
+
+
+class _Crop(object):
+
+    def __init__(self, windows):
+        self.windows = windows
+
+    def __call__(self, array):
+        for window in self.windows:
+            array = array[window]
+        return array
+
+
+class _ToFloat(object):
+    """ float32 in [0, 1], nan outside the valid cells of a plan view. Both
+    are done in one multiplication with a per cell scale (nan outside) """
+
+    def __init__(self, valid=None):
+        self.scale = np.float32(1 / 255) if valid is None else np.where(
+            valid, np.float32(1 / 255), np.float32(np.nan)
+        ).astype(np.float32)
+        self.buffer = None
+
+    def __call__(self, array):
+
+        if self.buffer is None or self.buffer.shape != array.shape:
+            self.buffer = np.empty(array.shape, dtype=np.float32)
+        scale = self.scale
+        if np.ndim(scale) and array.ndim == 3:
+            scale = scale[..., None]
+        return np.multiply(array, scale, out=self.buffer, casting='unsafe')
+
+
+class _Accumulator(object):
+    """ running per pixel sums (and squares, minimum, maximum) of the
+    requested statistics, ignoring nan and cells outside valid (e.g. of a
+    plan view, for frames without nan). Updates are done in place. While
+    every frame has the same nan cells the count is a single number """
+
+    def __init__(self, statistics=STATISTICS, valid=None):
+        self.statistics = statistics
+        self.mask = valid
+        self.frames = 0
+        self.count = None
+
+    def add(self, array):
+
+        if not self.frames:
+            self.sum = np.zeros(array.shape)
+            if array.dtype.kind == 'f':
+                self.valid = ~np.isnan(array)
+            elif self.mask is not None \
+                    and array.shape[:self.mask.ndim] == self.mask.shape:
+                self.valid = np.broadcast_to(
+                    self.mask.reshape(self.mask.shape + (1,) * (
+                        array.ndim - self.mask.ndim
+                    )), array.shape
+                )
+            else:
+                self.valid = np.ones(array.shape, dtype=bool)
+            self._valid = np.empty(array.shape, dtype=bool)
+            if 'std' in self.statistics:
+                self.squares = np.zeros(array.shape)
+                self._squared = np.empty(array.shape, dtype=np.float32)
+            if 'min' in self.statistics:
+                self.minimum = np.full(array.shape, np.nan)
+            if 'max' in self.statistics:
+                self.maximum = np.full(array.shape, np.nan)
+
+        valid = self.valid
+        if array.dtype.kind == 'f':
+            valid = np.isnan(array, out=self._valid)
+            np.logical_not(valid, out=valid)
+            if self.count is None and not np.array_equal(valid, self.valid):
+                self.count = self.frames * self.valid.astype(np.int64)
+        if self.count is not None:
+            self.count += valid
+        self.frames += 1
+
+        np.add(self.sum, array, out=self.sum, where=valid)
+        if 'std' in self.statistics:
+            np.multiply(array, array, out=self._squared, casting='unsafe')
+            np.add(self.squares, self._squared, out=self.squares,
+                   where=valid)
+        if 'min' in self.statistics:
+            np.fmin(self.minimum, array, out=self.minimum, where=valid)
+        if 'max' in self.statistics:
+            np.fmax(self.maximum, array, out=self.maximum, where=valid)
+
+    def result(self):
+
+        if not self.frames:
+            return {}
+        count = self.count if self.count is not None \
+            else np.where(self.valid, self.frames, 0)
+
+        output = {}
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = self.sum / count
+            for statistic in self.statistics:
+                if statistic == 'mean':
+                    output['mean'] = mean
+                elif statistic == 'std':
+                    output['std'] = np.sqrt(np.maximum(
+                        self.squares / count - mean ** 2, 0
+                    ))
+                elif statistic == 'min':
+                    output['min'] = self.minimum
+                elif statistic == 'max':
+                    output['max'] = self.maximum
+                else:
+                    output['count'] = count
+        return output
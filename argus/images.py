@@ -10,15 +10,20 @@ from calendar import timegm
 from datetime import datetime
 import itertools
 import os
-import urllib
-import requests
+import urllib.request
 
-import cv2
 import numpy as np
-import pandas as pd
 import pytz
 
 from .core import DATA_DIR
+from .instrumentation import add_bytes, timer
+from .lazy import lazy_import
+
+
+# loaded at first use to keep imports fast, catalog queries need no cv2
+cv2 = lazy_import('cv2')
+pd = lazy_import('pandas')
+requests = lazy_import('requests')
 
 
 IMAGE_CATALOG_URL = "http://argus-public.deltares.nl/catalog"
@@ -29,7 +34,8 @@ IMAGE_BASIC_TYPES = ['snap', 'timex', 'min', 'max', 'var']
 
 IMAGE_SITES = {
     'zandmotor': {
-        'cameras': list(range(1, 13))
+        'cameras': list(range(1, 13)),
+        'station': 'ZMXX00S'
     }
 }
 
@@ -38,6 +44,13 @@ def timestamp_from_datetime(date_time):
     return timegm(date_time.timetuple())
 
 
+def image_url(path):
+    """ full url of an image path as returned by the catalog """
+    if '://' in path:
+        return path
+    return '/'.join((IMAGE_BASE_URL, path.lstrip('/')))
+
+
 def parse_image_types(image_types):
     if isinstance(image_types, str):
         image_types = [image_types]
@@ -110,11 +123,9 @@ def get_images(time_start, time_end, parse=True, **kwargs):
         if options:
             for item in option_list:
                 parameters.update(item)
-                data += requests.get(
-                    IMAGE_CATALOG_URL, parameters
-                ).json()['data']
+                data += _request_catalog(parameters)
         else:
-            data += requests.get(IMAGE_CATALOG_URL, parameters).json()['data']
+            data += _request_catalog(parameters)
 
     # clean the output
     data = [item for item in data if item['type'] in IMAGE_BASIC_TYPES]
@@ -124,6 +135,14 @@ def get_images(time_start, time_end, parse=True, **kwargs):
     return data
 
 
+def _request_catalog(parameters):
+
+    with timer('images.catalog'):
+        response = requests.get(IMAGE_CATALOG_URL, parameters)
+    add_bytes('images.catalog', len(response.content))
+    return response.json()['data']
+
+
 def _image_request_to_pandas(data):
 
     df = pd.DataFrame(data).set_index('epoch')
@@ -137,8 +156,8 @@ def _image_request_to_pandas(data):
     to_multi_index = True if len(cameras) > 1 else False
 
     indices = pd.date_range(
-        start=df.index.min().floor('1H'), end=df.index.max().ceil('1H'),
-        freq='30T', tz=pytz.utc
+        start=df.index.min().floor('1h'), end=df.index.max().ceil('1h'),
+        freq='30min', tz=pytz.utc
     )
 
     # create empty dataframe to fill
@@ -163,20 +182,45 @@ def _image_request_to_pandas(data):
     return df_images
 
 
-def load_image(url, to_float=True):
+def download_image(url):
+    """ encoded image bytes """
 
-    response = urllib.request.urlopen(url)
+    with timer('images.download'):
+        response = urllib.request.urlopen(url)
+        image_bytes = np.asarray(bytearray(response.read()), dtype="uint8")
+    add_bytes('images.download', image_bytes.nbytes)
+    return image_bytes
 
-    image_bytes = np.asarray(bytearray(response.read()), dtype="uint8")
 
-    image = cv2.cvtColor(
-        cv2.imdecode(image_bytes, cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB
-    )
-    if to_float:
-        return np.float32(image.astype(float)/255)
+def decode_image(image_bytes):
+    """ BGR image of encoded image bytes """
+
+    with timer('images.decode'):
+        image = cv2.imdecode(image_bytes, cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError('Could not decode image')
     return image
 
 
+def bgr_to_rgb(image, to_float=True, out=None):
+    """ RGB (float) copy of a BGR image, written into out if given """
+
+    if out is None:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        if to_float:
+            return np.float32(image.astype(float)/255)
+        return image
+
+    if not to_float:
+        return cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=out)
+    np.divide(cv2.cvtColor(image, cv2.COLOR_BGR2RGB), 255.0, out=out)
+    return out
+
+
+def load_image(url, to_float=True):
+    return bgr_to_rgb(decode_image(download_image(url)), to_float=to_float)
+
+
 def get_test_image(camera_id, to_float=True):
 
     if not isinstance(camera_id, str):
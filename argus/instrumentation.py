@@ -0,0 +1,239 @@
+
+import functools
+import json
+import os
+import threading
+from time import perf_counter
+
+from .lazy import lazy_import
+
+
+pd = lazy_import('pandas')
+
+
+# set ARGUS_INSTRUMENTATION to a sample rate (e.g. 1 or 0.1) to enable the
+# instrumentation when the package is imported
+ENVIRONMENT_VARIABLE = 'ARGUS_INSTRUMENTATION'
+
+STAGE_FIELDS = ('calls', 'sampled', 'seconds', 'max_seconds', 'bytes',
+                'items')
+
+
+class _Timer(object):
+
+    __slots__ = ('instrumentation', 'stage', 'start')
+
+    def __init__(self, instrumentation, stage):
+        self.instrumentation = instrumentation
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.instrumentation.record(
+            self.stage, seconds=perf_counter() - self.start
+        )
+
+
+class _Untimed(object):
+    """ counts a call that is not sampled """
+
+    __slots__ = ('instrumentation', 'stage')
+
+    def __init__(self, instrumentation, stage):
+        self.instrumentation = instrumentation
+        self.stage = stage
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.instrumentation.record(self.stage)
+
+
+class _Disabled(object):
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+_DISABLED = _Disabled()
+
+
+class Instrumentation(object):
+    """ opt-in call counts, timers and byte counters per stage (e.g.
+    'images.download'). Disabled it costs one attribute lookup per call.
+    Enabled, every call and every byte is counted but only one in
+    1 / sample_rate calls is timed, total times are estimated from the mean
+    of the timed calls """
+
+    def __init__(self, enabled=False, sample_rate=1.0):
+
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self._lock = threading.Lock()
+        self._stages = {}
+
+    @property
+    def sample_rate(self):
+        return 1 / self._sample_every
+
+    @sample_rate.setter
+    def sample_rate(self, sample_rate):
+        if not 0 < sample_rate <= 1:
+            raise ValueError('sample_rate must be in (0, 1]')
+        self._sample_every = max(1, int(round(1 / sample_rate)))
+
+    def enable(self, sample_rate=None):
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+
+    def timer(self, stage):
+        """ context manager timing (a sample of) the calls to a stage """
+
+        if not self.enabled:
+            return _DISABLED
+        calls = self._stages.get(stage, {}).get('calls', 0)
+        if calls % self._sample_every:
+            return _Untimed(self, stage)
+        return _Timer(self, stage)
+
+    def timed(self, stage):
+        """ decorator timing (a sample of) the calls of a function """
+
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with self.timer(stage):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record(self, stage, seconds=None, n_bytes=0, n_items=0):
+        """ add a call to a stage, seconds is None for calls that were not
+        timed """
+
+        if not self.enabled:
+            return
+        with self._lock:
+            stats = self._stages.get(stage)
+            if stats is None:
+                stats = self._stages[stage] = dict.fromkeys(STAGE_FIELDS, 0)
+            stats['calls'] += 1
+            if seconds is not None:
+                stats['sampled'] += 1
+                stats['seconds'] += seconds
+                stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            stats['bytes'] += n_bytes
+            stats['items'] += n_items
+
+    def add_bytes(self, stage, n_bytes):
+        self._add(stage, 'bytes', n_bytes)
+
+    def add_items(self, stage, n_items):
+        self._add(stage, 'items', n_items)
+
+    def _add(self, stage, field, value):
+        if not self.enabled:
+            return
+        with self._lock:
+            stats = self._stages.get(stage)
+            if stats is None:
+                stats = self._stages[stage] = dict.fromkeys(STAGE_FIELDS, 0)
+            stats[field] += value
+
+    @property
+    def stages(self):
+        """ copy of the raw statistics per stage, seconds is the estimated
+        total time of all calls """
+
+        with self._lock:
+            stages = {stage: dict(stats)
+                      for stage, stats in self._stages.items()}
+        for stats in stages.values():
+            if stats['sampled']:
+                stats['seconds'] *= stats['calls'] / stats['sampled']
+        return stages
+
+    def summary(self):
+        """ DataFrame with one row per stage, slowest stage first """
+
+        stages = self.stages
+        summary = pd.DataFrame.from_dict(
+            stages, orient='index', columns=list(STAGE_FIELDS)
+        )
+        summary.index.name = 'stage'
+        summary['mean_ms'] = 1e3 * summary['seconds'] / summary['calls']
+        summary['mb_per_s'] = (
+            summary['bytes'] / 2**20
+            / summary['seconds'].where(summary['seconds'] > 0)
+        )
+        return summary.sort_values('seconds', ascending=False)
+
+    def to_json(self, **kwargs):
+        return json.dumps({
+            'sample_rate': self.sample_rate, 'stages': self.stages
+        }, **kwargs)
+
+    def to_prometheus(self, prefix='argus'):
+        """ the statistics in the Prometheus text exposition format """
+
+        stages = self.stages
+        metrics = (
+            ('calls_total', 'calls', 'counter', 'Number of calls'),
+            ('seconds_total', 'seconds', 'counter',
+             'Estimated total time spent'),
+            ('max_seconds', 'max_seconds', 'gauge',
+             'Longest timed call'),
+            ('bytes_total', 'bytes', 'counter', 'Bytes transferred'),
+            ('items_total', 'items', 'counter', 'Items processed'),
+        )
+        lines = []
+        for suffix, field, metric_type, description in metrics:
+            name = f'{prefix}_stage_{suffix}'
+            lines.append(f'# HELP {name} {description} per stage')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for stage, stats in sorted(stages.items()):
+                lines.append(f'{name}{{stage="{stage}"}} {stats[field]!r}')
+        return '\n'.join(lines) + '\n'
+
+
+def _rate_from_environment():
+    try:
+        return float(os.environ.get(ENVIRONMENT_VARIABLE, 0))
+    except ValueError:
+        return 0
+
+
+INSTRUMENTATION = Instrumentation()
+if _rate_from_environment() > 0:
+    INSTRUMENTATION.enable(min(1, _rate_from_environment()))
+
+enable = INSTRUMENTATION.enable
+disable = INSTRUMENTATION.disable
+reset = INSTRUMENTATION.reset
+timer = INSTRUMENTATION.timer
+timed = INSTRUMENTATION.timed
+record = INSTRUMENTATION.record
+add_bytes = INSTRUMENTATION.add_bytes
+add_items = INSTRUMENTATION.add_items
+summary = INSTRUMENTATION.summary
+to_json = INSTRUMENTATION.to_json
+to_prometheus = INSTRUMENTATION.to_prometheus
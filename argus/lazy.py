@@ -0,0 +1,25 @@
+
+import importlib
+import sys
+import types
+
+
+class LazyModule(types.ModuleType):
+    """ stand in for a module that is imported at the first attribute
+    access, after which its attributes are copied so later lookups cost the
+    same as on the module itself """
+
+    def __getattr__(self, attribute):
+        module = importlib.import_module(self.__name__)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attribute)
+
+
+def lazy_import(name):
+    """ a module that is only imported when it is first used, keeping heavy
+    dependencies (pandas, scipy, SQLAlchemy, requests, cv2) out of import
+    time """
+
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
@@ -1,8 +1,8 @@
 
 import numpy as np
 
-from sqlalchemy import (select, func, Column, Float, Integer, String,
-                        DateTime, ForeignKey)
+from sqlalchemy import (select, func, Boolean, Column, Float, Integer,
+                        String, DateTime, ForeignKey)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import relationship, column_property
@@ -188,6 +188,43 @@ class Geometry(Base):
         select([func.count(UsedGcp.pk)]).where(UsedGcp.geometry_id == id)
     )
 
+    quality = relationship("GeometryQuality", uselist=False)
+
     def __repr__(self):
         return (f"<Geometry {self.camera_id}:"
                 f"{self.time_valid.strftime('%Y-%m-%d %H:%M')}>")
+
+
+class GeometryQuality(Base):
+
+    __tablename__ = 'geometry_quality'
+
+    geometry_id = Column(Integer, ForeignKey('geometry.id'), primary_key=True)
+    gcp_count = Column(Integer)
+    inlier_count = Column(Integer)
+    mean_error = Column(Float)
+    rms_error = Column(Float)
+    max_error = Column(Float)
+    inlier_mean_error = Column(Float)
+    time_computed = Column(DateTime)
+
+    def __repr__(self):
+        rms_error = 'n/a' if self.rms_error is None \
+            else f"{self.rms_error:.2f}px"
+        return f"<GeometryQuality {self.geometry_id}: {rms_error}>"
+
+
+class UsedGcpError(Base):
+
+    __tablename__ = 'used_gcp_error'
+
+    used_gcp_pk = Column(Integer, ForeignKey('used_gcp.pk'), primary_key=True)
+    error = Column(Float)
+    is_inlier = Column(Boolean)
+
+    # relationships
+    geometry_id = Column(Integer, ForeignKey('geometry.id'))
+
+    def __repr__(self):
+        error = 'n/a' if self.error is None else f"{self.error:.2f}px"
+        return f"<Used GCP error {self.used_gcp_pk}: {error}>"
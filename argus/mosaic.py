@@ -0,0 +1,206 @@
+
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
+import os
+
+import cv2
+import numpy as np
+
+
+WEIGHTINGS = ('footprint', 'centre')
+
+
+class PlanView(object):
+    """ maps of a world grid into the original (distorted) frames of a
+    rectified camera, so a plan view is a single cv2.remap of a frame """
+
+    def __init__(self, camera, x, y, z=0):
+
+        grid_x, grid_y, grid_z = np.broadcast_arrays(
+            np.asarray(x, dtype=float).reshape(1, -1),
+            np.asarray(y, dtype=float).reshape(-1, 1),
+            np.asarray(z, dtype=float)
+        )
+        self.shape = grid_x.shape
+
+        image_points = camera.object_to_distorted_image_points(
+            np.column_stack((grid_x.ravel(), grid_y.ravel(), grid_z.ravel()))
+        )
+        self.valid = ~np.ma.getmaskarray(image_points).any(axis=1)\
+            .reshape(self.shape)
+
+        map_x, map_y = np.ma.filled(image_points, -1).astype(np.float32).T
+        self.map_x = map_x.reshape(self.shape)
+        self.map_y = map_y.reshape(self.shape)
+        self.frame_size = tuple(camera.frame_size)
+
+    @classmethod
+    def from_maps(cls, map_x, map_y, valid, frame_size):
+        plan_view = cls.__new__(cls)
+        plan_view.map_x, plan_view.map_y = map_x, map_y
+        plan_view.valid = valid
+        plan_view.shape = map_x.shape
+        plan_view.frame_size = tuple(frame_size)
+        return plan_view
+
+    def rectify(self, image):
+        return cv2.remap(
+            image, self.map_x, self.map_y, cv2.INTER_LINEAR,
+            borderMode=cv2.BORDER_CONSTANT, borderValue=0
+        )
+
+    def weights(self, weighting='footprint'):
+
+        if weighting not in WEIGHTINGS:
+            raise ValueError(f'weighting must be one of {WEIGHTINGS}')
+
+        if weighting == 'centre':
+            # 1 at the image centre, 0 at the corners
+            centre = (np.array(self.frame_size) - 1) / 2
+            distance = np.hypot(
+                (self.map_x - centre[0]) / centre[0],
+                (self.map_y - centre[1]) / centre[1]
+            ) / np.sqrt(2)
+            weights = 1 - distance
+        else:
+            # number of pixels covering a cell, i.e. the image resolution
+            dx_column, dx_row = np.gradient(self.map_x)
+            dy_column, dy_row = np.gradient(self.map_y)
+            weights = abs(dx_row * dy_column - dx_column * dy_row)
+
+        weights = np.where(self.valid, np.nan_to_num(weights), 0)
+        return weights.clip(0).astype(np.float32)
+
+
+class Mosaic(object):
+    """ site wide plan view merged from the frames of several cameras. The
+    per camera maps and normalised blending weights are computed once for
+    a set of geometries, merging a time step is then one remap per camera
+    (run in parallel) and a single weighted sum """
+
+    def __init__(self, cameras, x, y, z=0, weighting='footprint',
+                 cache_dir=None, cache_key=None, workers=None):
+
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        self.weighting = weighting
+        self.workers = workers if workers else max(1, len(cameras))
+
+        # maps and weights only depend on the geometries and the grid, so
+        # they can be cached on disk under a key identifying the set of
+        # geometries. The grid and the camera names are hashed into the file
+        # name, so reusing a key for another grid never loads stale maps
+        file_path = None
+        if cache_dir and cache_key is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            z = np.asarray(z, dtype=float)
+            digest = sha1()
+            for item in (self.x, self.y, z):
+                digest.update(repr(item.shape).encode())
+                digest.update(item.tobytes())
+            digest.update(repr(sorted(map(str, cameras))).encode())
+            file_path = os.path.join(
+                cache_dir,
+                f'{cache_key}_{weighting}_{digest.hexdigest()[:16]}.npz'
+            )
+
+        cached = None
+        if file_path and os.path.exists(file_path):
+            with np.load(file_path) as data:
+                cached = {name: data[name] for name in data.files}
+            names = [f'{name}_{array}' for name in cameras
+                     for array in ('map_x', 'map_y', 'valid', 'weights')]
+            if not all(name in cached and cached[name].shape == self.shape
+                       for name in names):
+                cached = None
+
+        if cached is not None:
+            self.plan_views = {
+                name: PlanView.from_maps(
+                    cached[f'{name}_map_x'], cached[f'{name}_map_y'],
+                    cached[f'{name}_valid'], camera.frame_size
+                )
+                for name, camera in cameras.items()
+            }
+            self.weights = {name: cached[f'{name}_weights']
+                            for name in cameras}
+        else:
+            self.plan_views = {
+                name: PlanView(camera, self.x, self.y, z)
+                for name, camera in cameras.items()
+            }
+            self.weights = {
+                name: plan_view.weights(weighting)
+                for name, plan_view in self.plan_views.items()
+            }
+            if file_path:
+                arrays = {}
+                for name, plan_view in self.plan_views.items():
+                    arrays.update({
+                        f'{name}_map_x': plan_view.map_x,
+                        f'{name}_map_y': plan_view.map_y,
+                        f'{name}_valid': plan_view.valid,
+                        f'{name}_weights': self.weights[name]
+                    })
+                np.savez(file_path, **arrays)
+
+        self._normalised = {}
+
+    @property
+    def shape(self):
+        return (len(self.y), len(self.x))
+
+    def normalised_weights(self, names):
+        """ weights of the given cameras normalised to sum to one, cached per
+        set of cameras (in case a camera has no image for a time step) """
+
+        key = frozenset(names)
+        if key not in self._normalised:
+            total = sum(self.weights[name] for name in key)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                self._normalised[key] = {
+                    name: np.where(total > 0, self.weights[name] / total, 0)
+                    .astype(np.float32)
+                    for name in key
+                }
+        return self._normalised[key]
+
+    def merge(self, images, executor=None):
+        """ merge a {camera: image} dict of one time step into a plan view,
+        cells seen by no camera are nan """
+
+        names = [name for name, image in images.items() if image is not None]
+        weights = self.normalised_weights(names)
+
+        def rectify(name):
+            return name, self.plan_views[name].rectify(images[name])
+
+        if executor is None:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                rectified = list(executor.map(rectify, names))
+        else:
+            rectified = list(executor.map(rectify, names))
+
+        output = None
+        for name, plan_view in rectified:
+            plan_view = plan_view.astype(np.float32, copy=False)
+            weight = weights[name]
+            if plan_view.ndim == 3:
+                weight = weight[..., None]
+            if output is None:
+                output = plan_view * weight
+            else:
+                output += plan_view * weight
+
+        if output is not None:
+            covered = sum(weights[name] for name in names) > 0
+            output[~covered] = np.nan
+        return output
+
+    def merge_series(self, series):
+        """ merge an iterable of (timestamp, {camera: image}) pairs, reusing
+        one thread pool. Yields (timestamp, plan view) """
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for timestamp, images in series:
+                yield timestamp, self.merge(images, executor=executor)
@@ -0,0 +1,426 @@
+"""
+Resumable batch processing of the images of a site:
+
+    catalog query -> download -> undistort -> rectify -> product
+
+Every image is an item in a local (sqlite) checkpoint database. Items are
+processed on a process pool and marked done as soon as their product is
+written, so a rerun with the same arguments skips finished items
+"""
+
+import argparse
+from bisect import bisect_right
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime, timezone
+import os
+import sqlite3
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from .camera import Camera as ArgusCamera
+from .core import create_session
+from .diagnostics import load_cameras, load_used_gcps
+from .images import IMAGE_SITES, get_images, image_url, load_image
+from .mosaic import PlanView
+
+
+PRODUCTS = ('undistort', 'planview')
+
+STATUSES = ('pending', 'done', 'failed', 'skipped')
+
+
+class Checkpoint(object):
+    """ completion state of every item of a run in a sqlite database. Only
+    the parent process writes to it """
+
+    def __init__(self, file_path):
+
+        directory = os.path.dirname(os.path.abspath(file_path))
+        os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(file_path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS item ('
+            'key TEXT PRIMARY KEY, epoch INTEGER, camera INTEGER, '
+            'type TEXT, url TEXT, status TEXT, output TEXT, error TEXT, '
+            'seconds REAL, time_done TEXT)'
+        )
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add(self, items):
+        """ register items, items that are already known keep their state """
+
+        self.connection.executemany(
+            'INSERT OR IGNORE INTO item (key, epoch, camera, type, url, '
+            'status) VALUES (?, ?, ?, ?, ?, ?)',
+            [(item['key'], item['epoch'], item['camera'], item['type'],
+              item['url'], 'pending') for item in items]
+        )
+        self.connection.commit()
+
+    def unfinished(self, retry_failed=True):
+        """ items to (re)process. Skipped items (e.g. without a geometry
+        at the time) are always retried, as that costs no download """
+
+        statuses = ('pending', 'skipped') + (
+            ('failed',) if retry_failed else ()
+        )
+        rows = self.connection.execute(
+            'SELECT key, epoch, camera, type, url FROM item WHERE status IN '
+            f'({", ".join("?" * len(statuses))}) ORDER BY camera, epoch',
+            statuses
+        ).fetchall()
+        return [dict(zip(('key', 'epoch', 'camera', 'type', 'url'), row))
+                for row in rows]
+
+    def mark(self, key, status, output=None, error=None, seconds=None,
+             commit=True):
+
+        if status not in STATUSES:
+            raise ValueError(f'status must be one of {STATUSES}')
+        self.connection.execute(
+            'UPDATE item SET status = ?, output = ?, error = ?, seconds = ?, '
+            'time_done = ? WHERE key = ?',
+            (status, output, error, seconds,
+             datetime.now(timezone.utc).replace(tzinfo=None).isoformat(), key)
+        )
+        if commit:
+            self.connection.commit()
+
+    def commit(self):
+        self.connection.commit()
+
+    def counts(self):
+        return dict(self.connection.execute(
+            'SELECT status, COUNT(*) FROM item GROUP BY status'
+        ).fetchall())
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+class Progress(object):
+    """ single line progress and throughput report on stderr """
+
+    def __init__(self, total, interval=0.5, stream=sys.stderr):
+
+        self.total = total
+        self.interval = interval
+        self.stream = stream
+        self.counts = dict.fromkeys(STATUSES[1:], 0)
+        self.bytes = 0
+        self._start = self._last = time.monotonic()
+
+    @property
+    def finished(self):
+        return sum(self.counts.values())
+
+    def update(self, status, n_bytes=0):
+
+        self.counts[status] += 1
+        self.bytes += n_bytes
+        now = time.monotonic()
+        if now - self._last >= self.interval:
+            self._last = now
+            self.stream.write('\r' + self.line())
+            self.stream.flush()
+
+    def line(self):
+
+        elapsed = max(time.monotonic() - self._start, 1e-9)
+        rate = self.finished / elapsed
+        remaining = (self.total - self.finished) / rate if rate else np.inf
+        return (f'{self.finished}/{self.total} '
+                f'(done {self.counts["done"]}, failed {self.counts["failed"]}'
+                f', skipped {self.counts["skipped"]}) '
+                f'{rate:.2f} images/s '
+                f'{self.bytes / 2**20 / elapsed:.2f} MB/s decoded '
+                f'eta {remaining:.0f} s')
+
+    def close(self):
+        self.stream.write('\r' + self.line() + '\n')
+        self.stream.flush()
+
+
+def grid_name(grid):
+    """ name of a plan view grid in keys and output paths """
+    return '_'.join(f'{value:g}' for value in grid)
+
+
+def catalog_items(site, time_start, time_end, cameras=None, image_types=None,
+                  product='undistort', grid=None):
+    """ checkpoint items of the images in the catalog, products on
+    different grids are different items """
+
+    kwargs = {key: value for key, value in
+              (('cameras', cameras), ('image_types', image_types)) if value}
+    entries = get_images(time_start, time_end, parse=False, **kwargs)
+
+    if grid is not None:
+        product = f'{product}:{grid_name(grid)}'
+
+    items = {}
+    for entry in entries:
+        camera = int(str(entry['camera']).lower().lstrip('c'))
+        key = f"{site}:{product}:c{camera}:{entry['type']}:{entry['epoch']}"
+        items[key] = {
+            'key': key, 'epoch': int(entry['epoch']), 'camera': camera,
+            'type': entry['type'], 'url': image_url(entry['path'])
+        }
+    return list(items.values())
+
+
+def load_geometries(site, cameras=None, min_gcps=4, session=None):
+    """ rectified camera parameters of every geometry of a site, per camera
+    number a (times valid, parameters) pair of lists sorted by time """
+
+    from .models import Camera, Geometry
+    close_session = session is None
+    session = session if session else create_session()
+    try:
+        query = session.query(Geometry.id, Geometry.time_valid, Camera.number)\
+            .join(Camera, Geometry.camera_id == Camera.id)\
+            .filter(Camera.station_id == IMAGE_SITES[site]['station'])\
+            .filter(Geometry.gcp_count >= min_gcps)
+        if cameras:
+            query = query.filter(Camera.number.in_(cameras))
+        geometries = query.order_by(Geometry.time_valid).all()
+        used_gcps = load_used_gcps(
+            session, [geometry_id for geometry_id, _, _ in geometries]
+        )
+        argus_cameras = load_cameras(session)
+    finally:
+        if close_session:
+            session.close()
+
+    by_geometry = {}
+    for geometry_id, gcps in used_gcps.groupby('geometry_id'):
+        camera = argus_cameras.get(gcps['camera_id'].iloc[0])
+        if camera is None:
+            continue
+        image_points = camera.undistort_points(
+            gcps[['u', 'v']].to_numpy(dtype=float, copy=True)
+        )
+        try:
+            camera.rectify(
+                gcps[['x', 'y', 'z']].to_numpy(dtype=float), image_points
+            )
+        except cv2.error:
+            continue
+        by_geometry[geometry_id] = {
+            'geometry_id': int(geometry_id),
+            'camera_matrix': camera.camera_matrix,
+            'dist_coefs': camera.dist_coefs,
+            'frame_size': tuple(camera.frame_size),
+            'rotation_matrix': camera.rotation_matrix,
+            'translation_vector': camera.translation_vector
+        }
+
+    output = {}
+    for geometry_id, time_valid, number in geometries:
+        if geometry_id in by_geometry:
+            times, parameters = output.setdefault(number, ([], []))
+            times.append(time_valid)
+            parameters.append(by_geometry[geometry_id])
+    return output
+
+
+def geometry_at(geometries, camera, epoch):
+    """ parameters of the last geometry of a camera valid at epoch """
+
+    if camera not in geometries:
+        return None
+    times, parameters = geometries[camera]
+    time = datetime.fromtimestamp(epoch, timezone.utc).replace(tzinfo=None)
+    index = bisect_right(times, time) - 1
+    return parameters[index] if index >= 0 else None
+
+
+# per process caches of the workers, keyed by geometry (and grid)
+_CAMERAS = {}
+_PLAN_VIEWS = {}
+
+
+def _worker_camera(parameters):
+
+    key = parameters['geometry_id']
+    if key not in _CAMERAS:
+        _CAMERAS[key] = ArgusCamera(
+            parameters['camera_matrix'], parameters['dist_coefs'],
+            parameters['frame_size'],
+            rotation_matrix=parameters['rotation_matrix'],
+            translation_vector=parameters['translation_vector']
+        )
+    return _CAMERAS[key]
+
+
+def _plan_view(parameters, grid):
+
+    key = (parameters['geometry_id'], grid)
+    if key not in _PLAN_VIEWS:
+        x_min, x_max, y_min, y_max, spacing, z = grid
+        _PLAN_VIEWS[key] = PlanView(
+            _worker_camera(parameters),
+            np.arange(x_min, x_max, spacing), np.arange(y_min, y_max, spacing),
+            z
+        )
+    return _PLAN_VIEWS[key]
+
+
+def process_item(task):
+    """ download one image and write its product, runs in a worker. Returns
+    the key, status, output path, error, bytes downloaded and duration """
+
+    start = time.perf_counter()
+    item, parameters = task['item'], task['parameters']
+    try:
+        image = load_image(item['url'], to_float=False)
+        if task['product'] == 'planview':
+            product = _plan_view(parameters, task['grid']).rectify(image)
+        else:
+            product = _worker_camera(parameters).undistort_image(image)
+
+        product_dir = task['product'] if task['grid'] is None \
+            else f"{task['product']}_{grid_name(task['grid'])}"
+        output = os.path.join(
+            task['output_dir'], product_dir, f"c{item['camera']}",
+            item['type'], f"{item['epoch']}.png"
+        )
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        if not cv2.imwrite(output, cv2.cvtColor(product, cv2.COLOR_RGB2BGR)):
+            raise OSError(f'Could not write {output}')
+    except Exception as exception:
+        return (item['key'], 'failed', None, repr(exception), 0,
+                time.perf_counter() - start)
+    return (item['key'], 'done', output, None, image.nbytes,
+            time.perf_counter() - start)
+
+
+def run(site, time_start, time_end, output_dir, cameras=None,
+        image_types=None, product='undistort', grid=None, workers=None,
+        checkpoint_path=None, retry_failed=True, min_gcps=4,
+        max_pending=None, progress=True):
+    """ run (or resume) the pipeline, returns the item counts per status """
+
+    if site not in IMAGE_SITES:
+        raise ValueError(f'Site must be one of {tuple(IMAGE_SITES)}')
+    if product not in PRODUCTS:
+        raise ValueError(f'product must be one of {PRODUCTS}')
+    if product == 'planview' and grid is None:
+        raise ValueError('A planview needs a grid')
+
+    checkpoint_path = checkpoint_path if checkpoint_path else os.path.join(
+        output_dir, 'checkpoint.db'
+    )
+    workers = workers if workers else os.cpu_count()
+    max_pending = max_pending if max_pending else 4 * workers
+
+    with Checkpoint(checkpoint_path) as checkpoint:
+        grid = tuple(grid) if product == 'planview' else None
+        checkpoint.add(catalog_items(
+            site, time_start, time_end, cameras, image_types, product, grid
+        ))
+        items = checkpoint.unfinished(retry_failed=retry_failed)
+        geometries = load_geometries(site, cameras, min_gcps=min_gcps)
+
+        reporter = Progress(len(items)) if progress else None
+        tasks = []
+        for item in items:
+            parameters = geometry_at(geometries, item['camera'], item['epoch'])
+            if parameters is None:
+                checkpoint.mark(item['key'], 'skipped', error='no geometry',
+                                commit=False)
+                if reporter:
+                    reporter.update('skipped')
+                continue
+            tasks.append({
+                'item': item, 'parameters': parameters, 'product': product,
+                'grid': grid, 'output_dir': output_dir
+            })
+        checkpoint.commit()
+
+        # items are sorted by camera and time, so consecutive tasks mostly
+        # share a geometry and hit the worker caches
+        tasks = iter(tasks)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = set()
+            while True:
+                for task in tasks:
+                    pending.add(executor.submit(process_item, task))
+                    if len(pending) >= max_pending:
+                        break
+                if not pending:
+                    break
+
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    key, status, output, error, n_bytes, seconds = \
+                        future.result()
+                    checkpoint.mark(key, status, output=output, error=error,
+                                    seconds=seconds, commit=False)
+                    if reporter:
+                        reporter.update(status, n_bytes)
+                checkpoint.commit()
+
+        if reporter:
+            reporter.close()
+        return checkpoint.counts()
+
+
+def _parse_date(value):
+    return datetime.fromisoformat(value)
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(
+        description='Download, undistort and rectify the images of a site. '
+                    'Reruns resume from the checkpoint database.'
+    )
+    parser.add_argument('start', type=_parse_date,
+                        help='start date (UTC), e.g. 2019-01-01')
+    parser.add_argument('end', type=_parse_date,
+                        help='end date (UTC), e.g. 2019-01-02T12:00')
+    parser.add_argument('output_dir')
+    parser.add_argument('--site', default='zandmotor',
+                        choices=sorted(IMAGE_SITES))
+    parser.add_argument('--cameras', type=int, nargs='+')
+    parser.add_argument('--types', nargs='+', dest='image_types')
+    parser.add_argument('--product', default='undistort', choices=PRODUCTS)
+    parser.add_argument('--grid', type=float, nargs=6,
+                        metavar=('X_MIN', 'X_MAX', 'Y_MIN', 'Y_MAX',
+                                 'SPACING', 'Z'),
+                        help='plan view grid in site coordinates')
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--checkpoint',
+                        help='default: OUTPUT_DIR/checkpoint.db')
+    parser.add_argument('--no-retry', action='store_true',
+                        help='do not retry items that failed before')
+    parser.add_argument('--min-gcps', type=int, default=4)
+    parser.add_argument('--quiet', action='store_true')
+    args = parser.parse_args(argv)
+
+    counts = run(
+        args.site, args.start, args.end, args.output_dir,
+        cameras=args.cameras, image_types=args.image_types,
+        product=args.product, grid=args.grid, workers=args.workers,
+        checkpoint_path=args.checkpoint, retry_failed=not args.no_retry,
+        min_gcps=args.min_gcps, progress=not args.quiet
+    )
+    print(', '.join(f'{status}: {count}'
+                    for status, count in sorted(counts.items())))
+    return 1 if counts.get('failed') else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,6 @@
 
+from collections import OrderedDict
+
 import ephem
 import numpy as np
 from pytz import timezone as pytz_timezone, utc as pytz_utc, all_timezones
@@ -6,37 +8,145 @@ from pytz import timezone as pytz_timezone, utc as pytz_utc, all_timezones
 
 class Rotation(object):
 
-    def __init__(self, lat, lon, rotation_angle):
+    def __init__(self, lat, lon, rotation_angle, elev=0):
         self.lat = lat
         self.lon = lon
+        self.elev = elev
         self.rotation_angle = rotation_angle
 
     @property
     def origin(self):
         return [self.lat, self.lon]
 
+    @property
+    def rotation_angle(self):
+        return self._rotation_angle
+
+    @rotation_angle.setter
+    def rotation_angle(self, rotation_angle):
+        # cache the matrix so it is only rebuilt when the angle changes
+        theta = np.deg2rad(rotation_angle)
+        self._rotation_angle = rotation_angle
+        self._rotation_matrix = np.array([
+            [np.cos(theta), np.sin(theta)],
+            [-np.sin(theta), np.cos(theta)]
+        ])
+
+    @property
+    def rotation_matrix(self):
+        return self._rotation_matrix
+
     # Argus to local
-    def local_to_argus(self, coords):
-        coords = self._rotate(coords - self.origin)
-        return coords
+    def local_to_argus(self, coords, out=None):
+        return self._transform_coords(coords, out=out)
 
-    def argus_to_local(self, coords):
-        coords = self._rotate(coords, positive=False) + self.origin
-        return coords
+    def argus_to_local(self, coords, out=None):
+        return self._transform_coords(coords, inverse=True, out=out)
 
-    def _rotate(self, coords, positive=True):
-        if not positive:
-            theta = np.deg2rad(-self.rotation_angle)
-        else:
-            theta = np.deg2rad(self.rotation_angle)
+    def grid_to_argus(self, x, y, z=None, out=None, dtype=None):
+        """ rotate the grid spanned by 1d x and y axes without building the
+        meshgrid first, output arrays have shape (len(y), len(x)) """
 
-        rotation_matrix = np.array([
-            [np.cos(theta), np.sin(theta)],
-            [-np.sin(theta), np.cos(theta)]
-         ])
+        x, y = np.asarray(x), np.asarray(y)
+        return self.transform(
+            x.reshape(1, -1), y.reshape(-1, 1), z=z, out=out, dtype=dtype
+        )
+
+    def grid_to_local(self, x, y, z=None, out=None, dtype=None):
+        x, y = np.asarray(x), np.asarray(y)
+        return self.transform(
+            x.reshape(1, -1), y.reshape(-1, 1), z=z, inverse=True, out=out,
+            dtype=dtype
+        )
 
-        rotated_coords = np.dot(rotation_matrix, coords.T)
-        return rotated_coords.T
+    def transform(self, x, y, z=None, inverse=False, out=None, dtype=None):
+        """ rotate separate (broadcastable) coordinate arrays. Results are
+        written into out (which may be the input arrays for an in place
+        transform) or into new arrays of the given dtype """
+
+        x, y = np.asarray(x), np.asarray(y)
+        shape = np.broadcast_shapes(x.shape, y.shape)
+        if z is not None:
+            z = np.asarray(z)
+            shape = np.broadcast_shapes(shape, z.shape)
+
+        if out is None:
+            dtype = np.dtype(dtype if dtype else np.result_type(x, y, float))
+            out = tuple(
+                np.empty(shape, dtype=dtype)
+                for _ in range(2 if z is None else 3)
+            )
+        elif len(out) != (2 if z is None else 3):
+            raise ValueError('out must contain an array for each coordinate')
+        elif any(item.shape != shape for item in out):
+            raise ValueError(f'out arrays must have shape {shape}')
+        x_out, y_out = out[:2]
+
+        if inverse:
+            matrix = self._rotation_matrix.T
+            pre_offset, post_offset = (0, 0, 0), self.origin + [self.elev]
+        else:
+            matrix = self._rotation_matrix
+            pre_offset, post_offset = self.origin + [self.elev], (0, 0, 0)
+
+        # the offsets are applied to copies of the inputs so that out can
+        # alias them. The copies have the input shapes, so they are small for
+        # grid axes but full size for flat coordinates. The arithmetic is done
+        # in (at least) double precision, as the offsets of e.g. RD
+        # coordinates are far larger than the float32 resolution needed,
+        # and only the result is cast to the dtype of out
+        dtype = np.result_type(x, y, float)
+        dx = np.subtract(x, pre_offset[0], dtype=dtype)
+        dy = np.subtract(y, pre_offset[1], dtype=dtype)
+
+        if x_out.dtype == dtype and y_out.dtype == dtype:
+            x_work, y_work = x_out, y_out
+        else:
+            x_work, y_work = np.empty(shape, dtype), np.empty(shape, dtype)
+
+        np.multiply(dx, matrix[0, 0], out=x_work)
+        np.multiply(dy, matrix[0, 1], out=y_work)
+        x_work += y_work
+        np.multiply(dy, matrix[1, 1], out=y_work)
+        dx *= matrix[1, 0]
+        y_work += dx
+
+        if post_offset[0] or post_offset[1]:
+            x_work += post_offset[0]
+            y_work += post_offset[1]
+
+        if x_work is not x_out:
+            np.copyto(x_out, x_work, casting='same_kind')
+            np.copyto(y_out, y_work, casting='same_kind')
+
+        if z is not None:
+            np.add(z, post_offset[2] - pre_offset[2], out=out[2])
+        return out
+
+    def _transform_coords(self, coords, inverse=False, out=None):
+
+        coords = np.asarray(coords)
+        if coords.shape[-1] not in (2, 3):
+            raise ValueError(
+                'coords must have 2 (x, y) or 3 (x, y, z) columns'
+            )
+
+        if out is None:
+            out = np.empty(coords.shape, dtype=np.result_type(coords, float))
+        elif out.shape != coords.shape:
+            raise ValueError('out must have the same shape as coords')
+
+        columns = coords.reshape(-1, coords.shape[-1]).T
+        out_columns = out.reshape(-1, coords.shape[-1]).T
+        if not np.may_share_memory(out_columns, out):
+            raise ValueError('out must be reshapeable without copying')
+
+        self.transform(
+            columns[0], columns[1],
+            z=columns[2] if len(columns) == 3 else None,
+            inverse=inverse, out=tuple(out_columns)
+        )
+        return out
 
 
 def parse_timezone(timezone_string):
@@ -70,7 +180,7 @@ class Solar(ephem.Observer):
 
     def sun_position(self, input_datetime):
 
-        self.date = self._process_input_date(input_datetime)
+        self.date = self.process_input_datetime(input_datetime)
         position = ephem.Sun(self)
         position.compute(self)
 
@@ -131,3 +241,217 @@ def shadow_position(azimuth, altitude,
                      + np.asarray(offset).reshape(-1, 1))
 
     return shadow_vector
+
+
+def shadow_positions(azimuth, altitude,
+                     object_heights, offsets=(0, 0), in_degrees=False):
+    """ vectorized shadow_position for arrays of sun positions and objects.
+    Returns an (n_sun, n_objects, 2, 2) array where [i, j] matches
+    shadow_position(azimuth[i], altitude[i], object_heights[j], offsets[j]) """
+
+    azimuth, altitude = (
+        np.atleast_1d(np.asarray(item, dtype=float))
+        for item in (azimuth, altitude)
+    )
+    if in_degrees:
+        azimuth, altitude = np.deg2rad(azimuth), np.deg2rad(altitude)
+
+    object_heights = np.atleast_1d(np.asarray(object_heights, dtype=float))
+    offsets = np.asarray(offsets, dtype=float).reshape(-1, 2)
+    object_heights, offsets = np.broadcast_arrays(
+        object_heights[:, None], offsets
+    )
+
+    with np.errstate(divide='ignore'):
+        shadow_lengths = object_heights[:, 0] / np.tan(altitude)[:, None]
+    shadow_lengths[altitude < 0] = 0
+
+    angle = (azimuth + np.pi) % (2 * np.pi)
+    directions = np.column_stack((np.cos(angle), -np.sin(angle)))
+
+    shadow_vectors = np.empty((len(azimuth), len(offsets), 2, 2))
+    shadow_vectors[..., 0] = offsets
+    shadow_vectors[..., 1] = (
+        offsets + shadow_lengths[..., None] * directions[:, None, :]
+    )
+    return shadow_vectors
+
+
+class ShadowMask(object):
+    """ rasterize the shadows of objects (e.g. camera masts) into boolean
+    masks, either on a world grid spanned by the 1d axes x and y or on the
+    (undistorted) pixel grid of a rectified camera. Shadows are rectangles
+    of the given width and masks are cached by rounded sun position """
+
+    def __init__(self, positions, heights, width=1, x=None, y=None,
+                 camera=None, elevation=0, max_length=None, decimals=1,
+                 in_degrees=True, cache_size=1024):
+
+        if camera is None and (x is None or y is None):
+            raise ValueError('Either a camera or grid axes x, y are required')
+        if camera is not None and not camera.is_rectified:
+            raise ValueError('Camera has to be rectified')
+
+        self.positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+        self.heights = heights
+        self.width = width
+        self.camera = camera
+        self.elevation = elevation
+        self.decimals = decimals
+        self.in_degrees = in_degrees
+        self.cache_size = cache_size
+
+        if camera is not None:
+            self.x = np.arange(camera.frame_size[0], dtype=float)
+            self.y = np.arange(camera.frame_size[1], dtype=float)
+        else:
+            self.x = np.asarray(x, dtype=float)
+            self.y = np.asarray(y, dtype=float)
+            if np.any(np.diff(self.x) <= 0) or np.any(np.diff(self.y) <= 0):
+                raise ValueError('Grid axes must be increasing')
+
+        # on a world grid shadows never have to extend beyond the grid, on a
+        # camera grid (sun near the horizon) they are cut at max_length
+        if max_length is None and camera is not None:
+            max_length = 1e3
+        elif max_length is None:
+            corners = np.array(np.meshgrid(self.x[[0, -1]], self.y[[0, -1]]))
+            max_length = np.hypot(
+                *(corners.reshape(2, 1, -1) - self.positions.T[..., None])
+            ).max()
+        self.max_length = max_length
+
+        self._cache = OrderedDict()
+
+    @property
+    def shape(self):
+        return (len(self.y), len(self.x))
+
+    def clear_cache(self):
+        self._cache.clear()
+
+    def mask(self, azimuth, altitude):
+        return self.masks(azimuth, altitude)[0]
+
+    def masks(self, azimuth, altitude):
+        """ boolean (n_sun, ny, nx) array of the shadowed cells """
+
+        keys = list(zip(
+            *(np.round(np.atleast_1d(item), self.decimals).tolist()
+              for item in (azimuth, altitude))
+        ))
+
+        missing = list(OrderedDict.fromkeys(
+            key for key in keys if key not in self._cache
+        ))
+        if missing:
+            for key, mask in zip(missing, self._compute_masks(missing)):
+                self._cache[key] = mask
+
+        output = np.empty((len(keys),) + self.shape, dtype=bool)
+        for index, key in enumerate(keys):
+            self._cache.move_to_end(key)
+            output[index] = self._cache[key]
+
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return output
+
+    def _compute_masks(self, keys):
+
+        azimuth, altitude = np.asarray(keys, dtype=float).T
+        polygons, valid = self._shadow_polygons(azimuth, altitude)
+
+        if self.camera is not None:
+            object_points = np.concatenate((
+                polygons.reshape(-1, 2),
+                np.full((polygons[..., 0].size, 1), self.elevation)
+            ), axis=1)
+            polygons = self.camera.object_to_camera_points(object_points)\
+                .reshape(polygons.shape[:-1] + (3,))
+
+        masks = np.zeros((len(keys),) + self.shape, dtype=bool)
+        for index, object_index in zip(*np.nonzero(valid)):
+            polygon = polygons[index, object_index]
+            if self.camera is not None:
+                # shadows can run behind the camera, where the projection
+                # mirrors them, so only the part in front of it is projected
+                polygon = _clip_near_plane(polygon)
+                if len(polygon) < 3:
+                    continue
+                polygon = self.camera.camera_to_image_points(polygon).data
+            _fill_convex_polygon(masks[index], self.x, self.y, polygon)
+        return masks
+
+    def _shadow_polygons(self, azimuth, altitude):
+
+        if self.in_degrees:
+            azimuth, altitude = np.deg2rad(azimuth), np.deg2rad(altitude)
+
+        heights = np.broadcast_to(self.heights, len(self.positions))
+        with np.errstate(divide='ignore'):
+            lengths = np.minimum(
+                heights / np.tan(altitude)[:, None], self.max_length
+            )
+        valid = (altitude[:, None] >= 0) & (lengths > 0)
+
+        # same orientation as shadow_position
+        angle = (azimuth + np.pi) % (2 * np.pi)
+        directions = np.column_stack((np.cos(angle), -np.sin(angle)))
+        normals = np.column_stack((directions[:, 1], -directions[:, 0]))
+
+        base = np.broadcast_to(self.positions, lengths.shape + (2,))
+        tip = base + lengths[..., None] * directions[:, None, :]
+        normals = normals[:, None, :] * (self.width / 2)
+
+        polygons = np.stack(
+            (base + normals, tip + normals, tip - normals, base - normals),
+            axis=-2
+        )
+        return polygons, valid
+
+
+def _clip_near_plane(polygon, near=1e-2):
+    """ part of a convex polygon in camera coordinates in front of the
+    plane z = near (Sutherland-Hodgman against a single plane) """
+
+    inside = polygon[:, 2] > near
+    if inside.all():
+        return polygon
+
+    clipped = []
+    for start, end, start_inside, end_inside in zip(
+            polygon, np.roll(polygon, -1, axis=0),
+            inside, np.roll(inside, -1)):
+        if start_inside:
+            clipped.append(start)
+        if start_inside != end_inside:
+            fraction = (near - start[2]) / (end[2] - start[2])
+            clipped.append(start + fraction * (end - start))
+    return np.array(clipped).reshape(-1, 3)
+
+
+def _fill_convex_polygon(mask, x, y, polygon):
+
+    # restrict the point in polygon test to the bounding box of the polygon
+    (x_min, y_min), (x_max, y_max) = polygon.min(axis=0), polygon.max(axis=0)
+    if not np.all(np.isfinite([x_min, y_min, x_max, y_max])):
+        return
+    i_start = np.searchsorted(x, x_min, side='left')
+    i_end = np.searchsorted(x, x_max, side='right')
+    j_start = np.searchsorted(y, y_min, side='left')
+    j_end = np.searchsorted(y, y_max, side='right')
+    if i_start >= i_end or j_start >= j_end:
+        return
+
+    grid_x = x[i_start:i_end].reshape(1, -1)
+    grid_y = y[j_start:j_end].reshape(-1, 1)
+
+    positive = negative = True
+    for start, end in zip(polygon, np.roll(polygon, -1, axis=0)):
+        cross = ((end[0] - start[0]) * (grid_y - start[1])
+                 - (end[1] - start[1]) * (grid_x - start[0]))
+        positive = positive & (cross >= 0)
+        negative = negative & (cross <= 0)
+
+    mask[j_start:j_end, i_start:i_end] |= positive | negative
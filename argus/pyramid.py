@@ -0,0 +1,394 @@
+
+from collections import OrderedDict
+import json
+import math
+import os
+
+import cv2
+import numpy as np
+
+from .core import DATA_DIR
+from .utils import to_epoch
+from .instrumentation import add_bytes, timer
+
+
+PYRAMID_DIR = os.path.join(DATA_DIR, 'pyramid')
+
+GRID_NAME = 'grid.json'
+
+SOURCE_NAME = 'source'
+
+
+class TileGrid(object):
+    """ regular grid of a rectified product, spanned by increasing 1d
+    (Argus) x and y axes of cell centres and cut into square tiles. Level 0
+    is the full resolution, every next level halves it until the grid fits
+    in a single tile """
+
+    def __init__(self, x, y, tile_size=256):
+
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        if np.any(np.diff(self.x) <= 0) or np.any(np.diff(self.y) <= 0):
+            raise ValueError('Grid axes must be increasing')
+        self.tile_size = int(tile_size)
+
+    @classmethod
+    def from_local_bounds(cls, rotation, x_lims, y_lims, spacing,
+                          tile_size=256):
+        """ grid in Argus coordinates covering a box in local (world)
+        coordinates, using Rotation.local_to_argus """
+
+        corners = np.array(np.meshgrid(x_lims, y_lims)).reshape(2, -1).T
+        corners = rotation.local_to_argus(corners)
+        x_min, y_min = np.floor(corners.min(axis=0) / spacing) * spacing
+        x_max, y_max = corners.max(axis=0)
+        return cls(np.arange(x_min, x_max + spacing / 2, spacing),
+                   np.arange(y_min, y_max + spacing / 2, spacing),
+                   tile_size=tile_size)
+
+    @classmethod
+    def from_dict(cls, grid):
+        return cls(grid['x'], grid['y'], tile_size=grid['tile_size'])
+
+    def to_dict(self):
+        return {'x': self.x.tolist(), 'y': self.y.tolist(),
+                'tile_size': self.tile_size}
+
+    @property
+    def shape(self):
+        return (len(self.y), len(self.x))
+
+    @property
+    def spacing(self):
+        return float(self.x[1] - self.x[0]) if len(self.x) > 1 else 1.
+
+    @property
+    def levels(self):
+        return 1 + max(0, math.ceil(math.log2(
+            max(self.shape) / self.tile_size
+        )))
+
+    def level_shape(self, level):
+        return tuple(-(-size // 2 ** level) for size in self.shape)
+
+    def tile_counts(self, level):
+        return tuple(-(-size // self.tile_size)
+                     for size in self.level_shape(level))
+
+    def axes(self, level=0):
+        """ x and y of the cell centres at a level """
+        factor = 2 ** level
+        return tuple(
+            axis[0] + self.spacing * (
+                factor * np.arange(size) + (factor - 1) / 2
+            )
+            for axis, size in zip((self.x, self.y),
+                                  self.level_shape(level)[::-1])
+        )
+
+    def level_for(self, resolution):
+        """ coarsest level with cells no larger than resolution """
+        level = int(math.floor(math.log2(max(resolution / self.spacing, 1))))
+        return min(level, self.levels - 1)
+
+    def window(self, x_lims=None, y_lims=None, level=0):
+        """ row and column slices of the cells of a level within the limits
+        (all cells if a limit is None) """
+
+        x, y = self.axes(level)
+        return tuple(
+            slice(0, len(axis)) if lims is None else slice(
+                np.searchsorted(axis, min(lims), side='left'),
+                np.searchsorted(axis, max(lims), side='right')
+            )
+            for axis, lims in ((y, y_lims), (x, x_lims))
+        )
+
+
+class TilePyramid(object):
+    """ tiled, multi resolution store of rectified products (plan views,
+    mosaics) keyed by site, product type and timestamp. A product is only
+    registered when it is added, its tiles are generated on first request:
+    level 0 tiles are cut from the source, coarser tiles are the 2 x 2 means
+    of the four tiles below them. Tiles are stored as numpy files and kept
+    in an in memory LRU cache of cache_bytes. If max_disk_bytes is set, the
+    least recently used tiles on disk are evicted (and regenerated when
+    needed again) once the store grows beyond it """
+
+    def __init__(self, directory=PYRAMID_DIR, cache_bytes=256 * 2 ** 20,
+                 max_disk_bytes=None):
+
+        self.directory = directory
+        self.cache_bytes = cache_bytes
+        self.max_disk_bytes = max_disk_bytes
+        os.makedirs(directory, exist_ok=True)
+
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+        self._grids = {}
+        self._sources = OrderedDict()
+        self._disk_bytes = None
+
+    def grid(self, site, product):
+
+        key = (site, product)
+        if key not in self._grids:
+            file_path = os.path.join(self.directory, site, product, GRID_NAME)
+            if not os.path.exists(file_path):
+                raise KeyError(f'No {product} products of {site}')
+            with open(file_path, 'r') as file:
+                self._grids[key] = TileGrid.from_dict(json.load(file))
+        return self._grids[key]
+
+    def timestamps(self, site, product):
+        """ sorted epochs of the products of a site and type """
+        product_dir = os.path.join(self.directory, site, product)
+        if not os.path.isdir(product_dir):
+            return []
+        return sorted(int(name) for name in os.listdir(product_dir)
+                      if name.isdigit())
+
+    def add(self, site, product, timestamp, source, grid=None):
+        """ register a product: an array of the grid shape (saved as the
+        level 0 source) or the path of a .npy (memory mapped) or image file.
+        The grid is stored with the first product of a site and type """
+
+        product_dir = os.path.join(self.directory, site, product)
+        grid_path = os.path.join(product_dir, GRID_NAME)
+        if grid is not None and not os.path.exists(grid_path):
+            os.makedirs(product_dir, exist_ok=True)
+            with open(grid_path, 'w') as file:
+                json.dump(grid.to_dict(), file)
+        grid = self.grid(site, product)
+
+        product_dir = self._product_dir(site, product, timestamp)
+        if os.path.isdir(product_dir):
+            self.remove(site, product, timestamp)
+        os.makedirs(product_dir)
+
+        if isinstance(source, str):
+            source = os.path.abspath(source)
+            with open(os.path.join(product_dir, SOURCE_NAME + '.json'),
+                      'w') as file:
+                json.dump({'path': source}, file)
+        else:
+            source = np.asarray(source)
+            if source.shape[:2] != grid.shape:
+                raise ValueError(
+                    f'Product of shape {source.shape[:2]} does not match the '
+                    f'grid {grid.shape}'
+                )
+            np.save(os.path.join(product_dir, SOURCE_NAME + '.npy'), source)
+
+    def remove(self, site, product, timestamp):
+
+        product_dir = self._product_dir(site, product, timestamp)
+        for root, directories, files in os.walk(product_dir, topdown=False):
+            for name in files:
+                os.remove(os.path.join(root, name))
+            for name in directories:
+                os.rmdir(os.path.join(root, name))
+        if os.path.isdir(product_dir):
+            os.rmdir(product_dir)
+
+        prefix = (site, product, to_epoch(timestamp))
+        for key in [key for key in self._cache if key[:3] == prefix]:
+            self._cached_bytes -= self._cache.pop(key).nbytes
+        self._sources.pop(prefix, None)
+        self._disk_bytes = None
+
+    def tile(self, site, product, timestamp, level, row, column):
+        """ one tile (possibly smaller at the edges of the grid) """
+
+        key = (site, product, to_epoch(timestamp), level, row, column)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        grid = self.grid(site, product)
+        rows, columns = grid.tile_counts(level)
+        if not (0 <= level < grid.levels and 0 <= row < rows
+                and 0 <= column < columns):
+            raise IndexError(f'No tile {(level, row, column)}')
+
+        file_path = self._tile_path(*key)
+        if os.path.exists(file_path):
+            tile = np.load(file_path)
+            os.utime(file_path)
+        else:
+            with timer('pyramid.tile'):
+                tile = self._make_tile(grid, *key)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            np.save(file_path, tile)
+            self._written(tile.nbytes)
+        add_bytes('pyramid.tile', tile.nbytes)
+
+        self._cache[key] = tile
+        self._cached_bytes += tile.nbytes
+        while self._cached_bytes > self.cache_bytes and len(self._cache) > 1:
+            self._cached_bytes -= self._cache.popitem(last=False)[1].nbytes
+        return tile
+
+    def read(self, site, product, timestamp, x_lims=None, y_lims=None,
+             level=0, resolution=None):
+        """ x and y axes and the cells of a window at a level (or at the
+        coarsest level with cells up to resolution), reading only the tiles
+        that overlap the window """
+
+        grid = self.grid(site, product)
+        if resolution is not None:
+            level = grid.level_for(resolution)
+        rows, columns = grid.window(x_lims, y_lims, level)
+        x, y = grid.axes(level)
+
+        size = grid.tile_size
+        output = None
+        for row in range(rows.start // size, -(-rows.stop // size)):
+            for column in range(columns.start // size,
+                                -(-columns.stop // size)):
+                tile = self.tile(site, product, timestamp, level, row,
+                                 column)
+                if output is None:
+                    output = np.empty(
+                        (rows.stop - rows.start, columns.stop - columns.start)
+                        + tile.shape[2:], dtype=tile.dtype
+                    )
+                source, target = _overlap(row, column, size, rows, columns,
+                                          tile.shape)
+                output[target] = tile[source]
+
+        if output is None:
+            output = np.empty((0, 0))
+        return x[columns], y[rows], output
+
+    def prune(self, max_bytes=None):
+        """ remove the least recently used tiles on disk until at most
+        max_bytes (by default max_disk_bytes) are used by tiles """
+
+        max_bytes = self.max_disk_bytes if max_bytes is None else max_bytes
+        tiles = []
+        for root, _, files in os.walk(self.directory):
+            tiles.extend(
+                os.path.join(root, name) for name in files
+                if name.endswith('.npy') and not name.startswith(SOURCE_NAME)
+            )
+        tiles = sorted(
+            (os.stat(path).st_mtime, os.stat(path).st_size, path)
+            for path in tiles
+        )
+
+        total = sum(size for _, size, _ in tiles)
+        for _, size, path in tiles:
+            if total <= max_bytes:
+                break
+            os.remove(path)
+            total -= size
+        self._disk_bytes = total
+        return total
+
+    def _written(self, n_bytes):
+
+        if self.max_disk_bytes is None:
+            return
+        if self._disk_bytes is None:
+            self.prune(float('inf'))
+        else:
+            self._disk_bytes += n_bytes
+        if self._disk_bytes > self.max_disk_bytes:
+            # prune below the limit so not every new tile triggers a scan
+            self.prune(0.9 * self.max_disk_bytes)
+
+    def _make_tile(self, grid, site, product, epoch, level, row, column):
+
+        size = grid.tile_size
+        if level == 0:
+            source = self._source(site, product, epoch)
+            return np.array(source[row * size:(row + 1) * size,
+                                   column * size:(column + 1) * size])
+
+        # the (up to) four tiles of the level below
+        rows, columns = grid.tile_counts(level - 1)
+        children = [
+            [self.tile(site, product, epoch, level - 1, child_row,
+                       child_column)
+             for child_column in range(2 * column,
+                                       min(2 * column + 2, columns))]
+            for child_row in range(2 * row, min(2 * row + 2, rows))
+        ]
+        block = np.concatenate(
+            [np.concatenate(tiles, axis=1) for tiles in children], axis=0
+        )
+        return _downsample(block)
+
+    def _source(self, site, product, epoch):
+
+        key = (site, product, epoch)
+        if key in self._sources:
+            self._sources.move_to_end(key)
+            return self._sources[key]
+
+        product_dir = self._product_dir(site, product, epoch)
+        array_path = os.path.join(product_dir, SOURCE_NAME + '.npy')
+        if os.path.exists(array_path):
+            source = np.load(array_path, mmap_mode='r')
+        else:
+            with open(os.path.join(product_dir, SOURCE_NAME + '.json')) \
+                    as file:
+                path = json.load(file)['path']
+            if path.endswith('.npy'):
+                source = np.load(path, mmap_mode='r')
+            else:
+                source = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+                if source is None:
+                    raise ValueError(f'Could not read {path}')
+                if source.ndim == 3:
+                    source = cv2.cvtColor(source, cv2.COLOR_BGR2RGB)
+
+        # decoded images are large, keep only the last few
+        self._sources[key] = source
+        while len(self._sources) > 2:
+            self._sources.popitem(last=False)
+        return source
+
+    def _product_dir(self, site, product, timestamp):
+        return os.path.join(self.directory, site, product,
+                            str(to_epoch(timestamp)))
+
+    def _tile_path(self, site, product, epoch, level, row, column):
+        return os.path.join(self._product_dir(site, product, epoch),
+                            str(level), f'{row}_{column}.npy')
+
+
+def _downsample(block):
+    """ 2 x 2 means of a block, ignoring nan (uncovered) cells and cells
+    beyond an odd sized block """
+
+    rows, columns = block.shape[:2]
+    padded = np.full((rows + rows % 2, columns + columns % 2)
+                     + block.shape[2:], np.nan, dtype=np.float32)
+    padded[:rows, :columns] = block
+    padded = padded.reshape(
+        (padded.shape[0] // 2, 2, padded.shape[1] // 2, 2) + block.shape[2:]
+    )
+    with np.errstate(invalid='ignore', divide='ignore'):
+        valid = ~np.isnan(padded)
+        mean = np.where(valid, padded, 0).sum(axis=(1, 3)) \
+            / valid.sum(axis=(1, 3))
+
+    if np.issubdtype(block.dtype, np.integer):
+        return np.round(np.nan_to_num(mean)).astype(block.dtype)
+    return mean.astype(block.dtype)
+
+
+def _overlap(row, column, size, rows, columns, shape):
+    """ slices of a tile and of the output window that overlap """
+
+    source, target = [], []
+    for index, window, length in ((row, rows, shape[0]),
+                                  (column, columns, shape[1])):
+        start = max(window.start, index * size)
+        stop = min(window.stop, index * size + length)
+        source.append(slice(start - index * size, stop - index * size))
+        target.append(slice(start - window.start, stop - window.start))
+    return tuple(source), tuple(target)
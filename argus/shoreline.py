@@ -0,0 +1,275 @@
+
+import numpy as np
+
+from .utils import to_epoch
+
+
+INDICES = ('red_minus_blue', 'saturation', 'intensity')
+
+
+def shoreline_index(images, index='red_minus_blue'):
+    """ (..., y, x) float32 classification index of RGB plan views of shape
+    (..., y, x, 3), nan where a plan view is nan (not covered). Dry sand has
+    a higher red minus blue index than water """
+
+    if index not in INDICES:
+        raise ValueError(f'index must be one of {INDICES}')
+
+    images = np.asarray(images, dtype=np.float32)
+    red, green, blue = images[..., 0], images[..., 1], images[..., 2]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if index == 'red_minus_blue':
+            return (red - blue) / (red + green + blue)
+        if index == 'saturation':
+            maximum = images.max(axis=-1)
+            return (maximum - images.min(axis=-1)) / maximum
+    return images.mean(axis=-1)
+
+
+def smooth_transects(values, window):
+    """ nan aware moving mean over the last (cross-shore) axis """
+
+    if window <= 1:
+        return values
+    valid = ~np.isnan(values)
+    sums = np.cumsum(np.where(valid, values, 0), axis=-1, dtype=np.float64)
+    counts = np.cumsum(valid, axis=-1)
+
+    pad = [(0, 0)] * (values.ndim - 1) + [(1, 0)]
+    sums, counts = np.pad(sums, pad), np.pad(counts, pad)
+    size = values.shape[-1]
+    start = np.clip(np.arange(size) - window // 2, 0, size)
+    stop = np.clip(start + window, 0, size)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        smoothed = (sums[..., stop] - sums[..., start]) \
+            / (counts[..., stop] - counts[..., start])
+    smoothed[~valid] = np.nan
+    return smoothed.astype(np.float32)
+
+
+def otsu_thresholds(values, bins=64):
+    """ Otsu threshold of every transect (last axis) of values, from one
+    histogram per transect built with a single bincount """
+
+    shape = values.shape[:-1]
+    values = values.reshape(-1, values.shape[-1])
+    rows = len(values)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        low = np.nanmin(np.where(np.isnan(values), np.inf, values), axis=1)
+        high = np.nanmax(np.where(np.isnan(values), -np.inf, values), axis=1)
+        scaled = (values - low[:, None]) / (high - low)[:, None]
+
+    # nan values (and flat transects) go to an extra bin that is dropped
+    bin_index = np.where(
+        np.isfinite(scaled), np.clip(scaled * bins, 0, bins - 1), bins
+    ).astype(np.intp)
+    bin_index += (bins + 1) * np.arange(rows)[:, None]
+    histogram = np.bincount(
+        bin_index.ravel(), minlength=rows * (bins + 1)
+    ).reshape(rows, bins + 1)[:, :bins].astype(float)
+
+    centres = (np.arange(bins) + 0.5) / bins
+    weight = np.cumsum(histogram, axis=1)[:, :-1]
+    moment = np.cumsum(histogram * centres, axis=1)[:, :-1]
+    total_weight = histogram.sum(axis=1, keepdims=True)
+    total_moment = (histogram * centres).sum(axis=1, keepdims=True)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        between = weight * (total_weight - weight) * (
+            moment / weight
+            - (total_moment - moment) / (total_weight - weight)
+        ) ** 2
+    split = np.argmax(np.nan_to_num(between, nan=-1), axis=1)
+
+    thresholds = low + (split + 1) / bins * (high - low)
+    thresholds[~np.isfinite(thresholds)] = np.nan
+    return thresholds.reshape(shape)
+
+
+class ShorelineDetector(object):
+    """ shoreline positions on the cross-shore transects (rows) of batches
+    of rectified plan views on a grid spanned by the (Argus) x and y axes,
+    e.g. the output of Mosaic.merge_series for timex images.
+
+    Per transect the index is thresholded (Otsu), the shoreline is the cell
+    edge that best splits the transect in a land and a water part (fewest
+    misclassified cells, from cumulative sums) and is refined to the
+    crossing of the threshold between the two cells """
+
+    def __init__(self, x, y, index='red_minus_blue', land_high=True,
+                 land_side='low', smooth=5, bins=64, min_valid=0.5):
+
+        if land_side not in ('low', 'high'):
+            raise ValueError("land_side must be 'low' or 'high'")
+
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        self.index = index
+        self.land_high = land_high
+        self.land_side = land_side
+        self.smooth = smooth
+        self.bins = bins
+        self.min_valid = min_valid
+
+    def detect(self, plan_views):
+        """ cross-shore (x) shoreline positions and fractions of
+        misclassified cells of a (time, y, x, 3) batch (or a single plan
+        view), both of shape (time, y). Transects without a shoreline or
+        with too few covered cells are nan """
+
+        plan_views = np.asarray(plan_views)
+        if plan_views.ndim == 3:
+            return tuple(item[0] for item in self.detect(plan_views[None]))
+        if plan_views.shape[1:3] != (len(self.y), len(self.x)):
+            raise ValueError('plan views do not match the grid')
+
+        values = smooth_transects(
+            shoreline_index(plan_views, self.index), self.smooth
+        )
+        if self.land_side == 'high':
+            values = values[..., ::-1]
+        thresholds = otsu_thresholds(values, self.bins)[..., None]
+
+        valid = ~np.isnan(values)
+        with np.errstate(invalid='ignore'):
+            land = values > thresholds if self.land_high \
+                else values < thresholds
+        land &= valid
+        water = valid & ~land
+
+        # misclassified cells with the edge before cell k, for k in 0..x
+        pad = [(0, 0)] * (values.ndim - 1) + [(1, 0)]
+        water_before = np.pad(np.cumsum(water, axis=-1), pad)
+        land_before = np.pad(np.cumsum(land, axis=-1), pad)
+        errors = water_before + (land_before[..., -1:] - land_before)
+        edge = errors.argmin(axis=-1)
+
+        size = values.shape[-1]
+        count = valid.sum(axis=-1)
+        found = (edge > 0) & (edge < size) \
+            & (count >= self.min_valid * size)
+
+        before = np.take_along_axis(
+            values, np.clip(edge - 1, 0, size - 1)[..., None], axis=-1
+        )[..., 0]
+        after = np.take_along_axis(
+            values, np.clip(edge, 0, size - 1)[..., None], axis=-1
+        )[..., 0]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fraction = (before - thresholds[..., 0]) / (before - after)
+        fraction = np.clip(np.nan_to_num(fraction, nan=0.5), 0, 1)
+
+        # cell centres are at 0..size - 1 along the transect
+        position = edge - 1 + fraction
+        if self.land_side == 'high':
+            position = size - 1 - position
+        positions = np.interp(position, np.arange(size), self.x)
+        positions[~found] = np.nan
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            misclassified = np.take_along_axis(
+                errors, edge[..., None], axis=-1
+            )[..., 0] / count
+        misclassified[~found] = np.nan
+        return (positions.astype(np.float32),
+                misclassified.astype(np.float32))
+
+    def detect_series(self, series, batch_size=16):
+        """ ShorelineSeries of an iterable of (timestamp, plan view) pairs,
+        detected batch_size plan views at a time """
+
+        shorelines = ShorelineSeries(self.y)
+        timestamps, batch = [], []
+        for timestamp, plan_view in series:
+            if plan_view is None:
+                continue
+            timestamps.append(timestamp)
+            batch.append(plan_view)
+            if len(batch) == batch_size:
+                shorelines.append(timestamps, *self.detect(np.stack(batch)))
+                timestamps, batch = [], []
+        if batch:
+            shorelines.append(timestamps, *self.detect(np.stack(batch)))
+        return shorelines
+
+
+class ShorelineSeries(object):
+    """ compact (time, transect) arrays of shoreline positions (Argus x),
+    sorted by epoch, with the alongshore (Argus y) position of every
+    transect """
+
+    def __init__(self, y, epochs=(), positions=None, misclassified=None):
+
+        self.y = np.asarray(y, dtype=float)
+        self.epochs = np.asarray(epochs, dtype=np.int64)
+        shape = (len(self.epochs), len(self.y))
+        self.positions = np.full(shape, np.nan, dtype=np.float32) \
+            if positions is None else np.asarray(positions, np.float32)
+        self.misclassified = np.full(shape, np.nan, dtype=np.float32) \
+            if misclassified is None \
+            else np.asarray(misclassified, np.float32)
+
+    def __len__(self):
+        return len(self.epochs)
+
+    def append(self, timestamps, positions, misclassified=None):
+        """ add (time, transect) positions, keeping the series sorted """
+
+        epochs = np.array([to_epoch(item) for item in timestamps],
+                          dtype=np.int64)
+        if misclassified is None:
+            misclassified = np.full(np.shape(positions), np.nan)
+
+        self.epochs = np.concatenate((self.epochs, epochs))
+        self.positions = np.concatenate(
+            (self.positions, np.asarray(positions, np.float32))
+        )
+        self.misclassified = np.concatenate(
+            (self.misclassified, np.asarray(misclassified, np.float32))
+        )
+        if len(epochs) and np.any(np.diff(self.epochs) < 0):
+            order = np.argsort(self.epochs, kind='stable')
+            self.epochs = self.epochs[order]
+            self.positions = self.positions[order]
+            self.misclassified = self.misclassified[order]
+
+    def query(self, start=None, end=None, y_min=None, y_max=None):
+        """ the part of the series in [start, end) and [y_min, y_max] """
+
+        first = 0 if start is None \
+            else np.searchsorted(self.epochs, to_epoch(start))
+        last = len(self.epochs) if end is None \
+            else np.searchsorted(self.epochs, to_epoch(end))
+        transects = np.ones(len(self.y), dtype=bool)
+        if y_min is not None:
+            transects &= self.y >= y_min
+        if y_max is not None:
+            transects &= self.y <= y_max
+
+        return ShorelineSeries(
+            self.y[transects], self.epochs[first:last],
+            self.positions[first:last][:, transects],
+            self.misclassified[first:last][:, transects]
+        )
+
+    def to_world(self, rotation):
+        """ (time, transect) x and y world (local) coordinates of the
+        shoreline points through a projections.Rotation """
+
+        return rotation.transform(
+            self.positions, self.y[None, :], inverse=True, dtype=np.float64
+        )
+
+    def save(self, file_path):
+        np.savez_compressed(
+            file_path, y=self.y, epochs=self.epochs, positions=self.positions,
+            misclassified=self.misclassified
+        )
+
+    @classmethod
+    def load(cls, file_path):
+        with np.load(file_path) as data:
+            return cls(data['y'], data['epochs'], data['positions'],
+                       data['misclassified'])
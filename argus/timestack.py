@@ -0,0 +1,137 @@
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+
+import numpy as np
+
+from .images import load_image
+
+
+class PixelSampler(object):
+    """ bilinear sampling of a fixed set of (sub)pixel positions. Indices and
+    weights are computed once, sampling a frame only touches the four
+    neighbouring pixels of each position. Positions outside the frame give
+    nan """
+
+    def __init__(self, image_points, frame_size):
+
+        image_points = np.ma.filled(
+            np.ma.asarray(image_points, dtype=float), np.nan
+        ).reshape(-1, 2)
+        width, height = frame_size
+
+        columns, rows = image_points.T
+        self.valid = (
+            ~np.isnan(columns) & ~np.isnan(rows)
+            & (columns >= 0) & (columns <= width - 1)
+            & (rows >= 0) & (rows <= height - 1)
+        )
+        columns, rows = columns[self.valid], rows[self.valid]
+
+        column_start = np.minimum(np.floor(columns), width - 2).clip(0)
+        row_start = np.minimum(np.floor(rows), height - 2).clip(0)
+        dx, dy = columns - column_start, rows - row_start
+
+        column_start, row_start = (
+            item.astype(np.intp) for item in (column_start, row_start)
+        )
+        self.rows = np.stack((row_start, row_start, row_start + 1,
+                              row_start + 1))
+        self.columns = np.stack((column_start, column_start + 1,
+                                 column_start, column_start + 1))
+        self.weights = np.stack((
+            (1 - dx) * (1 - dy), dx * (1 - dy), (1 - dx) * dy, dx * dy
+        )).astype(np.float32)
+
+        self.frame_size = tuple(frame_size)
+        self.point_count = len(image_points)
+
+    def sample(self, image, out=None):
+        """ (n_points, n_channels) values of an image """
+
+        image = np.asarray(image)
+        if image.shape[1::-1] != self.frame_size:
+            raise ValueError(f'Image must have frame size {self.frame_size}')
+        channels = image.shape[2] if image.ndim == 3 else 1
+
+        if out is None:
+            out = np.empty((self.point_count, channels), dtype=np.float32)
+        out[~self.valid] = np.nan
+
+        values = self.weights[0, :, None] * image[
+            self.rows[0], self.columns[0]
+        ].reshape(-1, channels)
+        for corner in range(1, 4):
+            values += self.weights[corner, :, None] * image[
+                self.rows[corner], self.columns[corner]
+            ].reshape(-1, channels)
+        out[self.valid] = values
+        return out
+
+
+class TimestackExtractor(object):
+    """ extract (time x point x channel) intensity stacks at world points
+    from a series of frames of one camera geometry. The points are
+    projected once into the original (distorted) frames, which are then
+    sampled directly without undistorting or keeping them """
+
+    def __init__(self, camera, object_points, distorted=True):
+
+        object_points = np.asarray(object_points, dtype=float).reshape(-1, 3)
+        if distorted:
+            image_points = camera.object_to_distorted_image_points(
+                object_points
+            )
+        else:
+            image_points = camera.object_to_image_points(object_points)
+
+        self.object_points = object_points
+        self.sampler = PixelSampler(image_points, camera.frame_size)
+
+    def sample(self, image, out=None):
+        return self.sampler.sample(image, out=out)
+
+    def extract(self, frames, out=None, count=None, channels=3,
+                prefetch=4, to_float=True):
+        """ frames is an iterable of (timestamp, image or url) pairs. Urls
+        are downloaded and decoded on a thread pool with at most prefetch
+        frames in flight. The stack is written into out (e.g. a np.memmap) or
+        a new float32 array, which needs the number of frames (count or
+        len(frames)). Returns the timestamps and the stack """
+
+        if out is None:
+            count = count if count is not None else len(frames)
+            out = np.empty(
+                (count, self.sampler.point_count, channels), dtype=np.float32
+            )
+
+        timestamps = []
+        frames = iter(frames)
+        with ThreadPoolExecutor(max_workers=prefetch) as executor:
+            pending = deque(
+                self._submit(executor, frame, to_float)
+                for frame in itertools.islice(frames, prefetch)
+            )
+            while pending:
+                timestamp, image = pending.popleft()
+                image = image.result() if hasattr(image, 'result') else image
+
+                # keep the pipeline full while this frame is sampled
+                for frame in itertools.islice(frames, 1):
+                    pending.append(self._submit(executor, frame, to_float))
+
+                index = len(timestamps)
+                if index >= len(out):
+                    raise ValueError('More frames than space in the stack')
+                self.sample(image, out=out[index])
+                timestamps.append(timestamp)
+
+        return timestamps, out[:len(timestamps)]
+
+    @staticmethod
+    def _submit(executor, frame, to_float):
+        timestamp, image = frame
+        if isinstance(image, str):
+            return timestamp, executor.submit(load_image, image, to_float)
+        return timestamp, image
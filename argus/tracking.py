@@ -0,0 +1,189 @@
+
+import cv2
+import numpy as np
+
+from .lazy import lazy_import
+
+
+pd = lazy_import('pandas')
+
+
+POSE_COLUMNS = ['rx', 'ry', 'rz', 'tx', 'ty', 'tz', 'error', 'n_points',
+                'full_solve']
+
+
+def to_gray(image):
+
+    image = np.asarray(image)
+    if image.dtype != np.uint8:
+        image = (np.clip(image, 0, 1) * 255).astype(np.uint8)
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    return image
+
+
+def reprojection_errors(camera, object_points, image_points):
+    """ distance in pixels between (undistorted) image points and the
+    projection of their object points """
+
+    projected = camera.object_to_image_points(object_points).data
+    return np.hypot(*(projected - image_points).T)
+
+
+class PoseTracker(object):
+    """ track the pose of a camera over a series of frames. The image
+    positions of the gcps (or other stable features with known object
+    coordinates) are followed from frame to frame with pyramidal Lucas
+    Kanade optical flow, and the pose is refined starting from the pose of
+    the previous frame. Only when the reprojection error jumps above
+    max(max_error, error_jump times the previous error) is the pose solved
+    from scratch with RANSAC """
+
+    def __init__(self, camera, object_points, image_points, distorted=True,
+                 max_error=2.0, error_jump=3.0, min_points=6,
+                 window_size=(21, 21), max_level=3):
+
+        if not camera.is_rectified:
+            camera.rectify(object_points, image_points, distorted=distorted)
+
+        self.camera = camera
+        self.object_points = np.asarray(object_points, dtype=np.float64)
+        self.max_error = max_error
+        self.error_jump = error_jump
+        self.min_points = min_points
+        self.flow_parameters = dict(
+            winSize=window_size, maxLevel=max_level,
+            criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT,
+                      30, 0.01)
+        )
+
+        # points are tracked in the original frames
+        image_points = np.asarray(image_points, dtype=np.float32)
+        if not distorted:
+            image_points = camera.object_to_distorted_image_points(
+                self.object_points
+            ).data.astype(np.float32)
+        self.reference_points = image_points.copy()
+
+        self._points = image_points.copy()
+        self._active = np.ones(len(image_points), dtype=bool)
+        self._previous_frame = None
+        self._initial_error = reprojection_errors(
+            camera, self.object_points,
+            camera.undistort_points(image_points.astype(np.float64))
+        ).mean()
+        self._previous_error = self._initial_error
+
+    def update(self, image):
+        """ track the points into a new frame and refine the pose, returns
+        the rotation vector, translation vector, error, number of points and
+        whether a full solve was needed """
+
+        frame = to_gray(image)
+        if self._previous_frame is not None:
+            self._track(frame)
+        self._previous_frame = frame
+
+        active = self._active
+        object_points = self.object_points[active]
+        image_points = self.camera.undistort_points(
+            self._points[active].astype(np.float64)
+        )
+        previous_pose = (self.camera.rotation_matrix,
+                         self.camera.translation_vector)
+
+        full_solve = False
+        if active.sum() >= self.min_points:
+            self.camera.rectify(
+                object_points, image_points, use_extrinsic_guess=True
+            )
+            error = reprojection_errors(
+                self.camera, object_points, image_points
+            ).mean()
+
+            threshold = max(self.max_error,
+                            self.error_jump * self._previous_error)
+            if error > threshold:
+                full_solve = True
+                error = self._full_solve(
+                    object_points, image_points, threshold
+                )
+        else:
+            error = np.inf
+
+        if not np.isfinite(error):
+            # keep the last good pose, restart tracking from the gcps
+            self.camera.rotation_matrix, self.camera.translation_vector = \
+                previous_pose
+            self.reset()
+        else:
+            self._previous_error = error
+
+        rotation_vector = cv2.Rodrigues(self.camera.rotation_matrix)[0]
+        return (rotation_vector.ravel(),
+                self.camera.translation_vector.ravel(), error,
+                int(active.sum()), full_solve)
+
+    def track(self, frames):
+        """ pose time series for an iterable of (timestamp, image) pairs """
+
+        timestamps, rows = [], []
+        for timestamp, image in frames:
+            rotation_vector, translation_vector, error, count, full_solve = \
+                self.update(image)
+            timestamps.append(timestamp)
+            rows.append([*rotation_vector, *translation_vector, error, count,
+                         full_solve])
+        return pd.DataFrame(rows, index=timestamps, columns=POSE_COLUMNS)
+
+    def reset(self):
+        self._points = self.reference_points.copy()
+        self._active[:] = True
+        self._previous_error = self._initial_error
+
+    def _track(self, frame):
+
+        active = np.nonzero(self._active)[0]
+        if not len(active):
+            return
+
+        points, status = cv2.calcOpticalFlowPyrLK(
+            self._previous_frame, frame,
+            self._points[active].reshape(-1, 1, 2), None,
+            **self.flow_parameters
+        )[:2]
+
+        # backwards check to drop points that drifted
+        back_points, back_status = cv2.calcOpticalFlowPyrLK(
+            frame, self._previous_frame, points, None,
+            **self.flow_parameters
+        )[:2]
+        drift = np.hypot(*(back_points - self._points[active].reshape(
+            -1, 1, 2)).reshape(-1, 2).T)
+
+        tracked = (status.ravel() == 1) & (back_status.ravel() == 1) & \
+            (drift < 1)
+        self._points[active] = points.reshape(-1, 2)
+        self._active[active[~tracked]] = False
+
+    def _full_solve(self, object_points, image_points, threshold):
+
+        success, rotation_vector, translation_vector, inliers = \
+            cv2.solvePnPRansac(
+                object_points, image_points, self.camera.opt_camera_matrix,
+                np.zeros(4), reprojectionError=threshold
+            )
+        if not success or inliers is None or len(inliers) < self.min_points:
+            return np.inf
+
+        self.camera.rotation_matrix = cv2.Rodrigues(rotation_vector)[0]
+        self.camera.translation_vector = translation_vector
+
+        # points that are no longer consistent are not tracked any further
+        outliers = np.setdiff1d(np.arange(len(object_points)), inliers)
+        self._active[np.nonzero(self._active)[0][outliers]] = False
+
+        inliers = inliers.ravel()
+        return reprojection_errors(
+            self.camera, object_points[inliers], image_points[inliers]
+        ).mean()
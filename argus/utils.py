@@ -1,3 +1,6 @@
+from calendar import timegm
+from datetime import datetime
+
 
 FIELD_MAPPING = {
     'site': {
@@ -125,3 +128,10 @@ def post_process_usedgcp(table):
             max_pk += 1
             table[index]['pk'] = max_pk
     return table
+
+
+def to_epoch(timestamp):
+    """ epoch seconds of a datetime (naive ones are utc) or a number """
+    if isinstance(timestamp, datetime):
+        return timegm(timestamp.utctimetuple())
+    return int(timestamp)
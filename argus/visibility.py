@@ -0,0 +1,220 @@
+
+from collections import OrderedDict
+from hashlib import sha1
+import os
+
+import numpy as np
+
+
+def visibility_mask(camera, x, y, z, buffer_scale=0.5, tolerance=0.01,
+                    tile_size=2**18, max_footprint=64):
+    """ boolean mask of the cells of a gridded surface that can be seen by a
+    rectified camera. x, y and z (in the object coordinates of the camera)
+    must broadcast to the 2d shape of the grid, e.g. 1d axes reshaped to a
+    row and a column and a 2d elevation.
+
+    Every quad between four neighbouring cells is rendered into a depth (z)
+    buffer at buffer_scale times the image resolution, using the bounding
+    box of its projection and its largest depth. A cell is visible if it is
+    not further than the nearest depth at its pixel plus the depth step to
+    its neighbours and a relative tolerance. Rows of the grid are processed
+    in tiles of about tile_size cells """
+
+    if not camera.is_rectified:
+        raise ValueError('Camera has to be rectified')
+
+    x, y, z = np.broadcast_arrays(
+        np.asarray(x, dtype=float), np.asarray(y, dtype=float),
+        np.ma.filled(np.ma.asarray(z, dtype=float), np.nan)
+    )
+    if x.ndim != 2:
+        raise ValueError('x, y and z must broadcast to a 2d grid')
+
+    buffer_shape = tuple(
+        max(1, int(round(size * buffer_scale)))
+        for size in camera.frame_size[::-1]
+    )
+    depth_buffer = np.full(buffer_shape, np.inf, dtype=np.float32)
+    rows_per_tile = max(1, tile_size // x.shape[1])
+
+    # first pass: render the quads of every tile (plus the next grid row)
+    for tile in _row_tiles(x.shape[0], rows_per_tile):
+        window = slice(tile.start, min(tile.stop + 1, x.shape[0]))
+        columns, rows, depth = _project(
+            camera, x[window], y[window], z[window], buffer_scale
+        )
+        _render_quads(
+            depth_buffer, columns, rows, depth, max_footprint
+        )
+
+    # second pass: compare every cell against the buffer
+    visible = np.zeros(x.shape, dtype=bool)
+    for tile in _row_tiles(x.shape[0], rows_per_tile):
+        window = slice(tile.start, min(tile.stop + 1, x.shape[0]))
+        columns, rows, depth = _project(
+            camera, x[window], y[window], z[window], buffer_scale
+        )
+        depth_step = _depth_step(depth)
+
+        count = tile.stop - tile.start
+        columns, rows, depth, depth_step = (
+            item[:count].astype(float).ravel()
+            for item in (columns, rows, depth, depth_step)
+        )
+        pixel_columns = np.floor(columns).astype(int)
+        pixel_rows = np.floor(rows).astype(int)
+        valid = (
+            ~np.isnan(depth) & (depth > 0)
+            & (pixel_columns >= 0) & (pixel_columns < buffer_shape[1])
+            & (pixel_rows >= 0) & (pixel_rows < buffer_shape[0])
+        )
+
+        visible_tile = np.zeros(len(depth), dtype=bool)
+        visible_tile[valid] = (
+            depth[valid] <= depth_buffer[pixel_rows[valid],
+                                         pixel_columns[valid]]
+            * (1 + tolerance) + depth_step[valid]
+        )
+        visible[tile] = visible_tile.reshape(count, -1)
+
+    return visible
+
+
+def _row_tiles(count, rows_per_tile):
+    for start in range(0, count, rows_per_tile):
+        yield slice(start, min(start + rows_per_tile, count))
+
+
+def _project(camera, x, y, z, buffer_scale):
+
+    shape = x.shape
+    points_camera = camera.object_to_camera_points(
+        np.column_stack((x.ravel(), y.ravel(), z.ravel()))
+    )
+    depth = points_camera[:, 2]
+
+    # points behind the camera or without elevation get nan
+    in_front = depth > 0
+    depth = np.where(in_front, depth, np.nan)
+    image_points = np.full((len(depth), 2), np.nan)
+    image_points[in_front] = camera.camera_to_image_points(
+        points_camera[in_front]
+    ).data
+
+    columns, rows = (image_points * buffer_scale).T
+    return columns.reshape(shape), rows.reshape(shape), depth.reshape(shape)
+
+
+def _depth_step(depth):
+
+    # largest depth difference with the right and lower neighbours
+    step = np.zeros(depth.shape)
+    step[:, :-1] = abs(np.diff(depth, axis=1))
+    step[:-1] = np.fmax(step[:-1], abs(np.diff(depth, axis=0)))
+    return np.nan_to_num(step)
+
+
+def _render_quads(depth_buffer, columns, rows, depth, max_footprint):
+
+    if min(depth.shape) < 2:
+        return
+
+    def corners(array):
+        return np.stack((array[:-1, :-1], array[:-1, 1:],
+                         array[1:, :-1], array[1:, 1:]))
+
+    quad_columns, quad_rows, quad_depth = map(
+        corners, (columns, rows, depth)
+    )
+    with np.errstate(invalid='ignore'):
+        valid = ~np.isnan(quad_depth).any(axis=0)
+    column_min, column_max, row_min, row_max = (
+        np.floor(function(item[:, valid], axis=0)).astype(int)
+        for item, function in ((quad_columns, np.min), (quad_columns, np.max),
+                               (quad_rows, np.min), (quad_rows, np.max))
+    )
+    quad_depth = quad_depth[:, valid].max(axis=0).astype(np.float32)
+
+    # clip to the buffer and drop quads outside it
+    height, width = depth_buffer.shape
+    keep = ((column_max >= 0) & (column_min < width)
+            & (row_max >= 0) & (row_min < height))
+    column_min, column_max = (np.clip(item[keep], 0, width - 1)
+                              for item in (column_min, column_max))
+    row_min, row_max = (np.clip(item[keep], 0, height - 1)
+                        for item in (row_min, row_max))
+    quad_depth = quad_depth[keep]
+
+    widths = column_max - column_min + 1
+    heights = row_max - row_min + 1
+    keep = (widths <= max_footprint) & (heights <= max_footprint)
+
+    # the few quads with a large footprint (steep faces or cells close to
+    # the camera) are rendered one by one
+    for index in np.nonzero(~keep)[0]:
+        window = (slice(row_min[index], row_max[index] + 1),
+                  slice(column_min[index], column_max[index] + 1))
+        np.minimum(depth_buffer[window], quad_depth[index],
+                   out=depth_buffer[window])
+
+    # other quads are grouped by footprint size so each group is one scatter
+    flat_buffer = depth_buffer.ravel()
+    sizes = np.stack((widths[keep], heights[keep]), axis=1)
+    starts = (row_min * width + column_min)[keep]
+    quad_depth = quad_depth[keep]
+    for size in np.unique(sizes, axis=0):
+        group = np.all(sizes == size, axis=1)
+        offsets = (np.arange(size[1]).reshape(-1, 1) * width
+                   + np.arange(size[0]).reshape(1, -1)).ravel()
+        pixels = starts[group].reshape(-1, 1) + offsets
+        np.minimum.at(
+            flat_buffer, pixels.ravel(),
+            np.repeat(quad_depth[group], len(offsets))
+        )
+
+
+class VisibilityCache(object):
+    """ visibility masks cached per camera geometry and topo survey, the
+    cache_size most recently used in memory and optionally all as .npy
+    files in cache_dir """
+
+    def __init__(self, cache_dir=None, cache_size=64):
+
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self._masks = OrderedDict()
+
+    def get(self, geometry_id, survey_key, camera, x, y, z, **kwargs):
+
+        key = (geometry_id, str(survey_key))
+        if key in self._masks:
+            self._masks.move_to_end(key)
+            return self._masks[key]
+
+        file_path = self._file_path(key)
+        if file_path and os.path.exists(file_path):
+            mask = np.load(file_path)
+        else:
+            mask = visibility_mask(camera, x, y, z, **kwargs)
+            if file_path:
+                np.save(file_path, mask)
+
+        self._masks[key] = mask
+        while len(self._masks) > self.cache_size:
+            self._masks.popitem(last=False)
+        return mask
+
+    def clear(self):
+        self._masks.clear()
+
+    def _file_path(self, key):
+        if not self.cache_dir:
+            return None
+        # the readable part can collide after sanitising, the hash of the
+        # full key can not
+        name = '_'.join(str(item) for item in key)
+        name = ''.join(char if char.isalnum() else '_' for char in name)
+        digest = sha1(repr(key).encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f'{name[:64]}_{digest}.npy')
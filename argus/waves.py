@@ -0,0 +1,233 @@
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def intensity(stack):
+    """ (time, point) float32 intensities of a (time, point[, channel])
+    stack, channels are averaged """
+
+    stack = np.asarray(stack)
+    if stack.ndim == 3:
+        return stack.mean(axis=2, dtype=np.float32)
+    return stack.astype(np.float32, copy=False)
+
+
+def transect_pairs(count, spacing=1):
+    """ pairs of points spacing apart along a transect of count points """
+    first = np.arange(count - spacing)
+    return np.column_stack((first, first + spacing))
+
+
+def pair_distances(object_points, pairs):
+    """ horizontal distance between the object points of every pair """
+    object_points = np.asarray(object_points, dtype=float)
+    pairs = np.asarray(pairs)
+    first, second = object_points[pairs[:, 0]], object_points[pairs[:, 1]]
+    return np.hypot(*(second[:, :2] - first[:, :2]).T)
+
+
+class WaveAnalyzer(object):
+    """ Welch spectra of every point of a (time, point) timestack and cross
+    correlations between pairs of points, from which peak periods and
+    celerities follow.
+
+    The record is fed in chunks of any length (e.g. slices of a memory
+    mapped timestack), each chunk is cut into windowed segments that overlap
+    with the previous ones, and only the running sums of the spectra are
+    kept. Memory is therefore bounded by the chunk size and batch_size
+    segments, whatever the length of the record """
+
+    def __init__(self, sampling_frequency, segment_length=256, overlap=0.5,
+                 pairs=None, batch_size=64):
+
+        if not 0 <= overlap < 1:
+            raise ValueError('overlap must be in [0, 1)')
+
+        self.sampling_frequency = float(sampling_frequency)
+        self.segment_length = int(segment_length)
+        self.step = max(1, int(round(self.segment_length * (1 - overlap))))
+        self.batch_size = batch_size
+        self.pairs = None if pairs is None else np.asarray(pairs, dtype=int)
+
+        self.window = np.hanning(self.segment_length + 2)[1:-1]\
+            .astype(np.float32)
+        self.segment_count = 0
+        self._tail = None
+        self._power = None
+        self._cross = None
+        self._energy = None
+
+    @property
+    def frequencies(self):
+        return np.fft.rfftfreq(self.segment_length,
+                               1 / self.sampling_frequency)
+
+    @property
+    def spectra(self):
+        """ (frequency, point) one sided power spectral densities """
+
+        if not self.segment_count:
+            raise ValueError('No complete segment yet')
+        scale = 2 / (self.sampling_frequency * (self.window ** 2).sum())
+        spectra = self._power * (scale / self.segment_count)
+        spectra[0] /= 2
+        if self.segment_length % 2 == 0:
+            spectra[-1] /= 2
+        return spectra
+
+    def update(self, chunk):
+        """ add the next (time, point[, channel]) part of the record """
+
+        chunk = intensity(chunk)
+        if self._tail is not None:
+            chunk = np.concatenate((self._tail, chunk))
+
+        count = 0
+        if len(chunk) >= self.segment_length:
+            count = 1 + (len(chunk) - self.segment_length) // self.step
+
+        # (segment, point, time) views of the chunk, processed in batches
+        segments = sliding_window_view(
+            chunk, self.segment_length, axis=0
+        )[:count * self.step:self.step]
+        for start in range(0, count, self.batch_size):
+            self._add_segments(segments[start:start + self.batch_size])
+
+        self._tail = chunk[count * self.step:].copy()
+        return self
+
+    def _add_segments(self, segments):
+
+        segments = segments - segments.mean(axis=2, keepdims=True)
+        segments *= self.window
+
+        spectra = np.fft.rfft(segments, axis=2)
+        power = (spectra.real ** 2 + spectra.imag ** 2).sum(axis=0).T
+        self._power = power if self._power is None else self._power + power
+
+        if self.pairs is not None:
+            # zero padded so the correlation does not wrap around
+            padded = np.fft.rfft(
+                segments[:, np.unique(self.pairs)], n=2 * self.segment_length,
+                axis=2
+            )
+            index = np.searchsorted(np.unique(self.pairs), self.pairs)
+            cross = (np.conj(padded[:, index[:, 0]])
+                     * padded[:, index[:, 1]]).sum(axis=0)
+            self._cross = cross if self._cross is None else self._cross + cross
+
+            energy = (segments ** 2).sum(axis=(0, 2))
+            self._energy = energy if self._energy is None \
+                else self._energy + energy
+
+        self.segment_count += len(segments)
+
+    def peak_periods(self, min_period=None, max_period=None):
+        """ period (s) of the highest spectral peak of every point, within
+        [min_period, max_period] """
+
+        frequencies = self.frequencies
+        valid = frequencies > 0
+        if max_period:
+            valid &= frequencies >= 1 / max_period
+        if min_period:
+            valid &= frequencies <= 1 / min_period
+
+        spectra = self.spectra[valid]
+        peak = spectra.argmax(axis=0)
+
+        # parabolic interpolation of the peak between frequency bins
+        inner = (peak > 0) & (peak < len(spectra) - 1)
+        offset = np.zeros(len(peak))
+        columns = np.nonzero(inner)[0]
+        left, centre, right = (
+            spectra[peak[inner] + shift, columns] for shift in (-1, 0, 1)
+        )
+        with np.errstate(invalid='ignore', divide='ignore'):
+            offset[inner] = np.nan_to_num(
+                0.5 * (left - right) / (left - 2 * centre + right)
+            )
+        resolution = self.sampling_frequency / self.segment_length
+        peak_frequency = frequencies[valid][peak] + offset * resolution
+        return 1 / peak_frequency
+
+    def mean_periods(self, min_period=None, max_period=None):
+        """ mean period m0 / m1 (s) of every point """
+
+        frequencies = self.frequencies
+        valid = frequencies > 0
+        if max_period:
+            valid &= frequencies >= 1 / max_period
+        if min_period:
+            valid &= frequencies <= 1 / min_period
+
+        spectra = self.spectra[valid]
+        m0 = spectra.sum(axis=0)
+        m1 = (spectra * frequencies[valid, None]).sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return m0 / m1
+
+    def correlations(self, max_lag=None):
+        """ lags (s) and (lag, pair) normalised cross correlations of the
+        pairs. A peak at a positive lag means the second point of a pair
+        follows the first """
+
+        if self._cross is None:
+            raise ValueError('No pairs or no complete segment yet')
+
+        correlation = np.fft.irfft(self._cross, axis=1)
+        correlation = np.fft.fftshift(correlation, axes=1).T
+        lags = np.arange(-self.segment_length, self.segment_length)
+
+        # normalise with the zero lag auto correlations
+        first = self._energy[self.pairs[:, 0]]
+        second = self._energy[self.pairs[:, 1]]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            correlation = correlation / np.sqrt(first * second)
+
+        if max_lag is not None:
+            keep = abs(lags) <= max_lag * self.sampling_frequency
+            lags, correlation = lags[keep], correlation[keep]
+        return lags / self.sampling_frequency, correlation
+
+    def lags(self, max_lag=None):
+        """ lag (s) of the correlation peak of every pair and the
+        correlation at that lag """
+
+        lags, correlation = self.correlations(max_lag)
+        peak = np.nanargmax(np.nan_to_num(correlation, nan=-np.inf), axis=0)
+        columns = np.arange(correlation.shape[1])
+
+        inner = (peak > 0) & (peak < len(lags) - 1)
+        offset = np.zeros(len(peak))
+        left, centre, right = (
+            correlation[peak[inner] + shift, columns[inner]]
+            for shift in (-1, 0, 1)
+        )
+        with np.errstate(invalid='ignore', divide='ignore'):
+            offset[inner] = np.nan_to_num(
+                0.5 * (left - right) / (left - 2 * centre + right)
+            )
+        lag = lags[peak] + offset / self.sampling_frequency
+        return lag, correlation[peak, columns]
+
+    def celerities(self, distances, max_lag=None, min_correlation=0):
+        """ celerity (m/s) of every pair from the distance between its
+        points, nan where the lag is zero or the correlation too low """
+
+        lag, correlation = self.lags(max_lag)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            celerity = np.asarray(distances, dtype=float) / lag
+        celerity[(lag == 0) | ~(correlation >= min_correlation)] = np.nan
+        return celerity
+
+
+def analyze(stack, sampling_frequency, chunk_size=4096, **kwargs):
+    """ WaveAnalyzer fed with a (time, point[, channel]) stack (e.g. a
+    np.memmap) chunk_size time steps at a time """
+
+    analyzer = WaveAnalyzer(sampling_frequency, **kwargs)
+    for start in range(0, len(stack), chunk_size):
+        analyzer.update(stack[start:start + chunk_size])
+    return analyzer
@@ -0,0 +1,358 @@
+"""
+Benchmarks of the argus and zandmotor hot paths on synthetic, offline
+fixtures. Every case reports the best wall time of a few repeats, the
+throughput and the peak (python and numpy) memory of a single run, and is
+compared with the stored baseline:
+
+    python benchmarks/bench_hotpaths.py                  # full run
+    python benchmarks/bench_hotpaths.py --quick -k meteo  # small sizes only
+    python benchmarks/bench_hotpaths.py --save-baseline  # update baseline
+
+The exit status is 1 if a case is slower than the baseline by more than the
+tolerance
+"""
+
+import argparse
+from contextlib import contextmanager
+from datetime import timedelta
+import json
+import os
+import sys
+import tempfile
+from time import perf_counter
+import tracemalloc
+
+import numpy as np
+
+# runnable from a checkout without installing the packages
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from argus import core  # noqa: E402
+from argus.alignment import align  # noqa: E402
+from argus.graph import FrameGraph  # noqa: E402
+from argus.images import _image_request_to_pandas  # noqa: E402
+from argus.projections import Solar  # noqa: E402
+from argus.shoreline import ShorelineDetector  # noqa: E402
+from argus.utils import post_process_usedgcp  # noqa: E402
+from argus.waves import analyze, transect_pairs  # noqa: E402
+from zandmotor import meteo  # noqa: E402
+from zandmotor.topo import GPS  # noqa: E402
+from zandmotor.utils import DATASET_POOL  # noqa: E402
+
+import fixtures  # noqa: E402
+
+
+BASELINE_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'baseline.json'
+)
+
+
+class Case(object):
+    """ a benchmarked function at one problem size. setup returns the
+    function to time (without arguments) and the number of items it
+    processes """
+
+    def __init__(self, name, size, setup, unit):
+        self.name = name
+        self.size = size
+        self.setup = setup
+        self.unit = unit
+
+    @property
+    def key(self):
+        return f'{self.name}[{int(self.size)}]'
+
+
+def object_to_image_points(size, directory):
+    camera = fixtures.synthetic_camera()
+    points = fixtures.object_points(size)
+    return lambda: camera.object_to_image_points(points), size
+
+
+def undistort_image(size, directory):
+    camera = fixtures.synthetic_camera((size, size * 3 // 4))
+    image = fixtures.frame(camera.frame_size)
+    return lambda: camera.undistort_image(image), image.shape[0] * size
+
+
+def image_request_to_pandas(size, directory):
+    catalog = fixtures.image_catalog(size)
+    return lambda: _image_request_to_pandas(catalog), size
+
+
+def cleaned_gcp_table(size, directory):
+    fixtures.write_tables(directory, size)
+    return lambda: _cleaned_table(directory, 'gcp'), size
+
+
+def cleaned_usedgcp_table(size, directory):
+    fixtures.write_tables(directory, size)
+    return lambda: _cleaned_table(directory, 'usedgcp'), size
+
+
+def usedgcp_post_process(size, directory):
+    fixtures.write_tables(directory, size)
+    with open(os.path.join(directory, 'usedgcp.json')) as file:
+        table = [dict(item, pk=item['seq']) for item in json.load(file)]
+
+    # the table is processed in place, so every run gets a fresh copy
+    return lambda: post_process_usedgcp([dict(item) for item in table]), size
+
+
+def gps_interpolate_data(size, directory):
+    lon, lat, elev = fixtures.synthetic_survey(n_points=size)
+    spacing = 5
+
+    def function():
+        return GPS.interpolate_data(
+            lon, lat, elev, lon_spacing=spacing, lat_spacing=spacing
+        )
+    return function, (5e3 / spacing) * (5e3 / spacing)
+
+
+def sun_position(size, directory):
+    solar = Solar(4.2, 52.05)
+    datetimes = fixtures.datetimes(size)
+
+    def function():
+        return [solar.sun_position(item) for item in datetimes]
+    return function, size
+
+
+def get_meteo(size, directory):
+    file_path = os.path.join(directory, 'meteo.nc')
+    if not os.path.exists(file_path):
+        fixtures.write_meteo(file_path, 2 * 365 * 24 * 60)
+
+    time_start = fixtures.START
+    time_end = time_start + timedelta(days=size)
+    variables = ['WindDir_Avg', 'WindSpeed_Avg', 'AirTemp_Avg']
+
+    def function():
+        return meteo.get_meteo(time_start, time_end, variables, file_path)
+    return function, size * 24 * 60
+
+
+def wave_spectra(size, directory):
+    stack = fixtures.timestack(4096, size)
+    pairs = transect_pairs(int(size), 5)
+
+    def function():
+        analyzer = analyze(stack, 2., chunk_size=1024, pairs=pairs)
+        return analyzer.peak_periods(), analyzer.lags(max_lag=10)
+    return function, stack.size
+
+
+def detect_shorelines(size, directory):
+    images = fixtures.plan_views(size)
+    detector = ShorelineDetector(np.arange(images.shape[2]),
+                                 np.arange(images.shape[1]))
+    return lambda: detector.detect(images), size
+
+
+def align_catalog(size, directory):
+    file_path = os.path.join(directory, 'meteo.nc')
+    if not os.path.exists(file_path):
+        fixtures.write_meteo(file_path, 2 * 365 * 24 * 60)
+
+    meteo_data = meteo.get_meteo(
+        fixtures.START, fixtures.START + timedelta(days=365),
+        ['WindDir_Avg', 'WindSpeed_Avg', 'AirTemp_Avg'], file_path
+    )
+    catalog = _image_request_to_pandas(fixtures.image_catalog(size))
+
+    def function():
+        return align(catalog, meteo_data, method='linear')
+    return function, len(catalog)
+
+
+def graph_reduce(size, directory):
+    camera = fixtures.synthetic_camera()
+    frames = [fixtures.frame(seed=seed) for seed in range(4)]
+    graph = FrameGraph(
+        {1: [(index, frames[index % 4]) for index in range(int(size))]},
+        {1: camera}
+    ).undistort().rectify(np.arange(-300, 300), np.arange(20, 800)).to_float()
+
+    def function():
+        return graph.reduce(('mean', 'std'))
+    return function, size
+
+
+# name: (setup, unit, sizes, quick sizes)
+BENCHMARKS = {
+    'object_to_image_points': (
+        object_to_image_points, 'points', (1e4, 1e5, 1e6, 1e7), (1e4, 1e5)
+    ),
+    'undistort_image': (
+        undistort_image, 'pixels', (640, 1280, 2560), (640,)
+    ),
+    'image_request_to_pandas': (
+        image_request_to_pandas, 'entries', (1e3, 5e3), (1e3,)
+    ),
+    'get_cleaned_table_gcp': (
+        cleaned_gcp_table, 'rows', (1e4, 1e5), (1e4,)
+    ),
+    'get_cleaned_table_usedgcp': (
+        cleaned_usedgcp_table, 'rows', (2e3, 1e4), (2e3,)
+    ),
+    'post_process_usedgcp': (
+        usedgcp_post_process, 'rows', (2e3, 1e4), (2e3,)
+    ),
+    'gps_interpolate_data': (
+        gps_interpolate_data, 'cells', (1e4, 1e5), (1e4,)
+    ),
+    'sun_position': (
+        sun_position, 'positions', (1e3, 1e4), (1e3,)
+    ),
+    'get_meteo': (
+        get_meteo, 'records', (1, 30, 365), (1, 30)
+    ),
+    'align_catalog': (
+        align_catalog, 'epochs', (1e3, 5e3), (1e3,)
+    ),
+    'graph_reduce': (
+        graph_reduce, 'frames', (8, 32), (8,)
+    ),
+    'detect_shorelines': (
+        detect_shorelines, 'plan views', (4, 32), (4,)
+    ),
+    'wave_spectra': (
+        wave_spectra, 'samples', (1e2, 1e3), (1e2,)
+    ),
+}
+
+
+@contextmanager
+def table_dir(directory):
+    # get_cleaned_table only reads from the local table directory
+    original, core.TABLE_DIR = core.TABLE_DIR, directory
+    try:
+        yield
+    finally:
+        core.TABLE_DIR = original
+
+
+def _cleaned_table(directory, table_name):
+    with table_dir(directory):
+        return core.get_cleaned_table(table_name)
+
+
+def measure(function, repeat=3):
+    """ best wall time of repeat runs and peak traced memory of one run """
+
+    durations = []
+    for _ in range(repeat):
+        start = perf_counter()
+        function()
+        durations.append(perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return min(durations), peak
+
+
+def cases(names=None, quick=False):
+    for name, (setup, unit, sizes, quick_sizes) in BENCHMARKS.items():
+        if names and not any(item in name for item in names):
+            continue
+        for size in (quick_sizes if quick else sizes):
+            yield Case(name, size, setup, unit)
+
+
+def run(cases, repeat=3):
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for case in cases:
+            function, items = case.setup(int(case.size), directory)
+            seconds, peak = measure(function, repeat=repeat)
+            results[case.key] = {
+                'seconds': seconds,
+                'throughput': items / seconds,
+                'unit': case.unit,
+                'peak_mb': peak / 2**20
+            }
+            print(format_result(case.key, results[case.key]), flush=True)
+        DATASET_POOL.close_all()
+    return results
+
+
+def format_result(key, result, baseline=None):
+
+    line = (f"{key:<36}{result['seconds']:10.4f} s"
+            f"{result['throughput']:12.3g} {result['unit'] + '/s':<12}"
+            f"{result['peak_mb']:8.1f} MB")
+    if baseline:
+        line += f"{result['seconds'] / baseline['seconds']:8.2f}x"
+    return line
+
+
+def compare(results, baseline, tolerance=1.5):
+    """ print the results relative to the baseline, returns the keys of the
+    cases that are slower than tolerance times the baseline """
+
+    regressions = []
+    print(f"\n{'case':<36}{'time':>12}{'throughput':>14}{'peak':>19}"
+          f"{'ratio':>10}")
+    for key, result in results.items():
+        reference = baseline.get(key)
+        line = format_result(key, result, reference)
+        if reference is None:
+            line += '     new'
+        elif result['seconds'] > tolerance * reference['seconds']:
+            line += '  slower'
+            regressions.append(key)
+        elif result['seconds'] * tolerance < reference['seconds']:
+            line += '  faster'
+        print(line)
+    return regressions
+
+
+def load_baseline(file_path=BASELINE_FILE):
+    if not os.path.exists(file_path):
+        return {}
+    with open(file_path) as file:
+        return json.load(file)
+
+
+def save_baseline(results, file_path=BASELINE_FILE):
+
+    # update, so a partial run only replaces the cases it ran
+    baseline = load_baseline(file_path)
+    baseline.update(results)
+    with open(file_path, 'w') as file:
+        json.dump(baseline, file, indent=4, sort_keys=True)
+        file.write('\n')
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-k', dest='names', action='append',
+                        help='only run benchmarks containing this string')
+    parser.add_argument('--quick', action='store_true',
+                        help='only the small problem sizes')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--tolerance', type=float, default=1.5)
+    parser.add_argument('--save-baseline', action='store_true')
+    args = parser.parse_args(argv)
+
+    results = run(cases(args.names, args.quick), repeat=args.repeat)
+    if args.save_baseline:
+        save_baseline(results, args.baseline)
+        return 0
+
+    regressions = compare(results, load_baseline(args.baseline),
+                          tolerance=args.tolerance)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,107 @@
+"""
+Import time of the argus and zandmotor modules, each measured in a fresh
+interpreter. A module fails if it takes longer than its budget or if
+importing it loads one of the heavy dependencies, which should only be
+imported at first use:
+
+    python benchmarks/bench_import.py
+
+The exit status is 1 if a module fails
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# cv2 is not listed: camera, mosaic, graph and the pipeline workers need it
+# at import (only images loads it lazily). ephem is not listed either: Solar
+# subclasses ephem.Observer and ephem imports in about 2 ms
+HEAVY_MODULES = ('pandas', 'scipy', 'sqlalchemy', 'requests')
+
+# budget in seconds, numpy and cv2 alone take about 0.1 s
+BUDGETS = {
+    'argus.alignment': 0.1,
+    'argus.camera': 0.3,
+    'argus.graph': 0.3,
+    'argus.core': 0.1,
+    'argus.diagnostics': 0.3,
+    'argus.frames': 0.3,
+    'argus.images': 0.1,
+    'argus.instrumentation': 0.1,
+    'argus.mosaic': 0.3,
+    'argus.pipeline': 0.3,
+    'argus.projections': 0.3,
+    'argus.pyramid': 0.3,
+    'argus.shoreline': 0.3,
+    'argus.timestack': 0.3,
+    'argus.tracking': 0.3,
+    'argus.visibility': 0.3,
+    'argus.waves': 0.3,
+    'zandmotor.cube': 0.4,
+    'zandmotor.interpolation': 0.3,
+    'zandmotor.meteo': 0.4,
+    'zandmotor.mirror': 0.4,
+    'zandmotor.topo': 0.4,
+    'zandmotor.utils': 0.4,
+}
+
+SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+print(json.dumps({{
+    'seconds': time.perf_counter() - start,
+    'heavy': [name for name in {heavy!r} if name in sys.modules]
+}}))
+"""
+
+
+def import_time(module, repeat=3):
+    """ best import time of a module in repeat fresh interpreters and the
+    heavy modules it loaded """
+
+    environment = dict(os.environ)
+    environment['PYTHONPATH'] = os.pathsep.join(
+        filter(None, (REPO_DIR, environment.get('PYTHONPATH')))
+    )
+    results = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, '-c',
+             SCRIPT.format(module=module, heavy=HEAVY_MODULES)],
+            check=True, capture_output=True, text=True, env=environment
+        ).stdout
+        results.append(json.loads(output.splitlines()[-1]))
+    return (min(result['seconds'] for result in results),
+            results[0]['heavy'])
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('modules', nargs='*', default=sorted(BUDGETS))
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    failures = []
+    for module in args.modules:
+        seconds, heavy = import_time(module, repeat=args.repeat)
+        budget = BUDGETS.get(module, 0.5)
+        line = f'{module:<28}{seconds:8.3f} s  (budget {budget:.1f} s)'
+        if seconds > budget:
+            line += '  over budget'
+        if heavy:
+            line += f"  loads {', '.join(heavy)}"
+        if seconds > budget or heavy:
+            failures.append(module)
+        print(line, flush=True)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,49 @@
+"""
+Compare gridding a synthetic GPS survey with scipy.interpolate.griddata (what
+GPS.interpolate_data used to do) with the reusable SurveyInterpolator
+"""
+
+from time import perf_counter
+
+import numpy as np
+from scipy.interpolate import griddata
+
+from zandmotor.interpolation import SurveyInterpolator, interpolate_surveys
+
+from fixtures import synthetic_survey
+
+
+def timed(function, *args, **kwargs):
+    start = perf_counter()
+    output = function(*args, **kwargs)
+    return output, perf_counter() - start
+
+
+def main(n_surveys=4, spacing=2):
+
+    lon_array = np.arange(7e4, 7.5e4, spacing)
+    lat_array = np.arange(4.5e5, 4.55e5, spacing)
+    surveys = [synthetic_survey(seed=seed) for seed in range(n_surveys)]
+
+    lon, lat, elev = surveys[0]
+    xx, yy = np.meshgrid(lon_array, lat_array)
+    reference, duration = timed(griddata, (lon, lat), elev, (xx, yy))
+    print(f'griddata:                {duration:8.3f} s')
+
+    interpolator = SurveyInterpolator(lon, lat, elev)
+    values, duration = timed(interpolator, lon_array, lat_array)
+    print(f'SurveyInterpolator:      {duration:8.3f} s')
+    print(f'  max abs difference:    {np.nanmax(abs(values - reference)):.2e}')
+
+    # the triangulation is reused when a second grid is evaluated
+    _, duration = timed(interpolator, lon_array[::2], lat_array[::2])
+    print(f'  reuse on a new grid:   {duration:8.3f} s')
+
+    _, duration = timed(
+        interpolate_surveys, surveys, lon_array, lat_array, max_distance=50
+    )
+    print(f'{n_surveys} surveys in parallel:  {duration:8.3f} s')
+
+
+if __name__ == '__main__':
+    main()
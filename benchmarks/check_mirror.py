@@ -0,0 +1,141 @@
+"""
+Check that reads through a DatasetMirror equal direct reads of a local
+netCDF stand-in for the zandmotor datasets, before and after records are
+appended to the source and the mirror is refreshed. The time lengths are
+not multiples of the time chunk, so the trailing partial chunk is covered:
+
+    python benchmarks/check_mirror.py
+
+The exit status is 1 if any read differs
+"""
+
+import os
+import sys
+import tempfile
+
+import netCDF4
+import numpy as np
+
+# runnable from a checkout without installing the packages
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from zandmotor import meteo  # noqa: E402
+from zandmotor.mirror import DatasetMirror  # noqa: E402
+from zandmotor.utils import DATASET_POOL  # noqa: E402
+
+import fixtures  # noqa: E402
+
+
+TIME_CHUNK = 64
+
+SPACE_CHUNK = 32
+
+# indices read from every variable, spanning chunk boundaries
+KEYS = [
+    Ellipsis,
+    slice(TIME_CHUNK - 5, 2 * TIME_CHUNK + 3),
+    slice(None, None, 7),
+    -1,
+    [0, TIME_CHUNK, -2],
+]
+
+SPACE_KEYS = [
+    (slice(None), slice(SPACE_CHUNK - 3, SPACE_CHUNK + 4), slice(10, 70)),
+    (-1, slice(None, None, 5), 40),
+]
+
+
+def same(expected, actual):
+    """ equal values and masks, as np.ma.allequal ignores masked values """
+
+    expected, actual = np.ma.asarray(expected), np.ma.asarray(actual)
+    return (expected.shape == actual.shape
+            and np.array_equal(np.ma.getmaskarray(expected),
+                               np.ma.getmaskarray(actual))
+            and np.ma.allequal(expected, actual))
+
+
+def compare(file_path, mirror, stage):
+    """ names of the reads where the mirror differs from the source """
+
+    failures = []
+    with netCDF4.Dataset(file_path) as dataset:
+        for name in dataset.variables:
+            variable = dataset[name]
+            keys = KEYS + (SPACE_KEYS if variable.ndim == 3 else [])
+            if variable.dimensions[0] != 'time':
+                keys = [Ellipsis]
+            for key in keys:
+                if not same(variable[key], mirror[name][key]):
+                    failures.append(f'{stage}: {name}[{key}]')
+    return failures
+
+
+def check(file_path, mirror_dir, append, count, appended):
+
+    failures = []
+    mirror = DatasetMirror(file_path, mirror_dir, time_chunk=TIME_CHUNK,
+                           space_chunk=SPACE_CHUNK)
+    failures += compare(file_path, mirror, f'{count} records')
+
+    # the chunks are now on disk, so this compares the stored copies
+    failures += compare(file_path, mirror, f'{count} records, cached')
+
+    DATASET_POOL.close_all()
+    append(file_path, appended)
+    mirror.refresh()
+    failures += compare(file_path, mirror,
+                        f'{count + appended} records, refreshed')
+    return failures
+
+
+def check_time_axis(file_path, mirror_dir, count, appended):
+    """ get_time_axis through the (shared) mirror before and after an
+    append, like a long running process polling the meteo file """
+
+    failures = []
+    for stage in (count, count + appended):
+        if stage > count:
+            DATASET_POOL.close_all()
+            fixtures.append_meteo(file_path, appended)
+        timestamps, _ = meteo.get_time_axis(
+            file_path, refresh=stage > count, mirror=mirror_dir
+        )
+        with netCDF4.Dataset(file_path) as dataset:
+            if not same(dataset['time'][:], timestamps):
+                failures.append(f'{stage} records: get_time_axis')
+    meteo.clear_time_axes()
+    return failures
+
+
+def main(count=1000, appended=300):
+
+    failures = []
+    with tempfile.TemporaryDirectory() as directory:
+        mirror_dir = os.path.join(directory, 'mirror')
+
+        file_path = os.path.join(directory, 'meteo.nc')
+        fixtures.write_meteo(file_path, count)
+        failures += check(file_path, mirror_dir, fixtures.append_meteo,
+                          count, appended)
+
+        file_path = os.path.join(directory, 'lidar.nc')
+        fixtures.write_lidar(file_path, 3 * TIME_CHUNK // 2)
+        failures += check(file_path, mirror_dir, fixtures.append_lidar,
+                          3 * TIME_CHUNK // 2, TIME_CHUNK + 7)
+
+        file_path = os.path.join(directory, 'meteo_axis.nc')
+        fixtures.write_meteo(file_path, count)
+        failures += check_time_axis(file_path, mirror_dir, count, appended)
+
+        DATASET_POOL.close_all()
+
+    for failure in failures:
+        print(f'mirror differs from source, {failure}')
+    print('ok' if not failures else f'{len(failures)} reads differ')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,225 @@
+"""
+Synthetic, offline fixtures for the benchmarks. Everything is generated from
+a seed so repeated runs (and the stored baseline) see the same data
+"""
+
+from calendar import timegm
+from datetime import datetime, timedelta
+import json
+import os
+
+import netCDF4
+import numpy as np
+
+from argus.camera import Camera
+
+
+FRAME_SIZE = (1280, 960)
+
+IMAGE_TYPES = ['snap', 'timex', 'min', 'max', 'var']
+
+START = datetime(2014, 1, 1)
+
+
+def synthetic_camera(frame_size=FRAME_SIZE):
+    """ rectified camera 40 m above the origin looking out to sea """
+
+    width, height = frame_size
+    camera_matrix = np.array([
+        [1.1 * width, 0, width / 2],
+        [0, 1.1 * width, height / 2],
+        [0, 0, 1]
+    ])
+    dist_coefs = np.array([-0.2, 0.05, 0, 0, 0.01, 0, 0, 0])
+    camera = Camera(camera_matrix, dist_coefs, frame_size)
+
+    tilt = np.deg2rad(70)
+    camera.rotation_matrix = np.array([
+        [1, 0, 0],
+        [0, -np.cos(tilt), -np.sin(tilt)],
+        [0, np.sin(tilt), -np.cos(tilt)]
+    ])
+    camera.translation_vector = -camera.rotation_matrix @ np.array(
+        [[0], [0], [40]]
+    )
+    return camera
+
+
+def object_points(count, seed=0):
+    """ points on the beach in front of the synthetic camera """
+
+    random = np.random.RandomState(seed)
+    points = np.empty((int(count), 3))
+    points[:, 0] = random.uniform(-300, 300, len(points))
+    points[:, 1] = random.uniform(20, 800, len(points))
+    points[:, 2] = random.normal(0, 1, len(points))
+    return points
+
+
+def synthetic_survey(n_points=20000, seed=0):
+    """ zig zag GPS survey tracks over the default interpolation box """
+
+    random = np.random.RandomState(seed)
+    track = np.linspace(0, 1, n_points)
+    lon = 7e4 + 5e3 * track
+    lat = 4.5e5 + 2.5e3 * (1 + np.sin(40 * np.pi * track))
+    lon += random.normal(0, 5, n_points)
+    lat += random.normal(0, 5, n_points)
+    elev = -(lat - 4.5e5) / 500 + random.normal(0, 0.1, n_points)
+    return lon, lat, elev
+
+
+def frame(frame_size=FRAME_SIZE, seed=0):
+    random = np.random.RandomState(seed)
+    return random.randint(
+        0, 256, (frame_size[1], frame_size[0], 3), dtype=np.uint8
+    )
+
+
+def image_catalog(count, cameras=4, seed=0):
+    """ entries as returned by the image catalog: every half hour one image
+    of each type for each camera, with a few minutes of jitter """
+
+    random = np.random.RandomState(seed)
+    start = timegm(START.timetuple())
+    per_slot = cameras * len(IMAGE_TYPES)
+    slots = -(-int(count) // per_slot)
+
+    catalog = []
+    for slot in range(slots):
+        for camera in range(cameras):
+            for image_type in IMAGE_TYPES:
+                epoch = start + slot * 1800 + int(random.randint(-240, 240))
+                name = f'{epoch}.c{camera + 1}.{image_type}.jpg'
+                catalog.append({
+                    'epoch': epoch,
+                    'camera': f'c{camera + 1}',
+                    'type': image_type,
+                    'path': f'/zandmotor/{name}'
+                })
+    return catalog[:int(count)]
+
+
+def write_tables(directory, count, duplicate_fraction=0.05, seed=0):
+    """ gcp and usedgcp tables in the format of the argus api, the usedgcp
+    table with a fraction of duplicate sequence numbers """
+
+    random = np.random.RandomState(seed)
+    os.makedirs(directory, exist_ok=True)
+    count = int(count)
+
+    gcp = [{
+        'seq': index, 'id': f'ZMXX{index:04d}', 'siteID': 'ZMXX',
+        'name': f'gcp {index}', 'x': float(random.uniform(-300, 300)),
+        'y': float(random.uniform(0, 800)), 'z': float(random.normal()),
+        'timeIN': 1300000000 + index, 'timeOUT': 0 if index % 2 else -1
+    } for index in range(count)]
+
+    sequence = np.arange(count)
+    duplicates = random.rand(count) < duplicate_fraction
+    sequence[duplicates] = random.randint(0, count, duplicates.sum())
+    used_gcp = [{
+        'seq': int(seq), 'U': float(random.uniform(0, FRAME_SIZE[0])),
+        'V': float(random.uniform(0, FRAME_SIZE[1])),
+        'gcpID': f'ZMXX{int(random.randint(count)):04d}',
+        'geometrySequence': int(seq // 10)
+    } for seq in sequence]
+
+    for name, table in (('gcp', gcp), ('usedgcp', used_gcp)):
+        with open(os.path.join(directory, f'{name}.json'), 'w') as file:
+            json.dump(table, file)
+
+
+def datetimes(count, step=timedelta(minutes=10)):
+    return [START + index * step for index in range(int(count))]
+
+
+def write_meteo(file_path, count, seed=0):
+    """ meteo netCDF file like the zandmotor one, one record per minute """
+
+    random = np.random.RandomState(seed)
+    count = int(count)
+    with netCDF4.Dataset(file_path, 'w') as dataset:
+        dataset.createDimension('time', None)
+        time = dataset.createVariable('time', 'f8', ('time',))
+        time[:] = timegm(START.timetuple()) + 60 * np.arange(count)
+        for name, scale in (('WindDir_Avg', 360), ('WindSpeed_Avg', 15),
+                            ('AirTemp_Avg', 20)):
+            variable = dataset.createVariable(name, 'f4', ('time',))
+            variable[:] = random.rand(count) * scale
+
+
+def append_meteo(file_path, count, seed=0):
+    """ append count records to a file written by write_meteo """
+
+    with netCDF4.Dataset(file_path, 'a') as dataset:
+        time = dataset['time']
+        start = len(time)
+        random = np.random.RandomState([seed, start])
+        time[start:] = time[start - 1] + 60 * np.arange(1, int(count) + 1)
+        for name, scale in (('WindDir_Avg', 360), ('WindSpeed_Avg', 15),
+                            ('AirTemp_Avg', 20)):
+            dataset[name][start:] = random.rand(int(count)) * scale
+
+
+def write_lidar(file_path, count, shape=(120, 90), seed=0):
+    """ lidar netCDF file like the zandmotor one, (time, y, x) elevation
+    with a fill value outside a diagonal band """
+
+    rows, columns = shape
+    with netCDF4.Dataset(file_path, 'w') as dataset:
+        dataset.createDimension('time', None)
+        dataset.createDimension('y', rows)
+        dataset.createDimension('x', columns)
+        dataset.createVariable('time', 'f8', ('time',))
+        dataset.createVariable('x', 'f8', ('x',))[:] = \
+            7e4 + 5 * np.arange(columns)
+        dataset.createVariable('y', 'f8', ('y',))[:] = \
+            4.55e5 - 5 * np.arange(rows)
+        dataset.createVariable('z', 'f4', ('time', 'y', 'x'),
+                               fill_value=-999.)
+    append_lidar(file_path, count, seed=seed)
+
+
+def append_lidar(file_path, count, seed=0):
+    """ append count surveys to a file written by write_lidar """
+
+    with netCDF4.Dataset(file_path, 'a') as dataset:
+        start = len(dataset['time'])
+        random = np.random.RandomState([seed, start])
+        _, rows, columns = dataset['z'].shape
+        times = start + np.arange(int(count))
+        dataset['time'][start:] = 16000 + 30 * times
+        elev = random.normal(0, 2, (len(times), rows, columns))
+        band = abs(np.arange(rows)[:, None] - np.arange(columns)) < rows / 3
+        dataset['z'][start:] = np.ma.masked_array(
+            elev, mask=np.broadcast_to(~band, elev.shape)
+        )
+
+
+def timestack(length, points, period=8., celerity=5., spacing=2.,
+              sampling_frequency=2., seed=0):
+    """ (time, point) uint8 timestack of a monochromatic wave travelling
+    along a transect of points spacing metres apart, with noise """
+
+    random = np.random.RandomState(seed)
+    time = np.arange(int(length)) / sampling_frequency
+    distance = spacing * np.arange(int(points))
+    phase = 2 * np.pi * (time[:, None] - distance / celerity) / period
+    stack = 100 + 40 * np.sin(phase) + random.normal(0, 10, phase.shape)
+    return np.clip(stack, 0, 255).astype(np.uint8)
+
+
+def plan_views(count, shape=(500, 600), seed=0):
+    """ (count, y, x, 3) float32 RGB plan views of sand and water divided
+    by a wavy shoreline that moves seaward over time """
+
+    random = np.random.RandomState(seed)
+    rows, columns = shape
+    shoreline = (columns / 2 + columns / 10 * np.sin(np.arange(rows) / 40)
+                 + np.arange(int(count))[:, None])
+    land = np.arange(columns) < shoreline[..., None]
+    images = np.where(land[..., None], np.float32([0.8, 0.7, 0.5]),
+                      np.float32([0.2, 0.4, 0.6]))
+    images += random.normal(0, 0.08, images.shape)
+    return images.clip(0, 1).astype(np.float32)
@@ -1,14 +1,13 @@
 
 from datetime import datetime
 import matplotlib.pyplot as plt
-import numpy as np
 
 from argus.core import create_session
 from argus.models import Site
 from argus.projections import Rotation
 
 from zandmotor.topo import GPS
-from zandmotor.meteo import get_meteo, average_angles
+from zandmotor.meteo import get_meteo, resample_angles
 
 
 time_start = datetime(2014, 1, 1)
@@ -31,12 +30,7 @@ lon, lat, elev = gps_class.interpolate_data(
 )
 
 # rotate topo survey to argus coordinate system as present
-lon_grid, lat_grid = np.meshgrid(lon, lat)
-coords = rotation.local_to_argus(
-    np.column_stack((lon_grid.flatten(), lat_grid.flatten()))
-)
-x_grid = coords[:, 0].reshape(lat_grid.shape)
-y_grid = coords[:, 1].reshape(lon_grid.shape)
+x_grid, y_grid = rotation.grid_to_argus(lon, lat)
 
 
 plt.figure()
@@ -47,8 +41,9 @@ plt.pcolormesh(y_grid, x_grid, elev)
 df_meteo = get_meteo(time_start, time_end, variables=('WindDir_Avg',))
 
 # resample
-df_resampled = df_meteo.resample('1H', label='right', closed='right')\
-           .agg(average_angles)
+df_resampled = resample_angles(
+    df_meteo, '1h', columns='WindDir_Avg', label='right', closed='right'
+)
 
 plt.figure()
 plt.plot(df_meteo, 'k', alpha=0.3)
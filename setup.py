@@ -21,4 +21,9 @@ setup(
        'requests',
        'scipy',
        ],  # external packages as dependencies
+   entry_points={
+       'console_scripts': [
+           'argus-pipeline=argus.pipeline:main',
+       ],
+   },
 )
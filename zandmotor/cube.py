@@ -0,0 +1,337 @@
+
+import json
+import os
+
+import numpy as np
+
+from argus.lazy import lazy_import
+from argus.projections import Rotation
+
+from .interpolation import SurveyInterpolator
+from .utils import to_datetime64
+
+
+# loaded at first use to keep imports fast
+interpolate = lazy_import('scipy.interpolate')
+
+METADATA_NAME = 'cube.json'
+
+DATA_NAME = 'cube.f32'
+
+TILE_NAME = 'tile_{}_{}.f32'
+
+
+class ElevationCube(object):
+    """ elevation of many surveys on one regular grid in Argus coordinates,
+    stored on disk in square spatial tiles of chunk_size cells, each a
+    memory mapped (t, y, x) float32 array. Surveys are appended one time
+    slice at a time to every tile, so a point series only touches the tiles
+    around the points. Queries interpolate bilinearly in space (ignoring
+    missing neighbours) and linearly in time """
+
+    def __init__(self, directory, x=None, y=None, rotation=None,
+                 chunk_size=128):
+
+        self.directory = directory
+        metadata_path = os.path.join(directory, METADATA_NAME)
+
+        if os.path.exists(metadata_path):
+            with open(metadata_path, 'r') as file:
+                self.metadata = json.load(file)
+        elif x is None or y is None or rotation is None:
+            raise ValueError('x, y and rotation are required for a new cube')
+        else:
+            os.makedirs(directory, exist_ok=True)
+            self.metadata = {
+                'x': np.asarray(x, dtype=float).tolist(),
+                'y': np.asarray(y, dtype=float).tolist(),
+                'rotation': [rotation.lat, rotation.lon,
+                             rotation.rotation_angle, rotation.elev],
+                'chunk_size': int(chunk_size),
+                'times': [],
+                'sources': []
+            }
+            for tile in self.tiles:
+                open(self.tile_path(*tile), 'wb').close()
+            self._save_metadata()
+
+        self.x = np.asarray(self.metadata['x'])
+        self.y = np.asarray(self.metadata['y'])
+        if np.any(np.diff(self.x) <= 0) or np.any(np.diff(self.y) <= 0):
+            raise ValueError('Grid axes must be increasing')
+        self.rotation = Rotation(*self.metadata['rotation'])
+        self._tiles = {}
+        self._local_grid = None
+
+    @property
+    def chunk_size(self):
+        # cubes without a chunk size are a single tile in DATA_NAME
+        return self.metadata.get('chunk_size') \
+            or max(len(self.metadata['x']), len(self.metadata['y']))
+
+    @property
+    def tiles(self):
+        """ (row, column) indices of the spatial tiles """
+        rows, columns = (-(-len(self.metadata[axis]) // self.chunk_size)
+                         for axis in ('y', 'x'))
+        return [(row, column) for row in range(rows)
+                for column in range(columns)]
+
+    def tile_path(self, row, column):
+        if 'chunk_size' not in self.metadata:
+            return os.path.join(self.directory, DATA_NAME)
+        return os.path.join(self.directory, TILE_NAME.format(row, column))
+
+    @property
+    def shape(self):
+        return (len(self.metadata['times']), len(self.y), len(self.x))
+
+    @property
+    def times(self):
+        return np.array(self.metadata['times'], dtype='datetime64[ms]')
+
+    @property
+    def sources(self):
+        return [tuple(source) if source else None
+                for source in self.metadata['sources']]
+
+    def tile(self, row, column):
+        """ memory mapped (t, y, x) elevation of a spatial tile """
+
+        if (row, column) not in self._tiles:
+            size = self.chunk_size
+            shape = (self.shape[0],
+                     len(self.y[row * size:(row + 1) * size]),
+                     len(self.x[column * size:(column + 1) * size]))
+            self._tiles[row, column] = np.memmap(
+                self.tile_path(row, column), dtype='<f4', mode='r',
+                shape=shape
+            )
+        return self._tiles[row, column]
+
+    @property
+    def local_grid(self):
+        """ local (e.g. RD) coordinates of every cell of the cube """
+        if self._local_grid is None:
+            self._local_grid = self.rotation.grid_to_local(self.x, self.y)
+        return self._local_grid
+
+    def append(self, elev, time, source=None):
+
+        elev = np.ma.filled(np.ma.asarray(elev, dtype='<f4'), np.nan)
+        if elev.shape != self.shape[1:]:
+            raise ValueError(f'Elevation must have shape {self.shape[1:]}')
+
+        size = self.chunk_size
+        for row, column in self.tiles:
+            with open(self.tile_path(row, column), 'ab') as file:
+                file.write(elev[row * size:(row + 1) * size,
+                                column * size:(column + 1) * size].tobytes())
+
+        self.metadata['times'].append(
+            int(to_datetime64(time).astype('int64'))
+        )
+        self.metadata['sources'].append(list(source) if source else None)
+        self._save_metadata()
+        self._tiles = {}
+
+    def add_lidar(self, lidar, index):
+
+        lon, lat = self.local_grid
+        lon_lat_lims = [(np.nanmin(item), np.nanmax(item))
+                        for item in (lon, lat)]
+        lon_axis, lat_axis, elev = lidar.load_topo_from_index(
+            index, lon_lims=lon_lat_lims[0], lat_lims=lon_lat_lims[1]
+        )
+
+        values = np.full(self.shape[1:], np.nan, dtype='f4')
+        if len(lon_axis) > 1 and len(lat_axis) > 1:
+            elev = np.ma.filled(np.ma.asarray(elev, dtype=float), np.nan)
+
+            # the interpolator wants ascending axes
+            if lon_axis[0] > lon_axis[-1]:
+                lon_axis, elev = lon_axis[::-1], elev[:, ::-1]
+            if lat_axis[0] > lat_axis[-1]:
+                lat_axis, elev = lat_axis[::-1], elev[::-1]
+
+            interpolator = interpolate.RegularGridInterpolator(
+                (lat_axis, lon_axis), elev, bounds_error=False,
+                fill_value=np.nan
+            )
+            values[:] = interpolator(np.stack((lat, lon), axis=-1))
+
+        self.append(values, lidar.timestamps[index],
+                    source=(lidar.file_path, int(index)))
+
+    def add_gps(self, gps, index, max_distance=None):
+
+        lon, lat = self.local_grid
+        values = np.full(self.shape[1:], np.nan, dtype='f4')
+
+        survey = gps.load_topo_from_index(index)
+        if len(survey[0]) >= 3:
+            interpolator = SurveyInterpolator(
+                *survey, max_distance=max_distance
+            )
+            values[:] = interpolator.evaluate(lon, lat)
+
+        self.append(values, gps.timestamps[index],
+                    source=(gps.file_path, int(index)))
+
+    def build(self, lidar=None, gps=None, max_distance=None):
+        """ add every survey of the given Lidar and GPS instances that is not
+        in the cube yet, so rerunning only appends new surveys """
+
+        present = set(self.sources)
+        for survey, add in ((lidar, self.add_lidar), (gps, self.add_gps)):
+            if survey is None:
+                continue
+            for index in range(len(survey.timestamps)):
+                if (survey.file_path, index) in present:
+                    continue
+                if survey is gps:
+                    add(survey, index, max_distance=max_distance)
+                else:
+                    add(survey, index)
+
+    def sample(self, x, y, times):
+        """ elevation at arrays of (x, y, t) points in Argus coordinates """
+
+        x, y, times = np.broadcast_arrays(
+            np.asarray(x, dtype=float), np.asarray(y, dtype=float),
+            to_datetime64(times)
+        )
+        output = np.full(x.shape, np.nan)
+        if not self.shape[0]:
+            return output
+
+        lower, upper, weight = self._time_weights(times.ravel())
+        valid = ~np.isnan(weight)
+
+        x, y, weight = x.ravel()[valid], y.ravel()[valid], weight[valid]
+        lower_values = self._sample_space(lower[valid], x, y)
+        upper_values = self._sample_space(upper[valid], x, y)
+
+        # at the survey times themselves gaps in the other survey do not matter
+        values = (1 - weight) * lower_values + weight * upper_values
+        values[weight == 0] = lower_values[weight == 0]
+        values[weight == 1] = upper_values[weight == 1]
+
+        output.reshape(-1)[valid] = values
+        return output
+
+    def point_series(self, x, y):
+        """ time series (n_points, t) at points, in chronological order """
+
+        x, y = (np.atleast_1d(np.asarray(item, dtype=float)).ravel()
+                for item in (x, y))
+        order = np.argsort(self.times, kind='stable')
+
+        series = self._sample_space(
+            np.tile(order, len(x)), np.repeat(x, len(order)),
+            np.repeat(y, len(order))
+        )
+        return self.times[order], series.reshape(len(x), len(order))
+
+    def profile(self, y, times=None):
+        """ cross-shore profile along the x axis at alongshore position y, at
+        all surveys or interpolated to the given times """
+
+        if times is None:
+            times = np.sort(self.times)
+        times = np.atleast_1d(to_datetime64(times))
+        x, times = np.meshgrid(self.x, times)
+        return self.x, times[:, 0], self.sample(x, np.full(x.shape, y), times)
+
+    def interpolate_time(self, time):
+        """ the full grid linearly interpolated in time """
+
+        x, y = np.meshgrid(self.x, self.y)
+        return self.sample(x, y, np.full(x.shape, to_datetime64(time)))
+
+    def _time_weights(self, times):
+
+        cube_times = self.times
+        order = np.argsort(cube_times, kind='stable')
+        sorted_times = cube_times[order]
+        count = len(sorted_times)
+
+        # bracketing surveys, times outside the surveyed period are invalid
+        lower = np.searchsorted(sorted_times, times, side='right') - 1
+        valid = (lower >= 0) & (times <= sorted_times[-1])
+        lower = lower.clip(0)
+        upper = np.minimum(lower + 1, count - 1)
+
+        span = (sorted_times[upper] - sorted_times[lower]).astype(float)
+        offset = (times - sorted_times[lower]).astype(float)
+        weight = np.divide(
+            offset, span, out=np.zeros(len(times)), where=span > 0
+        )
+        weight[~valid] = np.nan
+        return order[lower], order[upper], weight
+
+    def _sample_space(self, time_indices, x, y):
+
+        # fractional cell indices on the regular grid
+        column = np.interp(x, self.x, np.arange(len(self.x)),
+                           left=np.nan, right=np.nan)
+        row = np.interp(y, self.y, np.arange(len(self.y)),
+                        left=np.nan, right=np.nan)
+        inside = ~(np.isnan(column) | np.isnan(row))
+
+        values = np.full(x.shape, np.nan)
+        if not self.shape[0] or not inside.any():
+            return values
+        column, row, time_indices = (
+            column[inside], row[inside], time_indices[inside]
+        )
+        i = np.minimum(column.astype(int), len(self.x) - 2).clip(0)
+        j = np.minimum(row.astype(int), len(self.y) - 2).clip(0)
+        di, dj = column - i, row - j
+        i1 = np.minimum(i + 1, len(self.x) - 1)
+        j1 = np.minimum(j + 1, len(self.y) - 1)
+
+        # the four neighbours in one read, missing ones get no weight and
+        # the others are renormalised
+        neighbours = self._read(
+            np.tile(time_indices, 4), np.concatenate((j, j, j1, j1)),
+            np.concatenate((i, i1, i, i1))
+        ).reshape(4, -1)
+        weights = np.stack((
+            (1 - di) * (1 - dj), di * (1 - dj), (1 - di) * dj, di * dj
+        ))
+        missing = np.isnan(neighbours)
+        weights[missing] = 0
+        neighbours[missing] = 0
+
+        total = weights.sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            values[inside] = np.where(
+                total > 0, (neighbours * weights).sum(axis=0) / total, np.nan
+            )
+        return values
+
+    def _read(self, time_indices, rows, columns):
+        """ values at (t, row, column) cell indices, read tile by tile """
+
+        size = self.chunk_size
+        tiles = self.tiles
+        tile_columns = tiles[-1][1] + 1
+        keys = rows // size * tile_columns + columns // size
+
+        values = np.empty(len(keys), dtype=np.float64)
+        for key in np.unique(keys):
+            select = keys == key
+            row, column = divmod(int(key), tile_columns)
+            values[select] = self.tile(row, column)[
+                time_indices[select], rows[select] - row * size,
+                columns[select] - column * size
+            ]
+        return values
+
+    def _save_metadata(self):
+
+        metadata_path = os.path.join(self.directory, METADATA_NAME)
+        with open(metadata_path + '.tmp', 'w') as file:
+            json.dump(self.metadata, file)
+        os.replace(metadata_path + '.tmp', metadata_path)
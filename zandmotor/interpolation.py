@@ -0,0 +1,141 @@
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from argus.instrumentation import timed
+from argus.lazy import lazy_import
+
+
+# loaded at first use to keep imports fast
+interpolate = lazy_import('scipy.interpolate')
+spatial = lazy_import('scipy.spatial')
+
+
+class SurveyInterpolator(object):
+    """ linear interpolation of a scattered survey (e.g. a GPS survey path)
+    onto arbitrary grids. The triangulation and the spatial index are built
+    once per survey and grids are evaluated tile by tile. Cells further than
+    max_distance from the nearest survey point are set to nan """
+
+    def __init__(self, lon, lat, elev, max_distance=None):
+
+        self.points = np.column_stack((lon, lat)).astype(float)
+        self.elev = np.asarray(elev, dtype=float)
+        self.max_distance = max_distance
+
+        self._interpolator = None
+        self._tree = None
+
+    @property
+    def interpolator(self):
+        if self._interpolator is None:
+            self._interpolator = interpolate.LinearNDInterpolator(
+                spatial.Delaunay(self.points), self.elev
+            )
+        return self._interpolator
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            self._tree = spatial.cKDTree(self.points)
+        return self._tree
+
+    @timed('zandmotor.interpolate')
+    def __call__(self, lon_array, lat_array, tile_size=256, dtype=float):
+
+        tiles = self.tiles(lon_array, lat_array, tile_size)
+        output = np.empty((len(lat_array), len(lon_array)), dtype=dtype)
+        for window, values in tiles:
+            output[window] = values
+        return output
+
+    def evaluate(self, lon, lat):
+        """ interpolate at (arrays of) arbitrary points """
+
+        lon, lat = np.broadcast_arrays(
+            np.asarray(lon, dtype=float), np.asarray(lat, dtype=float)
+        )
+        points = np.column_stack((lon.ravel(), lat.ravel()))
+        values = self.interpolator(points)
+
+        # only cells inside the triangulation need a distance check
+        if self.max_distance is not None:
+            inside = np.nonzero(~np.isnan(values))[0]
+            distance = self.tree.query(
+                points[inside], distance_upper_bound=self.max_distance,
+                workers=-1
+            )[0]
+            values[inside[np.isinf(distance)]] = np.nan
+        return values.reshape(lon.shape)
+
+    def tiles(self, lon_array, lat_array, tile_size=256):
+        """ lazily evaluate a grid spanned by 1d axes, yields the window of the
+        full (lat, lon) grid and the values of each tile. The axes are
+        checked before the first tile """
+
+        lon_array, lat_array = (np.asarray(axis, dtype=float)
+                                for axis in (lon_array, lat_array))
+        if lon_array.ndim != 1 or lat_array.ndim != 1:
+            raise ValueError('Grid axes must be 1d')
+        if not len(lon_array) or not len(lat_array):
+            raise ValueError('Grid axes must not be empty')
+        if not len(self.points):
+            raise ValueError('Survey has no points')
+        return self._tiles(lon_array, lat_array, tile_size)
+
+    def _tiles(self, lon_array, lat_array, tile_size):
+
+        lon_min, lat_min = self.points.min(axis=0)
+        lon_max, lat_max = self.points.max(axis=0)
+
+        for lat_start in range(0, len(lat_array), tile_size):
+            for lon_start in range(0, len(lon_array), tile_size):
+                window = (slice(lat_start, lat_start + tile_size),
+                          slice(lon_start, lon_start + tile_size))
+                lon_tile = lon_array[window[1]]
+                lat_tile = lat_array[window[0]]
+
+                # tiles outside the bounding box of the survey are empty
+                if (lon_tile.max() < lon_min or lon_tile.min() > lon_max or
+                        lat_tile.max() < lat_min or lat_tile.min() > lat_max):
+                    values = np.full((len(lat_tile), len(lon_tile)), np.nan)
+                else:
+                    values = self.evaluate(
+                        lon_tile.reshape(1, -1), lat_tile.reshape(-1, 1)
+                    )
+                yield window, values
+
+
+def interpolate_survey(lon, lat, elev, lon_array, lat_array,
+                       max_distance=None, tile_size=256):
+    interpolator = SurveyInterpolator(lon, lat, elev, max_distance)
+    return interpolator(lon_array, lat_array, tile_size=tile_size)
+
+
+def _interpolate_survey(args):
+    return interpolate_survey(*args)
+
+
+def interpolate_surveys(surveys, lon_array, lat_array, max_distance=None,
+                        tile_size=256, processes=None):
+    """ grid many (lon, lat, elev) surveys onto the same grid, in parallel
+    over processes. Returns an (n_surveys, n_lat, n_lon) array """
+
+    lon_array, lat_array = np.asarray(lon_array), np.asarray(lat_array)
+    tasks = [
+        (lon, lat, elev, lon_array, lat_array, max_distance, tile_size)
+        for lon, lat, elev in surveys
+    ]
+
+    output = np.empty((len(tasks), len(lat_array), len(lon_array)))
+    if processes == 1 or len(tasks) < 2:
+        for index, values in enumerate(map(_interpolate_survey, tasks)):
+            output[index] = values
+        return output
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        results = executor.map(_interpolate_survey, tasks)
+        for index, values in enumerate(results):
+            output[index] = values
+    return output
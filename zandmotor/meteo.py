@@ -3,9 +3,17 @@ from calendar import timegm
 import os
 
 import numpy as np
-from pandas import DataFrame
 
-from .utils import parse_datetime, timestamp_to_datetime, open_with_retries
+from argus.alignment import direction_columns
+from argus.instrumentation import add_bytes, timer
+from argus.lazy import lazy_import
+
+from .mirror import open_dataset
+from .utils import parse_datetime
+
+
+# loaded at first use to keep imports fast
+pd = lazy_import('pandas')
 
 
 # set up paths
@@ -48,6 +56,60 @@ def average_angles(angles, radians=False):
     return theta
 
 
+def resample_angles(dataframe, rule, columns=None, radians=False, std=False,
+                    weights=None, **kwargs):
+    """ circular mean of direction columns per resample bin, computed for
+    all bins at once from grouped sin/cos means. Unlike aggregating each bin
+    with average_angles, missing (nan) directions are skipped instead of
+    making the bin nan. Optionally add the circular standard
+    deviation ({column}_std) or weight the directions with a speed column,
+    in which case the vector averaged speed ({column}_vector_speed) is
+    added """
+
+    if std and weights is not None:
+        raise ValueError('std is only available for unweighted means')
+
+    if columns is None:
+        columns = direction_columns(dataframe.columns)
+    elif isinstance(columns, str):
+        columns = [columns]
+
+    angles = dataframe[columns].to_numpy(dtype=float)
+    if not radians:
+        angles = np.deg2rad(angles)
+
+    components = pd.DataFrame(
+        np.concatenate((np.sin(angles), np.cos(angles)), axis=1),
+        index=dataframe.index
+    )
+    if weights is not None:
+        speed = dataframe[weights].to_numpy(dtype=float).reshape(-1, 1)
+        components *= np.tile(speed, (1, 2))
+    components = components.resample(rule, **kwargs).mean()
+
+    sines, cosines = np.split(components.to_numpy(), 2, axis=1)
+    theta = np.arctan2(sines, cosines) % (2*np.pi)
+    output = pd.DataFrame(
+        theta if radians else np.rad2deg(theta),
+        index=components.index, columns=columns
+    )
+
+    if weights is not None:
+        vector_speed = np.hypot(sines, cosines)
+        for index, column in enumerate(columns):
+            output[f'{column}_vector_speed'] = vector_speed[:, index]
+    if std:
+        length = np.minimum(np.hypot(sines, cosines), 1)
+        with np.errstate(divide='ignore'):
+            deviation = np.sqrt(2 * np.log(1 / length))
+        for index, column in enumerate(columns):
+            output[f'{column}_std'] = (
+                deviation[:, index] if radians
+                else np.rad2deg(deviation[:, index])
+            )
+    return output
+
+
 def parse_variables(variables):
 
     if not isinstance(variables, (tuple, list)):
@@ -59,21 +121,57 @@ def parse_variables(variables):
     return variables
 
 
-def get_meteo(time_start, time_end, variables):
+# time axes that have already been read, keyed by file path
+_TIME_AXES = {}
 
-    start, end = map(lambda t: parse_datetime(t), (time_start, time_end))
-    parse_variables(variables)
 
-    # Open file and extract
-    with open_with_retries(METEO_FILE, retries=3) as dataset:
-        timestamps = dataset['time'][:]
+def get_time_axis(file_path=METEO_FILE, refresh=False, mirror=False):
+    """ get the (cached) time axis of a dataset in seconds since epoch """
+
+    if refresh or file_path not in _TIME_AXES:
+        with open_dataset(file_path, mirror, reopen=refresh) as dataset:
+            timestamps = np.ma.filled(
+                np.ma.asarray(dataset['time'][:], dtype=float), np.nan
+            )
+        _TIME_AXES[file_path] = (
+            timestamps, bool(np.all(np.diff(timestamps) >= 0))
+        )
+    return _TIME_AXES[file_path]
 
-        mask = ((timestamps <= timegm(end.timetuple())) &
-                (timestamps >= timegm(start.timetuple())))
 
-        data = {var: dataset.variables[var][mask] for var in variables}
+def clear_time_axes():
+    _TIME_AXES.clear()
 
-    dataframe = DataFrame(data).set_index(timestamps[mask])
-    dataframe.index = dataframe.index.map(lambda ts: timestamp_to_datetime(ts))
 
+def get_meteo(time_start, time_end, variables, file_path=METEO_FILE,
+              mirror=False):
+    """ meteo variables in [time_start, time_end]. With mirror (True or a
+    mirror directory) the records are read through a local DatasetMirror,
+    so repeated queries do not go back to the server """
+
+    start, end = map(lambda t: parse_datetime(t), (time_start, time_end))
+    parse_variables(variables)
+
+    start, end = timegm(start.timetuple()), timegm(end.timetuple())
+    timestamps, is_sorted = get_time_axis(file_path, mirror=mirror)
+
+    # Open file and extract. For a sorted time axis the window is a single
+    # contiguous hyperslab, so only the requested records are read
+    with open_dataset(file_path, mirror) as dataset:
+        if is_sorted:
+            window = slice(
+                np.searchsorted(timestamps, start, side='left'),
+                np.searchsorted(timestamps, end, side='right')
+            )
+        else:
+            window = np.nonzero((timestamps <= end) & (timestamps >= start))[0]
+
+        with timer('zandmotor.meteo'):
+            data = {var: dataset.variables[var][window]
+                    for var in variables}
+    add_bytes('zandmotor.meteo', sum(item.nbytes for item in data.values()))
+
+    dataframe = pd.DataFrame(data).set_index(
+        pd.to_datetime(timestamps[window], unit='s', utc=True)
+    )
     return dataframe
@@ -0,0 +1,344 @@
+
+from contextlib import contextmanager
+from hashlib import sha1
+import itertools
+import json
+import os
+from re import sub as re_sub
+
+import numpy as np
+
+from argus.instrumentation import add_bytes, timer
+
+from .utils import pooled_dataset
+
+
+# set up paths
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+MIRROR_DIR = os.path.join(BASE_DIR, 'data', 'mirror')
+
+MANIFEST_NAME = 'manifest.json'
+
+# mirrors in use, keyed by file path and mirror directory
+_MIRRORS = {}
+
+
+def get_mirror(file_path, mirror_dir=MIRROR_DIR):
+    """ the (shared) mirror of a dataset in mirror_dir """
+
+    key = (file_path, mirror_dir)
+    if key not in _MIRRORS:
+        _MIRRORS[key] = DatasetMirror(file_path, mirror_dir)
+    return _MIRRORS[key]
+
+
+@contextmanager
+def open_dataset(file_path, mirror=False, reopen=False):
+    """ a pooled dataset, or its local mirror if mirror is True or a mirror
+    directory. Reopening a mirror picks up appended time steps """
+
+    if not mirror:
+        with pooled_dataset(file_path, reopen=reopen) as dataset:
+            yield dataset
+        return
+
+    dataset = get_mirror(
+        file_path, MIRROR_DIR if mirror is True else mirror
+    )
+    if reopen:
+        dataset.refresh()
+    yield dataset
+
+
+class DatasetMirror(object):
+    """ local mirror of a (remote) netCDF dataset. Variables are split into
+    chunks that are fetched from the source on first access and stored as
+    numpy files, later reads of the same chunks are served from disk. Can
+    be used in place of an open netCDF4.Dataset for reading """
+
+    def __init__(self, file_path, mirror_dir=MIRROR_DIR, time_chunk=256,
+                 space_chunk=256):
+
+        self.file_path = file_path
+        self.time_chunk = time_chunk
+        self.space_chunk = space_chunk
+
+        file_name = re_sub(r'\W', '_', os.path.basename(file_path))
+        file_hash = sha1(file_path.encode()).hexdigest()[:10]
+        self.directory = os.path.join(mirror_dir, f'{file_name}_{file_hash}')
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.manifest = self._load_manifest()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getitem__(self, name):
+        return MirroredVariable(self, name)
+
+    def close(self):
+        # nothing is kept open, present for compatibility with Dataset
+        pass
+
+    @property
+    def variables(self):
+        # variables are resolved lazily, so dataset.variables[name] works
+        # like it does for a netCDF4.Dataset
+        return self
+
+    def variable_info(self, name):
+
+        if name not in self.manifest['variables']:
+            with self._open_source() as dataset:
+                self._add_variable(dataset, name)
+            self._save_manifest()
+        return self.manifest['variables'][name]
+
+    def present_chunks(self, name):
+        return [tuple(chunk) for chunk in self.variable_info(name)['present']]
+
+    def read(self, name, key=Ellipsis):
+
+        info = self.variable_info(name)
+        ranges, post_indices = _parse_key(key, info['shape'])
+        block = self._read_block(name, ranges)
+
+        # apply remaining (orthogonal) indices one axis at a time, backwards
+        # so that integer indices removing an axis do not shift the others
+        for axis, index in reversed(list(enumerate(post_indices))):
+            if isinstance(index, slice):
+                block = block[(slice(None),) * axis + (index,)]
+            else:
+                block = block.take(index, axis=axis)
+        return block
+
+    def refresh(self, names=None):
+        """ pick up records appended to the source. Complete chunks stay
+        valid, only the trailing partial chunk along time is refetched """
+
+        names = names if names else list(self.manifest['variables'])
+        with self._open_source(reopen=True) as dataset:
+            for name in names:
+                info = self.manifest['variables'][name]
+                shape = list(dataset.variables[name].shape)
+                old_shape = info['shape']
+
+                if shape[1:] != old_shape[1:] or shape[0] < old_shape[0]:
+                    self._remove_chunks(name, info['present'])
+                    self._add_variable(dataset, name)
+                elif shape[0] > old_shape[0]:
+                    last_chunk = old_shape[0] // info['chunks'][0]
+                    self._remove_chunks(name, [
+                        chunk for chunk in info['present']
+                        if chunk[0] == last_chunk
+                    ])
+                    info['shape'] = shape
+        self._save_manifest()
+
+    def clear(self, names=None):
+
+        names = names if names else list(self.manifest['variables'])
+        for name in names:
+            self._remove_chunks(name, self.present_chunks(name))
+            self.manifest['variables'].pop(name)
+        self._save_manifest()
+
+    def _open_source(self, reopen=False):
+        return pooled_dataset(self.file_path, reopen=reopen)
+
+    def _add_variable(self, dataset, name):
+
+        if name not in dataset.variables:
+            raise ValueError(f'{name} not in {self.file_path}')
+
+        # the time axis grows, so its chunk size does not depend on the
+        # current length
+        variable = dataset.variables[name]
+        shape = list(variable.shape)
+        self.manifest['variables'][name] = {
+            'shape': shape,
+            'dtype': variable.dtype.str,
+            'chunks': [self.time_chunk][:len(shape)] + [
+                max(1, min(self.space_chunk, size)) for size in shape[1:]
+            ],
+            'present': []
+        }
+
+    def _read_block(self, name, ranges):
+
+        info = self.manifest['variables'][name]
+        chunks = info['chunks']
+
+        chunk_ranges = [
+            range(start // size, -(-stop // size)) if stop > start
+            else range(0)
+            for (start, stop), size in zip(ranges, chunks)
+        ]
+        needed = list(itertools.product(*chunk_ranges))
+
+        present = set(map(tuple, info['present']))
+        missing = [chunk for chunk in needed if chunk not in present]
+        if missing:
+            self._fetch_chunks(name, missing)
+
+        shape = [stop - start for start, stop in ranges]
+        data = np.empty(shape, dtype=np.dtype(info['dtype']))
+        mask = np.zeros(shape, dtype=bool)
+        for chunk in needed:
+            chunk_data, chunk_mask = self._load_chunk(name, chunk)
+
+            source, target = [], []
+            for index, (start, stop), size in zip(chunk, ranges, chunks):
+                lower = max(start, index * size)
+                upper = min(stop, (index + 1) * size)
+                source.append(slice(lower - index * size,
+                                    upper - index * size))
+                target.append(slice(lower - start, upper - start))
+
+            data[tuple(target)] = chunk_data[tuple(source)]
+            if chunk_mask is not None:
+                mask[tuple(target)] = chunk_mask[tuple(source)]
+        return np.ma.masked_array(data, mask=mask)
+
+    def _fetch_chunks(self, name, chunks):
+
+        info = self.manifest['variables'][name]
+        with self._open_source() as dataset:
+            variable = dataset.variables[name]
+            for chunk in chunks:
+                key = tuple(
+                    slice(index * size, min((index + 1) * size, length))
+                    for index, size, length
+                    in zip(chunk, info['chunks'], info['shape'])
+                )
+                with timer('zandmotor.mirror.fetch'):
+                    values = variable[key]
+                add_bytes('zandmotor.mirror.fetch', values.nbytes)
+
+                file_path = self._chunk_path(name, chunk)
+                np.save(file_path, np.ma.getdata(values))
+                mask = np.ma.getmaskarray(values)
+                if mask.any():
+                    np.save(file_path.replace('.npy', '.mask.npy'), mask)
+
+                info['present'].append(list(chunk))
+        self._save_manifest()
+
+    def _load_chunk(self, name, chunk):
+
+        file_path = self._chunk_path(name, chunk)
+        mask_path = file_path.replace('.npy', '.mask.npy')
+
+        data = np.load(file_path, mmap_mode='r')
+        mask = (np.load(mask_path, mmap_mode='r')
+                if os.path.exists(mask_path) else None)
+        return data, mask
+
+    def _remove_chunks(self, name, chunks):
+
+        info = self.manifest['variables'][name]
+        for chunk in list(chunks):
+            file_path = self._chunk_path(name, chunk)
+            for path in (file_path, file_path.replace('.npy', '.mask.npy')):
+                if os.path.exists(path):
+                    os.remove(path)
+            info['present'].remove(list(chunk))
+
+    def _chunk_path(self, name, chunk):
+
+        variable_dir = os.path.join(self.directory, name)
+        os.makedirs(variable_dir, exist_ok=True)
+        return os.path.join(
+            variable_dir, '_'.join(map(str, chunk)) + '.npy'
+        )
+
+    def _load_manifest(self):
+
+        manifest_path = os.path.join(self.directory, MANIFEST_NAME)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as file:
+                return json.load(file)
+        return {'file_path': self.file_path, 'variables': {}}
+
+    def _save_manifest(self):
+
+        # write to a temporary file first so the manifest is never partial
+        manifest_path = os.path.join(self.directory, MANIFEST_NAME)
+        with open(manifest_path + '.tmp', 'w') as file:
+            json.dump(self.manifest, file)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+
+class MirroredVariable(object):
+
+    def __init__(self, mirror, name):
+        self.mirror = mirror
+        self.name = name
+
+    def __getitem__(self, key):
+        return self.mirror.read(self.name, key)
+
+    @property
+    def shape(self):
+        return tuple(self.mirror.variable_info(self.name)['shape'])
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def dtype(self):
+        return np.dtype(self.mirror.variable_info(self.name)['dtype'])
+
+
+def _parse_key(key, shape):
+    """ split an index into the range to read along each axis and the index
+    to apply to the block that is read """
+
+    if not isinstance(key, tuple):
+        key = (key,)
+    if any(item is Ellipsis for item in key):
+        position = [item is Ellipsis for item in key].index(True)
+        fill = (slice(None),) * (len(shape) - len(key) + 1)
+        key = key[:position] + fill + key[position + 1:]
+    key = key + (slice(None),) * (len(shape) - len(key))
+
+    if len(key) != len(shape):
+        raise IndexError('Too many indices')
+
+    ranges, post_indices = [], []
+    for item, size in zip(key, shape):
+        if isinstance(item, slice):
+            start, stop, step = item.indices(size)
+            if step == 1:
+                ranges.append((start, max(start, stop)))
+                post_indices.append(slice(None))
+                continue
+            item = np.arange(start, stop, step)
+        elif np.ndim(item) == 0:
+            index = int(item)
+            index = index + size if index < 0 else index
+            if not 0 <= index < size:
+                raise IndexError(f'Index {item} out of bounds')
+            ranges.append((index, index + 1))
+            post_indices.append(0)
+            continue
+
+        item = np.asarray(item)
+        if item.dtype == bool:
+            item = np.nonzero(item)[0]
+        item = np.where(item < 0, item + size, item).astype(int)
+        if item.size == 0:
+            ranges.append((0, 0))
+            post_indices.append(item)
+            continue
+        if item.min() < 0 or item.max() >= size:
+            raise IndexError('Index out of bounds')
+        ranges.append((int(item.min()), int(item.max()) + 1))
+        post_indices.append(item - item.min())
+
+    return ranges, post_indices
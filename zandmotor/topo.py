@@ -5,11 +5,16 @@ Created on Mon Apr 30 13:51:09 2018
 @author: isaacwilliams
 """
 
+from collections import OrderedDict
+from numbers import Integral
 
 import numpy as np
-from scipy.interpolate import griddata
 
-from .utils import open_with_retries, parse_datetime, timestamp_to_datetime
+from argus.instrumentation import add_bytes, timer
+
+from .interpolation import SurveyInterpolator
+from .mirror import open_dataset
+from .utils import timestamp_to_datetime, to_datetime64
 
 
 GPS_FILE = ('http://opendap.tudelft.nl/thredds/dodsC/data2/zandmotor/'
@@ -20,78 +25,242 @@ LIDAR_FILE = ('http://opendap.deltares.nl/thredds/dodsC/'
               'opendap/rijkswaterstaat/kusthoogte/30dz1.nc')
 
 
+# time axes, coordinate axes and recently loaded elevation windows, keyed by
+# file path
+_TIME_AXES = {}
+_AXES = {}
+_ELEVATION_CACHE = OrderedDict()
+
+
 class Lidar(object):
 
     file_path = LIDAR_FILE
 
-    def __init__(self):
-        self.timestamps = self.get_timestamps()
+    # bytes of elevation windows kept in memory
+    cache_bytes = 256 * 2 ** 20
 
-    def get_timestamps(self):
+    # read through a local DatasetMirror if True (or a mirror directory)
+    mirror = False
 
-        with open_with_retries(self.file_path) as dataset:
-            timestamps = dataset['time'][:] * (24 * 60 * 60)
-
-        timestamps = [
-             timestamp_to_datetime(timestamp) for timestamp in timestamps
-        ]
-        return np.asarray(timestamps)
+    def __init__(self, mirror=None):
+        if mirror is not None:
+            self.mirror = mirror
+        self.timestamps = self.get_timestamps()
 
-    def get_timestamp_index(self, datetime_obj):
-        datetime_obj = parse_datetime(datetime_obj)
-        return abs(self.timestamps - datetime_obj).argmin()
+    def get_timestamps(self, refresh=False):
+        """ survey times as datetime64 (UTC), read once per file """
+
+        if refresh or self.file_path not in _TIME_AXES:
+            with open_dataset(self.file_path, self.mirror,
+                              reopen=refresh) as dataset:
+                days = np.ma.filled(
+                    np.ma.asarray(dataset['time'][:], dtype=float), np.nan
+                )
+
+            timestamps = np.round(days * (24 * 60 * 60 * 1000))\
+                .astype('datetime64[ms]')
+            _TIME_AXES[self.file_path] = (
+                timestamps, *_sort_timestamps(timestamps)
+            )
+
+        timestamps = _TIME_AXES[self.file_path][0]
+        if refresh:
+            self.timestamps = timestamps
+        return timestamps
+
+    def get_timestamp_index(self, datetime_obj, method='nearest'):
+
+        index = self.get_timestamp_indices([datetime_obj], method=method)[0]
+        if index < 0:
+            raise ValueError(f'No {method} survey for {datetime_obj}')
+        return int(index)
+
+    def get_timestamp_indices(self, datetimes, method='nearest'):
+        """ indices of the nearest, previous (<=) or next (>=) survey for an
+        array of query times, found by binary search. Queries without a
+        previous or next survey get index -1 """
+
+        if method not in ('nearest', 'previous', 'next'):
+            raise ValueError('method must be nearest, previous or next')
+
+        # reuse the sorting of the cached axis unless timestamps was replaced
+        cached = _TIME_AXES.get(self.file_path)
+        if cached is not None and cached[0] is self.timestamps:
+            order, sorted_timestamps = cached[1:]
+        else:
+            order, sorted_timestamps = _sort_timestamps(self.timestamps)
+
+        queries = to_datetime64(datetimes)
+        count = len(sorted_timestamps)
+        indices = np.full(queries.shape, -1, dtype=int)
+        if not count:
+            return indices
+
+        if method == 'previous':
+            positions = np.searchsorted(
+                sorted_timestamps, queries, side='right'
+            ) - 1
+            valid = positions >= 0
+        elif method == 'next':
+            positions = np.searchsorted(
+                sorted_timestamps, queries, side='left'
+            )
+            valid = positions < count
+        else:
+            upper = np.clip(
+                np.searchsorted(sorted_timestamps, queries), 1, count - 1
+            ) if count > 1 else np.zeros(queries.shape, dtype=int)
+            lower = np.maximum(upper - 1, 0)
+            positions = np.where(
+                abs(sorted_timestamps[upper] - queries)
+                < abs(queries - sorted_timestamps[lower]), upper, lower
+            )
+            valid = np.ones(queries.shape, dtype=bool)
+
+        indices[valid] = order[positions[valid]]
+        return indices
 
     def is_valid_timestamp_index(self, index):
 
-        if not isinstance(index, int):
+        if not isinstance(index, Integral):
             raise TypeError('Index must be integer')
 
-        if (isinstance(index, int)
-                and ((index < 0) or index > len(self.timestamps))):
+        if (index < 0) or index >= len(self.timestamps):
             raise ValueError('Enter a valid integer')
 
-    def load_topo_from_datetime(self, datetime_obj):
+    def load_topo_from_datetime(self, datetime_obj, **kwargs):
 
         index = self.get_timestamp_index(datetime_obj)
-        lon, lat, elev = self.load_topo_from_index(index)
+        lon, lat, elev = self.load_topo_from_index(index, **kwargs)
 
-        topo_timestamp = self.timestamps[index]
+        topo_timestamp = timestamp_to_datetime(
+            self.timestamps[index].astype('datetime64[ms]').astype(int) / 1e3
+        )
         return lon, lat, elev, topo_timestamp
 
-    def load_topo_from_index(self, index):
+    def get_axes(self):
+
+        if self.file_path not in _AXES:
+            with open_dataset(self.file_path, self.mirror) as dataset:
+                _AXES[self.file_path] = (dataset['x'][:], dataset['y'][:])
+        return _AXES[self.file_path]
+
+    def get_window(self, lon_lims=None, lat_lims=None):
+        """ convert a bounding box to slices of the (cached) grid axes """
+
+        lon, lat = self.get_axes()
+        return tuple(
+            _axis_window(axis, lims) for axis, lims
+            in ((lat, lat_lims), (lon, lon_lims))
+        )
+
+    def load_topo_from_index(self, index, lon_lims=None, lat_lims=None):
 
         self.is_valid_timestamp_index(index)
 
-        with open_with_retries(self.file_path) as dataset:
-            lon = dataset['x'][:]
-            lat = dataset['y'][:]
-            elev = dataset['z'][index]
-        return lon, lat, elev
+        lon, lat = self.get_axes()
+        lat_window, lon_window = self.get_window(lon_lims, lat_lims)
+
+        # only the hyperslab covering the bounding box is read
+        key = (self.file_path, int(index),
+               lat_window.start, lat_window.stop,
+               lon_window.start, lon_window.stop)
+        if key in _ELEVATION_CACHE:
+            _ELEVATION_CACHE.move_to_end(key)
+            elev = _ELEVATION_CACHE[key]
+        else:
+            with open_dataset(self.file_path, self.mirror) as dataset, \
+                    timer('zandmotor.topo'):
+                elev = dataset['z'][index, lat_window, lon_window]
+            add_bytes('zandmotor.topo', elev.nbytes)
+            elev = _read_only(np.ma.asarray(elev))
+
+            # windows larger than the whole cache are not kept
+            if _cached_bytes(elev) <= self.cache_bytes:
+                _ELEVATION_CACHE[key] = elev
+            while sum(map(_cached_bytes, _ELEVATION_CACHE.values())) \
+                    > self.cache_bytes:
+                _ELEVATION_CACHE.popitem(last=False)
+
+        # a (read-only) view, cached windows are shared between calls
+        return lon[lon_window], lat[lat_window], elev.view()
+
+    @staticmethod
+    def clear_cache():
+        _TIME_AXES.clear()
+        _AXES.clear()
+        _ELEVATION_CACHE.clear()
 
     @classmethod
-    def get_topo(cls, datetime_obj):
-        return cls().load_topo_from_datetime(datetime_obj)
+    def get_topo(cls, datetime_obj, **kwargs):
+        return cls().load_topo_from_datetime(datetime_obj, **kwargs)
 
 
 class GPS(Lidar):
 
     file_path = GPS_FILE
 
-    def load_topo_from_index(self, index):
-        with open_with_retries(self.file_path) as dataset:
+    def load_topo_from_index(self, index, lon_lims=None, lat_lims=None):
+        with open_dataset(self.file_path, self.mirror) as dataset, \
+                timer('zandmotor.topo'):
             xyz = dataset['survey_path_RD'][index]
-            lon, lat, elev = xyz[~xyz.mask[:, 0], :].data.T
-        return lon, lat, elev
+        add_bytes('zandmotor.topo', xyz.nbytes)
+        lon, lat, elev = xyz[~np.ma.getmaskarray(xyz)[:, 0], :].data.T
+
+        mask = np.ones(lon.shape, dtype=bool)
+        for coords, lims in ((lon, lon_lims), (lat, lat_lims)):
+            if lims is not None:
+                mask &= (coords >= min(lims)) & (coords <= max(lims))
+        return lon[mask], lat[mask], elev[mask]
+
+    def get_interpolator(self, index, max_distance=None, **kwargs):
+        return SurveyInterpolator(
+            *self.load_topo_from_index(index, **kwargs),
+            max_distance=max_distance
+        )
 
     @staticmethod
     def interpolate_data(
         lon, lat, elev, lon_lims=(7e4, 7.5e4),
-            lat_lims=(4.5e5, 4.55e5), lon_spacing=2, lat_spacing=2):
+            lat_lims=(4.5e5, 4.55e5), lon_spacing=2, lat_spacing=2,
+            max_distance=None):
 
         lon_array = np.arange(*lon_lims, lon_spacing)
         lat_array = np.arange(*lat_lims, lat_spacing)
 
-        xx, yy = np.meshgrid(lon_array, lat_array)
-        interpolated_elev = griddata((lon, lat), elev, (xx, yy))
+        interpolated_elev = SurveyInterpolator(
+            lon, lat, elev, max_distance=max_distance
+        )(lon_array, lat_array)
 
         return lon_array, lat_array, interpolated_elev
+
+
+def _cached_bytes(elev):
+    mask = np.ma.getmask(elev)
+    return elev.nbytes + (0 if mask is np.ma.nomask else mask.nbytes)
+
+
+def _read_only(elev):
+
+    elev.flags.writeable = False
+    mask = np.ma.getmask(elev)
+    if mask is not np.ma.nomask:
+        mask.flags.writeable = False
+    return elev
+
+
+def _axis_window(axis, lims):
+
+    if lims is None:
+        return slice(0, len(axis))
+
+    # works for ascending as well as descending axes
+    indices = np.nonzero((axis >= min(lims)) & (axis <= max(lims)))[0]
+    if not len(indices):
+        return slice(0, 0)
+    return slice(int(indices[0]), int(indices[-1]) + 1)
+
+
+def _sort_timestamps(timestamps):
+    order = np.argsort(timestamps, kind='stable')
+    return order, timestamps[order]
@@ -1,9 +1,21 @@
 
+from contextlib import contextmanager
 from datetime import datetime
+import random
+import threading
+import time
 
 from netCDF4 import Dataset
+import numpy as np
 from pytz import utc as pytz_utc
 
+from argus.instrumentation import timer
+from argus.lazy import lazy_import
+
+
+# loaded at first use to keep imports fast
+pd = lazy_import('pandas')
+
 
 def timestamp_to_datetime(timestamp):
     return pytz_utc.localize(datetime.utcfromtimestamp(timestamp))
@@ -20,12 +32,171 @@ def parse_datetime(datetime_obj):
         return datetime_obj.astimezone(pytz_utc)
 
 
-def open_with_retries(file_path, retries=3):
-    try:
-        return Dataset(file_path, 'r')
-    except OSError as exception:
-        if retries > 0:
+def to_datetime64(datetimes):
+    """ convert (arrays of) datetimes to UTC datetime64, naive datetimes are
+    taken to be UTC as in parse_datetime """
+
+    datetimes = np.asarray(datetimes)
+    if np.issubdtype(datetimes.dtype, np.datetime64):
+        return datetimes.astype('datetime64[ms]')
+
+    values = datetimes.ravel()
+    if len(values) and pd.api.types.infer_dtype(values) != 'datetime':
+        raise TypeError
+    return pd.DatetimeIndex(pd.to_datetime(values, utc=True))\
+        .tz_localize(None).to_numpy(dtype='datetime64[ms]')\
+        .reshape(datetimes.shape)
+
+
+def backoff_delay(attempt, delay=0.5, max_delay=30):
+    """ exponential backoff with full jitter """
+    return random.uniform(0, min(max_delay, delay * 2 ** attempt))
+
+
+def open_with_retries(file_path, retries=3, delay=0.5, max_delay=30,
+                      on_retry=None):
+
+    for attempt in range(retries + 1):
+        try:
+            with timer('zandmotor.open'):
+                return Dataset(file_path, 'r')
+        except OSError as exception:
+            if attempt == retries:
+                raise OSError(exception)
             print(f"Retrying {file_path}")
-            return open_with_retries(file_path, retries=retries - 1)
-        else:
-            raise OSError(exception)
+            if on_retry:
+                on_retry()
+            time.sleep(backoff_delay(attempt, delay, max_delay))
+
+
+class DatasetPool(object):
+    """ thread safe pool of open (remote) netCDF datasets keyed by file path.
+    Handles are reused between calls and closed once they have been idle for
+    longer than idle_timeout seconds """
+
+    def __init__(self, idle_timeout=300, retries=3, delay=0.5, max_delay=30):
+
+        self.idle_timeout = idle_timeout
+        self.retries = retries
+        self.delay = delay
+        self.max_delay = max_delay
+
+        self._lock = threading.Lock()
+        self._handles = {}
+        self._metrics = dict.fromkeys(
+            ('opens', 'reuses', 'retries', 'failures', 'closes'), 0
+        )
+
+    @property
+    def metrics(self):
+        with self._lock:
+            return dict(self._metrics, open_handles=len(self._handles))
+
+    @contextmanager
+    def dataset(self, file_path, reopen=False):
+        """ yield a pooled dataset, which is not closed on exit. Access to a
+        handle is serialized as netCDF4 datasets are not thread safe. A
+        handle that fails while in use is discarded """
+
+        entry = self._acquire(file_path, reopen=reopen)
+        try:
+            with entry['lock']:
+                yield entry['dataset']
+        except (OSError, RuntimeError):
+            self.discard(file_path, entry)
+            raise
+        finally:
+            with self._lock:
+                entry['users'] -= 1
+                entry['last_used'] = time.monotonic()
+                if entry['discarded'] and not entry['users']:
+                    self._close(entry)
+
+    def discard(self, file_path, entry=None):
+
+        with self._lock:
+            current = self._handles.get(file_path)
+            if current is None or (entry is not None and current is not entry):
+                return
+            # handles still in use are closed once they are released
+            self._handles.pop(file_path)
+            current['discarded'] = True
+            if not current['users']:
+                self._close(current)
+
+    def close_idle(self):
+
+        now = time.monotonic()
+        with self._lock:
+            for file_path, entry in list(self._handles.items()):
+                if (now - entry['last_used'] > self.idle_timeout
+                        and not entry['users']):
+                    self._handles.pop(file_path)
+                    self._close(entry)
+
+    def close_all(self):
+
+        with self._lock:
+            for entry in self._handles.values():
+                self._close(entry)
+            self._handles.clear()
+
+    def _acquire(self, file_path, reopen=False):
+
+        self.close_idle()
+        if reopen:
+            self.discard(file_path)
+
+        with self._lock:
+            entry = self._handles.get(file_path)
+            if entry is not None:
+                self._metrics['reuses'] += 1
+                entry['users'] += 1
+                return entry
+
+        try:
+            dataset = open_with_retries(
+                file_path, retries=self.retries, delay=self.delay,
+                max_delay=self.max_delay, on_retry=self._count_retry
+            )
+        except OSError:
+            with self._lock:
+                self._metrics['failures'] += 1
+            raise
+
+        with self._lock:
+            self._metrics['opens'] += 1
+            # another thread may have opened the same file in the meantime
+            if file_path in self._handles:
+                dataset.close()
+                self._metrics['closes'] += 1
+                entry = self._handles[file_path]
+                entry['users'] += 1
+                return entry
+            entry = {
+                'dataset': dataset,
+                'lock': threading.RLock(),
+                'users': 1,
+                'discarded': False,
+                'last_used': time.monotonic()
+            }
+            self._handles[file_path] = entry
+            return entry
+
+    def _count_retry(self):
+        with self._lock:
+            self._metrics['retries'] += 1
+
+    def _close(self, entry):
+        try:
+            entry['dataset'].close()
+        except RuntimeError:
+            pass
+        self._metrics['closes'] += 1
+
+
+DATASET_POOL = DatasetPool()
+
+
+def pooled_dataset(file_path, reopen=False):
+    return DATASET_POOL.dataset(file_path, reopen=reopen)